@@ -0,0 +1,726 @@
+# bench.py
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import count
+
+import credentials01
+import server01
+from framing01 import FRAMES, LINES, RECV_SIZE, Framing
+
+# ---------- DB benchmark ----------
+# The "before" side reproduces the original helpers: one sqlite3.connect per call.
+def legacy_verify_user(identifier, password):
+    conn = sqlite3.connect(server01.DB_FILE)
+    cur = conn.cursor()
+    cur.execute("SELECT username, password FROM users WHERE phone=? OR username=?", (identifier, identifier))
+    row = cur.fetchone()
+    conn.close()
+    return bool(row) and row[1] == password
+
+def legacy_store_message(sender, recipient, message, timestamp):
+    conn = sqlite3.connect(server01.DB_FILE)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO messages (sender, recipient, message, timestamp, delivered) VALUES (?, ?, ?, ?, 0)",
+                (sender, recipient, message, timestamp))
+    conn.commit()
+    conn.close()
+
+def pooled_verify_user(identifier, password):
+    # the legacy query on a pooled connection, so the two differ only in the
+    # pool; the row lookup only: password hashing is measured by "load login_load"
+    with server01.db() as conn:
+        row = conn.execute("SELECT username, password FROM users WHERE phone=? OR username=?",
+                           (identifier, identifier)).fetchone()
+    return row is not None
+
+def directory_verify_user(identifier, password):
+    # what login does today: the in-memory user directory, no SQL at all
+    return server01.lookup_user(identifier) is not None
+
+def pooled_store_message(sender, recipient, message, timestamp):
+    server01.store_message(sender, recipient, message, timestamp)
+
+def run_threads(fn, threads, per_thread):
+    def worker(t):
+        for i in range(per_thread):
+            fn(t, i)
+    ts = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return threads * per_thread / elapsed
+
+def bench_db(args):
+    results = {}
+    for mode in ("legacy", "pooled", "write_behind"):
+        workdir = tempfile.mkdtemp(prefix="chatbench-")
+        server01.DB_FILE = os.path.join(workdir, "bench.db")
+        server01.directory = server01.UserDirectory()
+        if mode == "legacy":
+            # the original schema setup, in rollback-journal mode
+            conn = sqlite3.connect(server01.DB_FILE)
+            conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, country TEXT, phone TEXT, username TEXT UNIQUE, password TEXT)")
+            conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT, recipient TEXT, message TEXT, timestamp TEXT, delivered INTEGER DEFAULT 0)")
+            conn.executemany("INSERT INTO users (country, phone, username, password) VALUES ('', ?, ?, 'pw')",
+                             [(f"p{i}", f"user{i}") for i in range(args.users)])
+            conn.commit()
+            conn.close()
+            verify, store = legacy_verify_user, legacy_store_message
+        else:
+            server01.init_db()
+            pw_hash = credentials01.hash_password("pw")
+            for i in range(args.users):
+                server01.add_user("", f"p{i}", f"user{i}", pw_hash)
+            verify, store = pooled_verify_user, pooled_store_message
+            if mode == "write_behind":
+                server01.offline_writer = server01.OfflineWriter()
+
+        login = run_threads(lambda t, i: verify(f"user{(t * 7919 + i) % args.users}", "pw"),
+                            args.threads, args.ops)
+        offline = run_threads(lambda t, i: store(f"user{t}", f"user{i % args.users}", "hello there", "10:00 AM"),
+                              args.threads, args.ops)
+        results[mode] = {"login_per_s": round(login, 1), "offline_store_per_s": round(offline, 1)}
+        if mode == "pooled":
+            # a cache against SQL, not pool against no pool: kept out of speedup_vs_legacy
+            cached = run_threads(lambda t, i: directory_verify_user(f"user{(t * 7919 + i) % args.users}", "pw"),
+                                 args.threads, args.ops)
+            results[mode]["login_directory_per_s"] = round(cached, 1)
+        server01.stop_services()
+        if server01.db_pool is not None:
+            server01.db_pool.close()
+            server01.db_pool = None
+    results["speedup_vs_legacy"] = {
+        mode: {k: round(results[mode][k] / results["legacy"][k], 2) for k in results["legacy"]}
+        for mode in ("pooled", "write_behind")
+    }
+    results["history"] = bench_history(args)
+    results["stores"] = bench_stores(args)
+    return results
+
+def bench_stores(args):
+    """Offline messages through each --store engine: appended in writer-sized
+    batches, then drained a backlog page at a time as recipients log in."""
+    out = {}
+    n = args.threads * args.ops
+    rows = [(f"user{i % 97}", f"user{i % args.users}", "hello there", "10:00 AM", 0.0, 0) for i in range(n)]
+    for engine in ("sqlite", "log", "memory"):
+        workdir = tempfile.mkdtemp(prefix="chatbench-")
+        server01.DB_FILE = os.path.join(workdir, "stores.db")
+        server01.STORE_ENGINE = engine
+        server01.init_db()
+        store = server01.store()
+        start = time.perf_counter()
+        for i in range(0, n, server01.WRITE_BATCH):
+            store.append(rows[i:i + server01.WRITE_BATCH])
+        appended = time.perf_counter() - start
+        start = time.perf_counter()
+        drained = 0
+        for u in range(args.users):
+            while True:
+                page = store.pending(f"user{u}", server01.BACKLOG_PAGE)
+                if not page:
+                    break
+                store.consume(f"user{u}", page)
+                drained += len(page)
+        elapsed = time.perf_counter() - start
+        assert drained == n
+        out[engine] = {"append_per_s": round(n / appended, 1), "drain_per_s": round(n / elapsed, 1)}
+        server01.close_store()
+        if server01.db_pool is not None:
+            server01.db_pool.close()
+            server01.db_pool = None
+    server01.STORE_ENGINE = "sqlite"
+    return out
+
+def bench_history(args):
+    """One page of a long conversation read at the newest end, the middle and
+    the oldest end; keyset pages should cost the same at every depth.
+    OFFSET paging over the same index is timed for comparison."""
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    server01.DB_FILE = os.path.join(workdir, "history.db")
+    server01.init_db()
+    now = time.time()
+    # the measured pair's messages interleaved with other conversations
+    rows = []
+    for i in range(args.history_rows):
+        a, b = ("user0", "user1") if i % 4 == 0 else (f"user{i % 97 + 2}", f"user{i % 89 + 2}")
+        rows.append((a, b, f"message {i}", "10:00 AM", now + i / 1000.0, 1))
+    ids = []
+    for i in range(0, len(rows), 5000):
+        ids += server01.insert_messages(rows[i:i + 5000])
+    ids = ids[::4]
+    page = server01.HISTORY_PAGE
+    out = {"rows": args.history_rows, "conversation_rows": len(ids)}
+    for label, before in (("newest", server01.NEWEST), ("middle", ids[len(ids) // 2]), ("oldest", ids[page])):
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            got = server01.fetch_conversation("user0", "user1", before, page)
+        out[f"{label}_page_ms"] = ms((time.perf_counter() - start) / args.ops)
+        assert len(got) == page
+    with server01.db() as conn:
+        for label, offset in (("newest", 0), ("oldest", len(ids) - page)):
+            start = time.perf_counter()
+            for _ in range(args.ops):
+                conn.execute("SELECT id, sender, recipient, message, timestamp, sent_at FROM messages "
+                             "WHERE min(sender, recipient)='user0' AND max(sender, recipient)='user1' "
+                             "ORDER BY id DESC LIMIT ? OFFSET ?", (page, offset)).fetchall()
+            out[f"offset_{label}_page_ms"] = ms((time.perf_counter() - start) / args.ops)
+    if server01.db_pool is not None:
+        server01.db_pool.close()
+        server01.db_pool = None
+    return out
+
+# ---------- Load benchmark ----------
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def latency_summary(values):
+    return {"count": len(values),
+            "p50_ms": ms(percentile(values, 50)),
+            "p95_ms": ms(percentile(values, 95)),
+            "p99_ms": ms(percentile(values, 99)),
+            "max_ms": ms(max(values) if values else None)}
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def process_tree(pid):
+    pids = [pid]
+    children = f"/proc/{pid}/task/{pid}/children"
+    if os.path.exists(children):
+        pids += [int(p) for p in open(children).read().split()]
+    return pids
+
+def process_rss_kb(pid):
+    """RSS of pid plus its children (sharded servers), from /proc; None elsewhere."""
+    if pid is None:
+        return None
+    total = 0
+    try:
+        for p in process_tree(pid):
+            for line in open(f"/proc/{p}/status"):
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+    except OSError:
+        return None
+    return total
+
+def process_cpu_s(pid):
+    """User + system CPU seconds of pid plus its children, from /proc; None elsewhere."""
+    if pid is None:
+        return None
+    ticks = 0
+    try:
+        for p in process_tree(pid):
+            # fields after the parenthesised command name; utime and stime are 14 and 15
+            fields = open(f"/proc/{p}/stat").read().rsplit(")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+    except (OSError, IndexError, ValueError):
+        return None
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+class SimClient:
+    """One simulated user speaking the real protocol over asyncio streams."""
+
+    def __init__(self, name, framing_mode, compression=False):
+        self.name = name
+        self.framing_mode = framing_mode
+        self.compression = compression     # offer deflate in the hello (frames only)
+        self.framing = Framing()
+        self.responses = asyncio.Queue()   # replies to requests sent without a rid, in order
+        self.waiting = {}                  # rid -> Future for the reply
+        self.rids = count(1)
+        self.latencies = []       # send -> receive, seconds
+        self.received = 0
+        self.presence_frames = 0
+        self.throttled = 0        # requests the server's rate limits refused
+        self.bytes_in = 0
+        self.arrived = asyncio.Event()
+        self.connect_time = None
+        self.token = None
+
+    async def connect(self, host, port):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+        if self.framing_mode == FRAMES:
+            reply = await self.request(self.framing.client_hello(compression=self.compression))
+            if reply.get("action") == "hello":
+                self.framing.switch(reply)
+        self.connect_time = time.perf_counter() - start
+
+    def send(self, obj):
+        self.writer.write(self.framing.encode(obj))
+
+    async def request(self, obj):
+        rid = next(self.rids)
+        fut = self.waiting[rid] = asyncio.get_running_loop().create_future()
+        self.send(dict(obj, rid=rid))
+        return await fut
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                self.bytes_in += len(data)
+                self.framing.feed(data)
+                for msg in self.framing.messages():
+                    self._on_message(msg)
+        except (ConnectionError, OSError):
+            pass
+
+    def _on_message(self, msg):
+        action = msg.get("action")
+        if action in ("receive_message", "room_message"):
+            self._on_chat(msg)
+        elif action in ("receive_messages", "room_messages"):
+            for m in msg.get("messages", []):
+                self._on_chat(m)
+        elif action in ("update_users", "user_online", "user_offline"):
+            self.presence_frames += 1
+        elif action == "ping":
+            self.send({"action":"pong"})
+        elif "status" in msg or action in ("hello", "pong"):
+            if "throttled" in msg:
+                self.throttled += 1
+            fut = self.waiting.pop(msg.get("rid"), None)
+            if fut is not None:
+                fut.set_result(msg)
+            elif action != "pong":
+                self.responses.put_nowait(msg)
+
+    def _on_chat(self, msg):
+        self.received += 1
+        try:
+            sent_at = float(msg.get("message", "").split(" ", 1)[0])
+            self.latencies.append(time.perf_counter() - sent_at)
+        except ValueError:
+            pass
+        self.arrived.set()
+
+    async def login(self, batch=True):
+        resp = await self.request({"action":"login","identifier":self.name,"password":"pw",
+                                   "batch":batch,"deltas":True})
+        self.token = resp.get("token")
+        return resp
+
+    async def resume(self, token, batch=True):
+        resp = await self.request({"action":"resume","token":token,"last_id":0,
+                                   "batch":batch,"deltas":True})
+        self.token = resp.get("token")
+        return resp
+
+    async def close(self, logout=False):
+        # logout=True ends the session for good; a bare close leaves it for a
+        # resume, so the user stays listed online through --resume-grace
+        try:
+            if logout:
+                await asyncio.wait_for(self.request({"action":"logout"}), 10)
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            pass
+        self.reader_task.cancel()
+
+
+async def connect_all(args, names, concurrency=200):
+    sem = asyncio.Semaphore(concurrency)
+    clients = [SimClient(n, args.framing, args.compression) for n in names]
+
+    async def one(c):
+        async with sem:
+            await c.connect(args.host, args.port)
+    await asyncio.gather(*(one(c) for c in clients))
+    return clients
+
+async def register_users(args, names):
+    c = SimClient("setup", args.framing, args.compression)
+    await c.connect(args.host, args.port)
+    for i, n in enumerate(names):
+        c.send({"action":"register","phone":f"bench-{n}","username":n,"password":"pw"})
+    for _ in names:
+        await c.responses.get()
+    await c.close()
+
+async def wait_received(clients, expected, timeout):
+    deadline = time.perf_counter() + timeout
+    while sum(c.received for c in clients) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    return sum(c.received for c in clients)
+
+async def scenario_login_storm(args, names):
+    clients = await connect_all(args, names)
+    lat = []
+
+    async def one(c):
+        start = time.perf_counter()
+        resp = await c.login()
+        lat.append(time.perf_counter() - start)
+        return resp.get("status") == "success"
+    start = time.perf_counter()
+    ok = await asyncio.gather(*(one(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    result = {"logins": sum(ok), "logins_per_s": round(sum(ok) / elapsed, 1),
+              "login_latency": latency_summary(lat)}
+    return clients, result
+
+async def scenario_steady_chat(args, names):
+    clients = await connect_all(args, names)
+    await asyncio.gather(*(c.login() for c in clients))
+    await asyncio.sleep(0.5)
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    rnd = random.Random(1)
+
+    async def sender(c):
+        for _ in range(args.messages):
+            peer = names[rnd.randrange(len(names))]
+            if peer == c.name:
+                peer = names[(names.index(peer) + 1) % len(names)]
+            c.send({"action":"send_message","from":c.name,"to":peer,
+                    "message":f"{time.perf_counter()!r} {args.payload}"})
+            if interval:
+                await asyncio.sleep(interval)
+            else:
+                await c.writer.drain()
+    start = time.perf_counter()
+    await asyncio.gather(*(sender(c) for c in clients))
+    expected = len(clients) * args.messages
+    got = await wait_received(clients, expected, args.timeout)
+    elapsed = time.perf_counter() - start
+    lat = [x for c in clients for x in c.latencies]
+    return clients, {"sent": expected, "received": got, "msgs_per_s": round(got / elapsed, 1),
+                     "latency": latency_summary(lat)}
+
+async def scenario_backlog_drain(args, names):
+    # half the users send to the other half while those are offline
+    half = max(1, len(names) // 2)
+    senders, receivers = names[:half], names[half:] or names[:1]
+    clients = await connect_all(args, senders)
+    await asyncio.gather(*(c.login() for c in clients))
+    for i, c in enumerate(clients):
+        for j in range(args.messages):
+            c.send({"action":"send_message","from":c.name,"to":receivers[(i + j) % len(receivers)],
+                    "message":f"{time.perf_counter()!r} {args.payload}"})
+    for c in clients:
+        for _ in range(args.messages):
+            await c.responses.get()
+    stored = len(clients) * args.messages
+    readers = await connect_all(args, receivers)
+    start = time.perf_counter()
+    await asyncio.gather(*(r.login() for r in readers))
+    got = await wait_received(readers, stored, args.timeout)
+    elapsed = time.perf_counter() - start
+    return clients + readers, {"stored": stored, "drained": got, "drain_s": round(elapsed, 3),
+                               "drain_msgs_per_s": round(got / elapsed, 1)}
+
+async def scenario_pipelined_send(args, names):
+    # half the users send --messages each to the other half: waiting for
+    # every ack before the next send, with up to --window in flight, and
+    # --window at a time in send_batch frames
+    half = max(1, len(names) // 2)
+    clients = await connect_all(args, names)
+    await asyncio.gather(*(c.login() for c in clients))
+    senders, receivers = clients[:half], clients[half:] or clients[:1]
+    result = {}
+    for mode in ("lockstep", "pipelined", "batched"):
+        window = 1 if mode == "lockstep" else max(1, args.window)
+        acks = []
+
+        async def batch_sender(i, c):
+            ok = 0
+            for first in range(0, args.messages, window):
+                items = [{"to":receivers[(i + j) % len(receivers)].name,
+                          "message":f"{time.perf_counter()!r} {args.payload}"}
+                         for j in range(first, min(args.messages, first + window))]
+                start = time.perf_counter()
+                resp = await c.request({"action":"send_batch","from":c.name,"items":items})
+                acks.append(time.perf_counter() - start)
+                ok += resp.get("states", "").count("d") + resp.get("states", "").count("s")
+            return ok
+
+        async def sender(i, c):
+            sem = asyncio.Semaphore(window)
+
+            async def one(j):
+                start = time.perf_counter()
+                resp = await c.request({"action":"send_message","from":c.name,
+                                        "to":receivers[(i + j) % len(receivers)].name,
+                                        "message":f"{time.perf_counter()!r} {args.payload}"})
+                acks.append(time.perf_counter() - start)
+                sem.release()
+                return resp.get("status") == "success"
+            tasks = []
+            for j in range(args.messages):
+                await sem.acquire()
+                tasks.append(asyncio.get_running_loop().create_task(one(j)))
+            return sum(await asyncio.gather(*tasks))
+        start = time.perf_counter()
+        run = batch_sender if mode == "batched" else sender
+        ok = sum(await asyncio.gather(*(run(i, c) for i, c in enumerate(senders))))
+        elapsed = time.perf_counter() - start
+        result[mode] = {"window": window, "acked": ok, "acks_per_s": round(ok / elapsed, 1),
+                        "ack_latency": latency_summary(acks)}
+    return clients, result
+
+async def scenario_presence_churn(args, names):
+    clients = await connect_all(args, names)
+    await asyncio.gather(*(c.login() for c in clients))
+    await asyncio.sleep(0.5)
+    for c in clients:
+        c.presence_frames = 0
+        c.bytes_in = 0
+    churners = clients[:max(1, len(clients) // 10)]
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        await asyncio.gather(*(c.close(logout=True) for c in churners))
+        fresh = await connect_all(args, [c.name for c in churners])
+        await asyncio.gather(*(c.login() for c in fresh))
+        clients = [c for c in clients if c not in churners] + fresh
+        churners = fresh
+    await asyncio.sleep(0.5)
+    elapsed = time.perf_counter() - start
+    watchers = clients[:-len(churners)] or clients
+    cycles = args.messages * len(churners)
+    return clients, {"churn_cycles": cycles, "cycles_per_s": round(cycles / elapsed, 1),
+                     "presence_frames_per_client": round(sum(c.presence_frames for c in watchers) / len(watchers), 1),
+                     "presence_bytes_per_client": round(sum(c.bytes_in for c in watchers) / len(watchers), 1)}
+
+async def scenario_login_load(args, names):
+    # half the users chat at --rate; the other half keep logging in again and
+    # again, first after a quiet phase, to show what password hashing costs
+    half = max(1, len(names) // 2)
+    chatters = await connect_all(args, names[:half])
+    await asyncio.gather(*(c.login() for c in chatters))
+    await asyncio.sleep(0.5)
+    churn_names = names[half:] or names[:1]
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    rnd = random.Random(1)
+
+    async def chat_phase():
+        for c in chatters:
+            c.latencies = []
+        async def sender(c):
+            for _ in range(args.messages):
+                peer = chatters[rnd.randrange(len(chatters))].name
+                c.send({"action":"send_message","from":c.name,"to":peer,
+                        "message":f"{time.perf_counter()!r} {args.payload}"})
+                if interval:
+                    await asyncio.sleep(interval)
+                else:
+                    await c.writer.drain()
+        await asyncio.gather(*(sender(c) for c in chatters))
+        await asyncio.sleep(0.2)
+        return [x for c in chatters for x in c.latencies]
+
+    quiet = await chat_phase()
+    stop = asyncio.Event()
+    login_lat, failed = [], []
+
+    async def relogin(name):
+        while not stop.is_set():
+            c = SimClient(name, args.framing, args.compression)
+            await c.connect(args.host, args.port)
+            start = time.perf_counter()
+            resp = await c.login()
+            if resp.get("status") == "success":
+                login_lat.append(time.perf_counter() - start)
+            else:
+                failed.append(resp.get("message"))
+            await c.close()
+    start = time.perf_counter()
+    storm = [asyncio.get_running_loop().create_task(relogin(n)) for n in churn_names]
+    loaded = await chat_phase()
+    stop.set()
+    await asyncio.gather(*storm)
+    elapsed = time.perf_counter() - start
+    return chatters, {"logins": len(login_lat), "logins_per_s": round(len(login_lat) / elapsed, 1),
+                      "login_failures": len(failed), "login_latency": latency_summary(login_lat),
+                      "send_latency_quiet": latency_summary(quiet),
+                      "send_latency_during_logins": latency_summary(loaded)}
+
+async def scenario_reconnect_storm(args, names):
+    # a network blip drops every connection but one at once; everyone comes
+    # back first with a full login, then (after another blip) with resume
+    clients = await connect_all(args, names)
+    await asyncio.gather(*(c.login() for c in clients))
+    watcher, clients = clients[0], clients[1:]
+    result = {}
+    for mode in ("login", "resume"):
+        tokens = {c.name: c.token for c in clients}
+        await asyncio.gather(*(c.close() for c in clients))
+        await asyncio.sleep(0.2)
+        watcher.presence_frames = 0
+        clients = await connect_all(args, [c.name for c in clients])
+        lat = []
+
+        async def one(c):
+            start = time.perf_counter()
+            resp = await (c.login() if mode == "login" else c.resume(tokens[c.name]))
+            lat.append(time.perf_counter() - start)
+            return resp.get("status") == "success"
+        start = time.perf_counter()
+        ok = await asyncio.gather(*(one(c) for c in clients))
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.5)
+        result[mode] = {"ok": sum(ok), "per_s": round(sum(ok) / elapsed, 1), "latency": latency_summary(lat),
+                        "presence_frames_seen": watcher.presence_frames}
+    return clients + [watcher], result
+
+async def scenario_room_fanout(args, names):
+    # everyone joins one room; a few members post, every post reaches all
+    clients = await connect_all(args, names)
+    await asyncio.gather(*(c.login() for c in clients))
+    await clients[0].request({"action":"create_room","room":f"{args.prefix}room"})
+    await asyncio.gather(*(c.request({"action":"join_room","room":f"{args.prefix}room"}) for c in clients[1:]))
+    await asyncio.sleep(0.5)
+    posters = clients[:max(1, len(clients) // 100)]
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+
+    async def poster(c):
+        for _ in range(args.messages):
+            c.send({"action":"room_post","room":f"{args.prefix}room",
+                    "message":f"{time.perf_counter()!r} {args.payload}"})
+            if interval:
+                await asyncio.sleep(interval)
+            else:
+                await c.writer.drain()
+    start = time.perf_counter()
+    await asyncio.gather(*(poster(c) for c in posters))
+    posts = len(posters) * args.messages
+    expected = posts * (len(clients) - 1)
+    got = await wait_received(clients, expected, args.timeout)
+    elapsed = time.perf_counter() - start
+    lat = [x for c in clients for x in c.latencies]
+    return clients, {"members": len(clients), "posts": posts, "expected": expected, "received": got,
+                     "deliveries_per_s": round(got / elapsed, 1), "latency": latency_summary(lat)}
+
+SCENARIOS = {
+    "login_storm": scenario_login_storm,
+    "steady_chat": scenario_steady_chat,
+    "backlog_drain": scenario_backlog_drain,
+    "presence_churn": scenario_presence_churn,
+    "pipelined_send": scenario_pipelined_send,
+    "login_load": scenario_login_load,
+    "reconnect_storm": scenario_reconnect_storm,
+    "room_fanout": scenario_room_fanout,
+}
+
+async def run_load(args, server_pid):
+    names = [f"{args.prefix}{i}" for i in range(args.clients)]
+    await register_users(args, names)
+    rss_before = process_rss_kb(server_pid)
+    cpu_before = process_cpu_s(server_pid)
+    client_cpu = time.process_time()
+    start = time.perf_counter()
+    clients, result = await SCENARIOS[args.scenario](args, names)
+    result["wall_s"] = round(time.perf_counter() - start, 3)
+    # bandwidth against CPU: what compression saves on the wire and what it costs at both ends
+    cpu_after = process_cpu_s(server_pid)
+    result["server_cpu_s"] = None if cpu_before is None or cpu_after is None else round(cpu_after - cpu_before, 3)
+    result["client_cpu_s"] = round(time.process_time() - client_cpu, 3)
+    result["bytes_in"] = sum(c.bytes_in for c in clients)
+    result["connect"] = latency_summary([c.connect_time for c in clients if c.connect_time is not None])
+    result["server_rss_kb"] = {"before": rss_before, "after": process_rss_kb(server_pid)}
+    result["throttled"] = sum(c.throttled for c in clients)
+    await asyncio.gather(*(c.close() for c in clients))
+    return result
+
+def bench_load(args):
+    server = None
+    server_pid = args.server_pid
+    workdir = None
+    if args.spawn is not None:
+        workdir = tempfile.mkdtemp(prefix="chatbench-")
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server01.py"),
+               "--host", args.host, "--port", str(args.port), "--db", os.path.join(workdir, "bench.db"),
+               "--no-rate-limits"]
+        server = subprocess.Popen(cmd + args.spawn.split(), stdout=subprocess.DEVNULL)
+        server_pid = server.pid
+        wait_for_port(args.host, args.port)
+    try:
+        result = asyncio.run(run_load(args, server_pid))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait(30)
+    return {"suite": "load", "scenario": args.scenario,
+            "params": {"clients": args.clients, "messages": args.messages, "rate": args.rate, "window": args.window,
+                       "payload_bytes": len(args.payload), "framing": args.framing,
+                       "compression": args.compression,
+                       "server_args": args.spawn},
+            "results": result}
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"server did not start on {host}:{port}")
+
+# ---------- Entry point ----------
+def parse_args():
+    p = argparse.ArgumentParser(description="Chat server benchmarks")
+    sub = p.add_subparsers(dest="suite", required=True)
+    d = sub.add_parser("db", help="login / offline-store throughput of the DB helpers")
+    d.add_argument("--users", type=int, default=1000)
+    d.add_argument("--threads", type=int, default=16)
+    d.add_argument("--ops", type=int, default=500, help="operations per thread")
+    d.add_argument("--history-rows", type=int, default=200000, help="messages in the history paging test")
+    d.add_argument("--out", help="also write the JSON result to this file")
+
+    l = sub.add_parser("load", help="simulated clients against a running (or spawned) server")
+    l.add_argument("scenario", choices=sorted(SCENARIOS))
+    l.add_argument("--host", default="127.0.0.1")
+    l.add_argument("--port", type=int, default=5000)
+    l.add_argument("--clients", type=int, default=500)
+    l.add_argument("--messages", type=int, default=20,
+                   help="messages per client (churn: login/logout rounds)")
+    l.add_argument("--rate", type=float, default=10.0, help="messages per second per client, 0 = flat out")
+    l.add_argument("--payload", default="x" * 64, help="message text appended after the timestamp")
+    l.add_argument("--framing", choices=(LINES, FRAMES), default=LINES)
+    l.add_argument("--compression", action="store_true",
+                   help="offer deflate in the hello (needs --framing frames)")
+    l.add_argument("--window", type=int, default=64,
+                   help="pipelined_send: requests in flight per client, and items per send_batch")
+    l.add_argument("--prefix", default="bench", help="username prefix")
+    l.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for deliveries")
+    l.add_argument("--server-pid", type=int, help="pid of a running server, for RSS")
+    l.add_argument("--spawn", metavar="ARGS", nargs="?", const="",
+                   help="start a throwaway server01.py on --port with these extra arguments "
+                        "(rate limits off; a running server needs --no-rate-limits for flat-out scenarios)")
+    l.add_argument("--out", help="also write the JSON result to this file")
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.suite == "db":
+        result = bench_db(args)
+    else:
+        result = bench_load(args)
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
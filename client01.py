@@ -1,56 +1,284 @@
 # client.py
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, simpledialog
+import queue
+import random
 import socket
 import threading
-import json
+import time
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime
+from itertools import count
+
+from framing01 import Framing
 
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 5000
+RECONNECT_MIN = 0.5    # seconds before the first reconnect attempt
+RECONNECT_MAX = 30.0   # backoff ceiling
+UI_FRAME_MS = 30           # incoming messages are drawn at most this often
+UI_BATCH = 2000            # messages drawn per frame; a bigger burst spills into the next ones
+CONVERSATION_LINES = 500   # lines kept per conversation, and shown while following the newest
+SCROLLBACK_LINES = 5000    # ...while scrolled back through older history
+HISTORY_RETRY = 5.0        # seconds before an unanswered history request may be repeated
+HEARTBEAT_SECS = 20.0      # ping the server after this long without hearing from it
+SERVER_DEAD_SECS = 50.0    # ...and give the connection up (and resume) after this long
+REQUEST_TIMEOUT = 15.0     # seconds a request waits for the reply carrying its rid
+MAX_IN_FLIGHT = 256        # ChatConnection: requests sent and not yet answered
+READ_TICK = 0.5            # ChatConnection: how often its reader checks for timed-out requests
+COMPRESSION = True         # offer deflate for large frames (backlogs, rosters, history) in the hello
 
 COUNTRY_CODES = [
     "+94 Sri Lanka", "+91 India", "+1 United States", "+44 United Kingdom", "+61 Australia",
     "+93 Afghanistan", "+213 Algeria", "+880 Bangladesh", "+86 China", "+81 Japan"
 ]
 
-def send_json(sock, obj):
-    raw = json.dumps(obj, ensure_ascii=False) + "\n"
-    sock.sendall(raw.encode("utf-8"))
-
-def recv_jsons(sock, buffer):
-    try:
-        data = sock.recv(4096)
-        if not data:
-            return None, buffer
-        buffer += data.decode("utf-8", errors="ignore")
-        msgs = []
-        while "\n" in buffer:
-            idx = buffer.index("\n")
-            raw = buffer[:idx].strip()
-            buffer = buffer[idx+1:]
-            if not raw:
+def send_json(sock, framing, obj):
+    sock.sendall(framing.encode(obj))
+
+def recv_single(sock, framing):
+    while True:
+        for msg in framing.messages():
+            if msg.get("action") in ("ping", "pong"):
+                continue   # heartbeats; the request itself shows we are alive
+            return msg
+        if not framing.recv_into(sock):
+            return None
+
+def recv_reply(sock, framing, rid, timeout=REQUEST_TIMEOUT):
+    """Read until the reply to request rid; None if the server hung up.
+    Anything else that arrives first is skipped, since nothing else has
+    been asked for yet."""
+    deadline = time.monotonic() + timeout
+    while True:
+        for msg in framing.messages():
+            if msg.get("rid") == rid or ("rid" not in msg and "status" in msg):
+                # the second case: a server too old to echo request ids
+                return msg
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TimeoutError("no reply from the server")
+        previous = sock.gettimeout()
+        sock.settimeout(left)
+        try:
+            n = framing.recv_into(sock)
+        except socket.timeout:
+            raise TimeoutError("no reply from the server") from None
+        finally:
+            sock.settimeout(previous)
+        if not n:
+            return None
+
+
+class PendingRequests:
+    """Requests sent with a client-chosen "rid", each waiting on a Future.
+
+    The server echoes the rid in its reply, so any number can be in flight
+    and replies are matched whatever order they come back in. A Future gets
+    the reply (errors included), TimeoutError once its deadline passes, or
+    the connection error when the link drops.
+    """
+
+    def __init__(self):
+        self._ids = count(1)
+        self._waiting = {}   # rid -> (future, deadline)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def new_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def tag(self, obj, timeout=REQUEST_TIMEOUT):
+        """obj with a fresh rid, and the Future for its reply."""
+        fut = Future()
+        with self._lock:
+            rid = next(self._ids)
+            self._waiting[rid] = (fut, time.monotonic() + timeout)
+        return dict(obj, rid=rid), fut
+
+    def resolve(self, msg):
+        """Complete the request msg answers; False if it answers none."""
+        rid = msg.get("rid")
+        if rid is None:
+            return False
+        with self._lock:
+            entry = self._waiting.pop(rid, None)
+        if entry is None:
+            return False
+        entry[0].set_result(msg)
+        return True
+
+    def fail(self, rid, exc):
+        with self._lock:
+            entry = self._waiting.pop(rid, None)
+        if entry is not None:
+            entry[0].set_exception(exc)
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            late = [rid for rid, (_, deadline) in self._waiting.items() if deadline <= now]
+            futures = [self._waiting.pop(rid)[0] for rid in late]
+        for fut in futures:
+            fut.set_exception(TimeoutError("no reply from the server"))
+
+    def fail_all(self, exc):
+        with self._lock:
+            futures = [fut for fut, _ in self._waiting.values()]
+            self._waiting.clear()
+        for fut in futures:
+            fut.set_exception(exc)
+
+
+class ChatConnection:
+    """Headless, pipelined connection for scripts and bulk senders.
+
+    request() sends at once and returns a Future for the reply, so a sender
+    keeps up to max_in_flight requests on the wire instead of waiting a
+    round trip for each; past that it blocks until replies come back.
+    Frames that answer no request (messages, presence) go to on_push, called
+    on the reader thread. Heartbeat pings are answered there too.
+
+        conn = ChatConnection()
+        conn.call({"action":"login","identifier":"alice","password":"pw"})
+        acks = [conn.request({"action":"send_message","from":"alice","to":"bob","message":m})
+                for m in lines]
+        states = [f.result().get("state") for f in acks]
+    """
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, on_push=None,
+                 max_in_flight=MAX_IN_FLIGHT, timeout=REQUEST_TIMEOUT):
+        self.on_push = on_push
+        self.timeout = timeout
+        self.pending = PendingRequests()
+        self.sock = socket.create_connection((host, port))
+        self.framing = Framing()
+        send_json(self.sock, self.framing, self.framing.client_hello(compression=COMPRESSION))
+        resp = recv_single(self.sock, self.framing)
+        if resp and resp.get("action") == "hello":
+            self.framing.switch(resp)
+        self.sock.settimeout(READ_TICK)
+        self.closed = False
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, name="chat-reader", daemon=True)
+        self._reader.start()
+
+    def send(self, obj):
+        """Fire and forget: no rid, so no reply is waited for."""
+        with self._send_lock:
+            send_json(self.sock, self.framing, obj)
+
+    def request(self, obj, timeout=None):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        self._window.acquire()
+        obj, fut = self.pending.tag(obj, self.timeout if timeout is None else timeout)
+        fut.add_done_callback(lambda _: self._window.release())
+        try:
+            self.send(obj)
+        except OSError as e:
+            self.pending.fail(obj["rid"], e)
+        return fut
+
+    def call(self, obj, timeout=None):
+        """request() and wait for the reply."""
+        return self.request(obj, timeout).result()
+
+    def send_batch(self, sender, pairs, timeout=None):
+        """Many (recipient, message) pairs in one send_batch frame; the
+        reply's "states" has a letter per pair: d delivered, s stored,
+        e rejected."""
+        items = [{"to":to,"message":message} for to, message in pairs]
+        return self.request({"action":"send_batch","from":sender,"items":items}, timeout)
+
+    def _read(self):
+        error = ConnectionError("connection closed")
+        try:
+            while True:
+                for msg in self.framing.messages():
+                    if self.pending.resolve(msg):
+                        continue
+                    action = msg.get("action")
+                    if action == "ping":
+                        self.send({"action":"pong"})
+                    elif action != "pong" and self.on_push is not None:
+                        self.on_push(msg)
+                try:
+                    n = self.framing.recv_into(self.sock)
+                except socket.timeout:
+                    n = None
+                if n == 0:
+                    break
+                self.pending.expire()
+        except OSError as e:
+            error = e
+        finally:
+            self.closed = True
+            self.pending.fail_all(error)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._reader.join()
+
+class Conversation:
+    """What the client holds of one chat (a peer, or "#room"): the newest
+    lines, oldest first, and whether older ones are left on the server."""
+
+    def __init__(self):
+        self.lines = deque()    # (id, sender, text, when)
+        self.ids = set()
+        self.complete = False   # the server has nothing older
+        self.requested = 0.0    # when the pending history request went out
+        self.unread = 0
+
+    def oldest_id(self):
+        return min((e[0] for e in self.lines if e[0] is not None), default=None)
+
+    def append(self, entries):
+        fresh = [e for e in entries if e[0] is None or e[0] not in self.ids]
+        self.lines.extend(fresh)
+        self.ids.update(e[0] for e in fresh if e[0] is not None)
+        return fresh
+
+    def prepend(self, entries, me):
+        # our own lines were shown when sent, before the server gave them an id
+        unsent = {}
+        for e in self.lines:
+            if e[0] is None and e[1] == me:
+                unsent[e[2]] = unsent.get(e[2], 0) + 1
+        fresh = []
+        for e in entries:
+            if e[0] in self.ids:
                 continue
-            try:
-                msgs.append(json.loads(raw))
-            except:
+            if e[1] == me and unsent.get(e[2]):
+                unsent[e[2]] -= 1
                 continue
-        return msgs, buffer
-    except:
-        return None, buffer
-
-def recv_single(sock):
-    data = ""
-    while "\n" not in data:
-        part = sock.recv(4096).decode("utf-8")
-        if not part:
-            return None
-        data += part
-    raw, rest = data.split("\n", 1)
-    try:
-        return json.loads(raw)
-    except:
-        return None
+            fresh.append(e)
+        self.lines.extendleft(reversed(fresh))
+        self.ids.update(e[0] for e in fresh)
+        return fresh
+
+    def trim(self, keep):
+        """Drop the oldest lines beyond keep; returns how many went."""
+        dropped = 0
+        while len(self.lines) > keep:
+            e = self.lines.popleft()
+            self.ids.discard(e[0])
+            dropped += 1
+        if dropped:
+            self.complete = False
+        return dropped
+
 
 class ChatClientGUI:
     def __init__(self, root):
@@ -60,12 +288,26 @@ class ChatClientGUI:
         root.configure(bg="#071226")
 
         self.sock = None
-        self.buffer = ""
+        self.framing = None
+        self.send_lock = threading.Lock()
+        self.pending = PendingRequests()   # sends waiting for their ack
         self.username = None
+        self.token = None      # resumes the session after a dropped connection
+        self.last_id = 0       # newest stored message id received
         self.running = False
+        self.online_users = set()
+        self.rooms = []        # joined rooms, shown as "#name" recipients
+        self.room_last = {}    # room -> newest post id shown
+        self.presence_version = None
+        self.conversations = {}   # peer or "#room" -> Conversation
+        self.current = None       # conversation in the chat view
+        self.chat_text = None
+        # the listen thread never touches widgets: it queues events, drawn in batches by _pump
+        self.ui_events = queue.SimpleQueue()
 
         self.setup_style()
         self.show_main()
+        self.root.after(UI_FRAME_MS, self._pump)
 
     def setup_style(self):
         style = ttk.Style()
@@ -76,16 +318,55 @@ class ChatClientGUI:
 
     def clear(self):
         for w in self.root.winfo_children():
-            w.destroy()
+            if not isinstance(w, tk.Toplevel):
+                w.destroy()
+        self.chat_text = None
 
     def connect(self):
-        if self.sock:
+        self.disconnect()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((SERVER_HOST, SERVER_PORT))
+        # offer length-prefixed frames; servers without hello keep newline JSON
+        framing = Framing()
+        send_json(sock, framing, framing.client_hello(compression=COMPRESSION))
+        resp = recv_single(sock, framing)
+        if resp and resp.get("action") == "hello":
+            framing.switch(resp)
+        # reads wake up at least this often, so listen_server can check on the server
+        sock.settimeout(HEARTBEAT_SECS)
+        with self.send_lock:
+            self.sock, self.framing = sock, framing
+
+    def ensure_connected(self):
+        # register and login attempts share one connection
+        if self.sock is None:
+            self.connect()
+
+    def disconnect(self):
+        with self.send_lock:
+            sock, self.sock = self.sock, None
+        if sock:
             try:
-                self.sock.close()
+                sock.close()
             except:
                 pass
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((SERVER_HOST, SERVER_PORT))
+
+    def send(self, obj):
+        with self.send_lock:
+            send_json(self.sock, self.framing, obj)
+
+    def request(self, obj):
+        """Send obj with a rid; the Future completes when the listen thread
+        sees the reply."""
+        obj, fut = self.pending.tag(obj)
+        self.send(obj)
+        return fut
+
+    def call(self, obj):
+        """Send obj and read its reply here; only while no listen thread runs."""
+        rid = self.pending.new_id()
+        self.send(dict(obj, rid=rid))
+        return recv_reply(self.sock, self.framing, rid)
 
     # ---------- Main ----------
     def show_main(self):
@@ -136,23 +417,18 @@ class ChatClientGUI:
             messagebox.showwarning("Missing", "Please fill all fields")
             return
         try:
-            self.connect()
-            send_json(self.sock, {"action":"register","country":country,"phone":phone,"username":username,"password":password})
-            resp = recv_single(self.sock)
-            if resp and resp.get("status")=="success":
+            self.ensure_connected()
+            resp = self.call({"action":"register","country":country,"phone":phone,"username":username,
+                              "password":password})
+            if resp is None:
+                raise ConnectionError("Server closed the connection")
+            if resp.get("status")=="success":
                 messagebox.showinfo("Success", resp.get("message","Registered"))
-                try:
-                    self.sock.close()
-                except:
-                    pass
                 self.show_login()
             else:
                 messagebox.showerror("Error", resp.get("message","Registration failed"))
-                try:
-                    self.sock.close()
-                except:
-                    pass
         except Exception as e:
+            self.disconnect()
             messagebox.showerror("Network", str(e))
 
     # ---------- Login ----------
@@ -183,21 +459,24 @@ class ChatClientGUI:
             messagebox.showwarning("Missing", "Enter credentials")
             return
         try:
-            self.connect()
-            send_json(self.sock, {"action":"login","identifier":identifier,"password":password})
-            resp = recv_single(self.sock)
-            if resp and resp.get("status")=="success":
+            self.ensure_connected()
+            resp = self.call({"action":"login","identifier":identifier,"password":password,
+                              "batch":True,"deltas":True})
+            if resp is None:
+                raise ConnectionError("Server closed the connection")
+            if resp.get("status")=="success":
                 self.username = resp.get("username")
+                self.token = resp.get("token")
+                self.last_id = 0
+                self.rooms = resp.get("rooms", [])
+                self.room_last = {}
                 self.running = True
                 threading.Thread(target=self.listen_server, daemon=True).start()
                 self.show_chat()
             else:
                 messagebox.showerror("Login Failed", resp.get("message","Invalid"))
-                try:
-                    self.sock.close()
-                except:
-                    pass
         except Exception as e:
+            self.disconnect()
             messagebox.showerror("Network", str(e))
 
     # ---------- Chat ----------
@@ -216,14 +495,26 @@ class ChatClientGUI:
         self.recipient_var = tk.StringVar()
         self.recipient_combo = ttk.Combobox(left, textvariable=self.recipient_var, state="readonly", width=28)
         self.recipient_combo.pack(padx=8, pady=8)
+        self.recipient_combo.bind("<<ComboboxSelected>>", lambda e: self.open_conversation(self.recipient_var.get()))
+        self.unread_var = tk.StringVar()
+        tk.Label(left, textvariable=self.unread_var, bg="#0b2940", fg="#f5c26b", wraplength=220, justify="left").pack(padx=8)
         ttk.Button(left, text="Refresh", command=self.request_online).pack(padx=8, pady=6)
+        ttk.Button(left, text="Join Room", command=self.join_room).pack(padx=8, pady=6)
+        ttk.Button(left, text="Leave Room", command=self.leave_room).pack(padx=8, pady=6)
+        ttk.Button(left, text="Search", command=self.search).pack(padx=8, pady=6)
         ttk.Button(left, text="Logout", command=self.do_logout).pack(padx=8, pady=6)
 
         right = tk.Frame(main, bg="#04121a")
         right.pack(side="right", fill="both", expand=True)
-        self.chat_text = tk.Text(right, bg="#071022", fg="white", font=("Segoe UI", 11), wrap="word")
+        vsb = ttk.Scrollbar(right, orient="vertical")
+        vsb.pack(side="right", fill="y", pady=8)
+        self.chat_scroll = vsb
+        # one logical line per message; spacing1 stands in for the old blank lines
+        self.chat_text = tk.Text(right, bg="#071022", fg="white", font=("Segoe UI", 11), wrap="word",
+                                 spacing1=8, yscrollcommand=self._on_scroll)
         self.chat_text.pack(fill="both", expand=True, padx=8, pady=8)
         self.chat_text.config(state="disabled")
+        vsb.config(command=self.chat_text.yview)
 
         bottom = tk.Frame(self.root, bg="#06121a")
         bottom.pack(fill="x", pady=8)
@@ -235,10 +526,14 @@ class ChatClientGUI:
 
         # initial request for online users
         self.request_online()
+        self._refresh_roster()
+        if self.current is not None:
+            key, self.current = self.current, None
+            self.open_conversation(key)
 
     def request_online(self):
         try:
-            send_json(self.sock, {"action":"get_online_users"})
+            self.send({"action":"get_online_users"})
         except:
             pass
 
@@ -252,84 +547,378 @@ class ChatClientGUI:
             return
         ts = datetime.now().strftime("%I:%M %p")
         try:
-            send_json(self.sock, {"action":"send_message","from":self.username,"to":recipient,"message":text,"timestamp":ts})
+            if recipient.startswith("#"):
+                fut = self.request({"action":"room_post","room":recipient[1:],"message":text,"timestamp":ts})
+            else:
+                fut = self.request({"action":"send_message","from":self.username,"to":recipient,
+                                    "message":text,"timestamp":ts})
+            fut.add_done_callback(lambda f: self._confirm(recipient, f))
             # locally display sent message
-            self.display_message(self.username, text, ts)
+            self.add_lines(recipient, [(None, self.username, text, ts)])
+            self.chat_text.see("end")
             self.msg_var.set("")
         except Exception as e:
             messagebox.showerror("Send failed", str(e))
 
-    def display_message(self, sender, text, timestamp):
+    def _confirm(self, key, fut):
+        # on the listen thread: only a refused or unanswered send is shown
+        try:
+            resp = fut.result()
+        except Exception as e:
+            # timed out, or the connection dropped before the ack
+            label, problem = "Unconfirmed", str(e) or "no reply"
+        else:
+            if resp.get("status") == "success":
+                return
+            label, problem = "Not sent", resp.get("message", "refused")
+        self.post_ui("lines", key, [(None, label, problem, datetime.now().strftime("%I:%M %p"))])
+
+    def join_room(self):
+        name = simpledialog.askstring("Join Room", "Room name (created if it does not exist):", parent=self.root)
+        if name and name.strip():
+            try:
+                self.send({"action":"join_room","room":name.strip(),"create":True})
+            except Exception as e:
+                messagebox.showerror("Join failed", str(e))
+
+    def leave_room(self):
+        recipient = self.recipient_var.get()
+        if not recipient.startswith("#"):
+            messagebox.showwarning("Select room", "Select a #room from the dropdown first")
+            return
+        try:
+            self.send({"action":"leave_room","room":recipient[1:]})
+        except Exception as e:
+            messagebox.showerror("Leave failed", str(e))
+
+    def search(self):
+        query = simpledialog.askstring("Search", "Search your messages for:", parent=self.root)
+        if not (query and query.strip()):
+            return
+        req = {"action":"search","query":query.strip()}
+        recipient = self.recipient_var.get()
+        if recipient.startswith("#"):
+            req["room"] = recipient[1:]
+        try:
+            self.send(req)
+        except Exception as e:
+            messagebox.showerror("Search failed", str(e))
+
+    def show_search(self, msg):
+        win = tk.Toplevel(self.root, bg="#071226")
+        where = f" in #{msg['room']}" if msg.get("room") else ""
+        win.title(f"Search: {msg.get('query')}{where}")
+        text = tk.Text(win, bg="#071022", fg="white", font=("Segoe UI", 11), wrap="word", spacing1=8,
+                       width=80, height=20)
+        text.pack(fill="both", expand=True, padx=8, pady=8)
+        lines = [self.format_line(self.history_entry(m), m.get("to")) for m in msg.get("messages", [])]
+        text.insert("end", "".join(lines) or "(no matches)\n")
+        text.config(state="disabled")
+
+    # ---------- Conversations ----------
+    def conversation(self, key):
+        conv = self.conversations.get(key)
+        if conv is None:
+            conv = self.conversations[key] = Conversation()
+        return conv
+
+    def history_entry(self, m):
+        sent_at = m.get("sent_at")
+        when = datetime.fromtimestamp(sent_at).strftime("%d %b %I:%M %p") if sent_at else m.get("timestamp", "")
+        return (m.get("id"), m.get("from"), m.get("message"), when)
+
+    def format_line(self, entry, to=None):
+        _, sender, text, when = entry
+        who = "You" if sender == self.username else sender
+        if to is not None and sender == self.username:
+            who = f"You → {to}"
+        # one logical line per message keeps trimming a matter of line numbers
+        return f"{who} ({when}): {str(text).replace(chr(10), ' ')}\n"
+
+    def at_bottom(self):
+        return self.chat_text.yview()[1] >= 1.0
+
+    def add_lines(self, key, entries):
+        conv = self.conversation(key)
+        fresh = conv.append(entries)
+        if not fresh:
+            return
+        if self.current is None and self.chat_text is not None:
+            self.open_conversation(key)
+            return
+        if key != self.current or self.chat_text is None:
+            conv.unread += len(fresh)
+            conv.trim(CONVERSATION_LINES)
+            return
+        following = self.at_bottom()
+        # reading older lines: keep them, up to the scrollback limit
+        dropped = conv.trim(CONVERSATION_LINES if following else SCROLLBACK_LINES)
         self.chat_text.config(state="normal")
-        if sender == self.username:
-            self.chat_text.insert("end", f"\nYou ({timestamp}): {text}\n")
+        shown = int(self.chat_text.index("end-1c").split(".")[0]) - 1
+        if dropped >= shown:
+            self.chat_text.delete("1.0", "end")
+            self.chat_text.insert("end", "".join(self.format_line(e) for e in conv.lines))
         else:
-            self.chat_text.insert("end", f"\n{sender} ({timestamp}): {text}\n")
+            self.chat_text.insert("end", "".join(self.format_line(e) for e in fresh))
+            if dropped:
+                self.chat_text.delete("1.0", f"{dropped + 1}.0")
+        self.chat_text.config(state="disabled")
+        if following:
+            self.chat_text.see("end")
+
+    def add_history(self, msg):
+        key = "#" + msg["room"] if msg.get("room") else msg.get("with")
+        conv = self.conversation(key)
+        conv.requested = 0.0
+        conv.complete = msg.get("next") is None
+        fresh = conv.prepend([self.history_entry(m) for m in msg.get("messages", [])], self.username)
+        if key != self.current or self.chat_text is None or not fresh:
+            return
+        # older lines go on top without moving what the user is looking at
+        top = int(self.chat_text.index("@0,0").split(".")[0])
+        self.chat_text.config(state="normal")
+        self.chat_text.insert("1.0", "".join(self.format_line(e) for e in fresh))
+        self.chat_text.config(state="disabled")
+        self.chat_text.yview(f"{top + len(fresh)}.0")
+
+    def open_conversation(self, key):
+        if not key or self.chat_text is None:
+            return
+        if self.current is not None and self.current != key:
+            self.conversation(self.current).trim(CONVERSATION_LINES)
+        self.current = key
+        if self.recipient_var.get() != key:
+            self.recipient_var.set(key)
+        conv = self.conversation(key)
+        conv.unread = 0
+        self.chat_text.config(state="normal")
+        self.chat_text.delete("1.0", "end")
+        self.chat_text.insert("end", "".join(self.format_line(e) for e in conv.lines))
         self.chat_text.config(state="disabled")
         self.chat_text.see("end")
+        self._refresh_roster()
 
-    def do_logout(self):
+    def _on_scroll(self, first, last):
+        self.chat_scroll.set(first, last)
+        if float(first) <= 0.0:
+            # at the top (or everything fits): fetch the page before the oldest line
+            self.load_older()
+
+    def load_older(self):
+        conv = self.conversations.get(self.current)
+        if conv is None or conv.complete or len(conv.lines) >= SCROLLBACK_LINES:
+            return
+        if time.monotonic() - conv.requested < HISTORY_RETRY:
+            return
+        req = {"action":"history","before":conv.oldest_id()}
+        if self.current.startswith("#"):
+            req["room"] = self.current[1:]
+        else:
+            req["with"] = self.current
         try:
-            if self.username:
-                send_json(self.sock, {"action":"logout","username":self.username})
+            self.send(req)
+            conv.requested = time.monotonic()
         except:
             pass
+
+    # ---------- UI event pump ----------
+    def post_ui(self, kind, *args):
+        """Called from the listen thread; drawn on the Tk thread by _pump."""
+        self.ui_events.put((kind, args))
+
+    def _pump(self):
+        # everything queued since the last frame, up to UI_BATCH messages,
+        # drawn with one insert per conversation
+        arrived = {}
+        events = []
+        roster = False
+        budget = UI_BATCH
+        while budget > 0:
+            try:
+                kind, args = self.ui_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "lines":
+                key, entries = args
+                arrived.setdefault(key, []).extend(entries)
+                budget -= len(entries)
+            elif kind == "roster":
+                roster = True
+            else:
+                events.append((kind, args))
+        try:
+            for key, entries in arrived.items():
+                self.add_lines(key, entries)
+            for kind, args in events:
+                if kind == "history":
+                    self.add_history(*args)
+                elif kind == "search":
+                    self.show_search(*args)
+            if roster or arrived:
+                self._refresh_roster()
+        except tk.TclError:
+            pass   # the chat view went away mid-frame
+        self.root.after(UI_FRAME_MS, self._pump)
+
+    def do_logout(self):
         self.running = False
         try:
-            self.sock.close()
+            if self.username:
+                self.send({"action":"logout","username":self.username})
         except:
             pass
+        self.disconnect()
         self.username = None
+        self.token = None
+        self.conversations = {}
+        self.current = None
         self.show_main()
 
     # ---------- listen thread ----------
     def listen_server(self):
-        buffer = ""
+        heard = time.monotonic()
         while self.running:
             try:
-                msgs, buffer = recv_jsons(self.sock, buffer)
-                if msgs is None:
-                    break
-                for msg in msgs:
+                for msg in self.framing.messages():
+                    # completes a pending send; the reply is still handled below
+                    self.pending.resolve(msg)
                     action = msg.get("action")
-                    if action == "update_users":
+                    if action == "ping":
+                        self.send({"action":"pong"})
+                    elif action == "update_users" or (msg.get("status") == "success" and "version" in msg):
+                        # full roster snapshot
+                        self.online_users = set(msg.get("users", []))
+                        self.presence_version = msg.get("version")
+                        self._push_roster()
+                    elif action in ("user_online", "user_offline"):
+                        version = msg.get("version")
+                        if self.presence_version is not None and version is not None:
+                            if version <= self.presence_version:
+                                continue
+                            if version != self.presence_version + 1:
+                                # missed an update: resync from a snapshot
+                                self.request_online()
+                                continue
                         users = msg.get("users", [])
-                        others = [u for u in users if u != self.username]
-                        # update combobox values on main thread
-                        self.root.after(0, lambda vals=others: self._update_recipient_combo(vals))
-                    elif action == "receive_message":
-                        sender = msg.get("from")
-                        text = msg.get("message")
-                        ts = msg.get("timestamp", datetime.now().strftime("%I:%M %p"))
-                        # ensure UI update on main thread
-                        self.root.after(0, lambda s=sender, t=text, tm=ts: self.display_message(s, t, tm))
+                        if action == "user_online":
+                            self.online_users.update(users)
+                        else:
+                            self.online_users.difference_update(users)
+                        self.presence_version = version
+                        self._push_roster()
+                    elif action in ("receive_message", "receive_messages"):
+                        # stored backlog arrives in pages
+                        by_sender = {}
+                        for m in (msg.get("messages", []) if action == "receive_messages" else [msg]):
+                            self._seen(m)
+                            ts = m.get("timestamp") or datetime.now().strftime("%I:%M %p")
+                            by_sender.setdefault(m.get("from"), []).append(
+                                (m.get("id"), m.get("from"), m.get("message"), ts))
+                        for sender, entries in by_sender.items():
+                            self.post_ui("lines", sender, entries)
+                    elif action in ("room_message", "room_messages"):
+                        room = msg.get("room")
+                        posts = msg.get("messages", []) if action == "room_messages" else [msg]
+                        # a replay after reconnecting may repeat posts already shown
+                        posts = [m for m in posts if m.get("id", 0) > self.room_last.get(room, 0)]
+                        if posts:
+                            self.room_last[room] = posts[-1].get("id", 0)
+                            self.post_ui("lines", "#" + room, [(m.get("id"), m.get("from"), m.get("message"),
+                                                                m.get("timestamp", "")) for m in posts])
+                    elif action in ("history", "search"):
+                        self.post_ui(action, msg)
+                    elif msg.get("status") == "success" and "rooms" in msg:
+                        # joined or left a room
+                        self.rooms = msg.get("rooms", [])
+                        self._push_roster()
                     else:
                         pass
-            except Exception:
-                break
-        self.running = False
-        try:
-            self.sock.close()
-        except:
-            pass
+                try:
+                    n = self.framing.recv_into(self.sock)
+                except socket.timeout:
+                    # a quiet line: dead servers and half-open sockets send nothing either
+                    if time.monotonic() - heard > SERVER_DEAD_SECS:
+                        raise ConnectionError("server stopped answering")
+                    self.send({"action":"ping"})
+                    self.pending.expire()
+                    continue
+                if not n:
+                    raise ConnectionError("connection closed")
+                heard = time.monotonic()
+                self.pending.expire(heard)
+            except Exception as e:
+                self.pending.fail_all(e if isinstance(e, OSError) else ConnectionError("connection lost"))
+                if not (self.running and self.reconnect()):
+                    break
+                heard = time.monotonic()
+        if self.running:
+            # the session could not be resumed
+            self.running = False
+            self.root.after(0, self.session_lost)
+        self.disconnect()
+
+    def _seen(self, msg):
+        mid = msg.get("id")
+        if isinstance(mid, int) and mid > self.last_id:
+            self.last_id = mid
+
+    def reconnect(self):
+        """Open a new connection and resume the session, backing off between
+        attempts. Returns False if the server no longer accepts the token."""
+        if not self.token:
+            return False
+        self.root.after(0, lambda: self.root.title("Secure Chat App - reconnecting..."))
+        delay = RECONNECT_MIN
+        while self.running:
+            # jitter, so clients dropped together do not all come back at once
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, RECONNECT_MAX)
+            try:
+                self.connect()
+                resp = self.call({"action":"resume","token":self.token,"last_id":self.last_id,
+                                  "batch":True,"deltas":True})
+            except OSError:
+                continue
+            if resp is None:
+                continue
+            if resp.get("status") == "success":
+                self.root.after(0, lambda: self.root.title("Secure Chat App"))
+                return True
+            return False
+        return False
+
+    def session_lost(self):
+        self.root.title("Secure Chat App")
+        self.username = None
+        self.token = None
+        messagebox.showwarning("Disconnected", "Connection lost. Please log in again.")
+        self.show_login()
+
+    def _push_roster(self):
+        # coalesced: a burst of presence changes redraws the list once
+        self.post_ui("roster")
 
-    def _update_recipient_combo(self, values):
+    def _refresh_roster(self):
+        if self.chat_text is None:
+            return
+        # peers with a conversation stay selectable after they go offline
+        peers = set(self.online_users) | {k for k in self.conversations if not k.startswith("#")}
+        values = ["#" + r for r in self.rooms] + sorted(u for u in peers if u != self.username)
         current = self.recipient_var.get()
         self.recipient_combo['values'] = values
         if current not in values:
             self.recipient_var.set("")
+        unread = [f"{k} ({c.unread})" for k, c in self.conversations.items() if c.unread]
+        self.unread_var.set(("New: " + ", ".join(unread)) if unread else "")
 
     def on_exit(self):
+        self.running = False
         try:
             if self.username:
-                send_json(self.sock, {"action":"logout","username":self.username})
-        except:
-            pass
-        try:
-            if self.sock:
-                self.sock.close()
+                self.send({"action":"logout","username":self.username})
         except:
             pass
+        self.disconnect()
         self.root.destroy()
 
 if __name__ == "__main__":
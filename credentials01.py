@@ -0,0 +1,156 @@
+# credentials.py
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+# scrypt where OpenSSL provides it, PBKDF2 otherwise
+SCHEME = "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2_sha256"
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+
+HASH_WORKERS = max(1, (os.cpu_count() or 2) // 2)   # processes doing KDF work
+HASH_QUEUE = 64       # hash/verify jobs queued or running; more are refused at once
+HASH_TIMEOUT = 5.0    # seconds a caller waits for its job
+
+class CredentialError(Exception):
+    pass
+
+class HasherBusy(CredentialError):
+    pass
+
+class HasherTimeout(CredentialError):
+    pass
+
+def _b64(raw):
+    return base64.b64encode(raw).decode("ascii")
+
+def _unb64(text):
+    return base64.b64decode(text.encode("ascii"))
+
+def hash_password(password, scheme=SCHEME):
+    """Salted hash in a self-describing "scheme$params$salt$digest" string."""
+    salt = os.urandom(SALT_BYTES)
+    pw = password.encode("utf-8")
+    if scheme == "scrypt":
+        digest = hashlib.scrypt(pw, salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", pw, salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}"
+
+def _parse(stored):
+    parts = stored.split("$")
+    try:
+        if parts[0] == "scrypt" and len(parts) == 6:
+            return parts[0], tuple(int(x) for x in parts[1:4]), _unb64(parts[4]), _unb64(parts[5])
+        if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+            return parts[0], (int(parts[1]),), _unb64(parts[2]), _unb64(parts[3])
+    except ValueError:
+        pass
+    return None
+
+def is_hashed(stored):
+    return _parse(stored or "") is not None
+
+def check_password(stored, password):
+    """Returns (ok, needs_rehash). Rows that are not a known hash are legacy
+    plaintext and always need rehashing."""
+    parsed = _parse(stored or "")
+    pw = password.encode("utf-8")
+    if parsed is None:
+        return hmac.compare_digest((stored or "").encode("utf-8"), pw), True
+    scheme, params, salt, digest = parsed
+    if scheme == "scrypt":
+        n, r, p = params
+        candidate = hashlib.scrypt(pw, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p)
+        current = scheme == SCHEME and params == (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    else:
+        candidate = hashlib.pbkdf2_hmac("sha256", pw, salt, params[0])
+        current = scheme == SCHEME and params[0] == PBKDF2_ITERATIONS
+    return hmac.compare_digest(candidate, digest), not current
+
+def verify_and_upgrade(stored, password):
+    """Pool job: (ok, replacement hash or None). The replacement is computed in
+    the same round trip when the row is plaintext or uses old parameters."""
+    ok, stale = check_password(stored, password)
+    return ok, (hash_password(password) if ok and stale else None)
+
+def _watch_parent(alive):
+    # a pool process is a child of the forkserver, not of the server, so
+    # nothing stops it when the server is killed outright. Only the server
+    # holds the write end of this pipe: end of file means it is gone.
+    try:
+        alive.recv()
+    except (EOFError, OSError):
+        pass
+    os._exit(0)
+
+def _init_worker(alive):
+    # Ctrl+C is for the server process; it shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=_watch_parent, args=(alive,), name="parent-watch", daemon=True).start()
+
+
+class Hasher:
+    """Process pool for the slow KDF, so a login storm burns other cores
+    instead of holding the server's GIL.
+
+    At most queue_size jobs are queued or running. A caller finding no free
+    slot gets HasherBusy straight away, and one whose job is not done within
+    timeout gets HasherTimeout, rather than waiting behind everyone else.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, queue_size=HASH_QUEUE, timeout=HASH_TIMEOUT):
+        methods = multiprocessing.get_all_start_methods()
+        # never fork a process that is already running threads
+        ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.timeout = timeout
+        self.queue_size = queue_size
+        # the pool processes get the read end; the write end closes with close() or the server
+        self._alive, self._alive_w = ctx.Pipe(duplex=False)
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                         initargs=(self._alive,))
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def depth(self):
+        return self._inflight
+
+    def _release(self, fut):
+        with self._lock:
+            self._inflight -= 1
+        self._slots.release()
+
+    def _call(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy("too many logins in progress")
+        with self._lock:
+            self._inflight += 1
+        try:
+            fut = self._pool.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        fut.add_done_callback(self._release)
+        try:
+            return fut.result(timeout=self.timeout)
+        except FutureTimeout:
+            fut.cancel()
+            raise HasherTimeout("password check timed out") from None
+
+    def hash(self, password):
+        return self._call(hash_password, password)
+
+    def verify(self, stored, password):
+        return self._call(verify_and_upgrade, stored, password)
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._alive_w.close()
+        self._alive.close()
@@ -0,0 +1,259 @@
+# framing.py
+import json
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # optional: compact binary encoding
+    msgpack = None
+
+MAX_FRAME = 1024 * 1024   # largest accepted line or frame payload
+RECV_SIZE = 65536
+
+LINES = "lines"     # newline-delimited JSON, what every client speaks
+FRAMES = "frames"   # HEADER + payload, switched to by a hello exchange
+
+# 4-byte payload length, 1-byte codec
+HEADER = struct.Struct("!IB")
+CODECS = {"json": 0, "msgpack": 1}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+# frames only: a codec byte with this bit set carries the next chunk of the
+# connection's deflate stream (raw deflate, one Z_SYNC_FLUSH per frame), so
+# keys and names repeated across frames compress against earlier ones
+DEFLATE = "deflate"
+COMPRESSED = 0x80
+COMPRESS_MIN = 512        # smaller payloads go out as they are
+COMPRESS_LEVEL = 6
+COMPRESS_WINDOW_BITS = 12 # 4 KiB history: about 40 KB of zlib state per direction, not 300
+COMPRESS_MEM_LEVEL = 5
+
+class FrameError(ValueError):
+    pass
+
+def supported_encodings():
+    return ["msgpack", "json"] if msgpack is not None else ["json"]
+
+def dump_json(obj):
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def dump(obj, encoding):
+    if encoding == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    return dump_json(obj)
+
+def load(payload, encoding):
+    if encoding == "msgpack":
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+class Framing:
+    """Wire format of one connection, plus its receive buffer.
+
+    Starts as newline JSON; a hello exchange can switch both directions to
+    length-prefixed frames. Incoming bytes land in one bytearray (recv_into
+    writes straight into it while a message is incomplete) and complete
+    lines or frames are sliced out by offset, so a burst is parsed in a
+    single pass and UTF-8 is only decoded once a whole message has arrived.
+    The buffer is dropped whenever it drains, so idle connections cost
+    nothing here.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.mode = LINES
+        self.encoding = "json"
+        self.max_frame = max_frame
+        self.compression = None           # DEFLATE once negotiated
+        self.compress_min = COMPRESS_MIN
+        self.compress_level = COMPRESS_LEVEL
+        self.window_bits = COMPRESS_WINDOW_BITS
+        self.on_compress = None           # optional callback(payload bytes, compressed bytes)
+        self._deflate = None              # created by the first frame that needs it
+        self._inflate = None
+        self._buf = bytearray()   # grown while a message is incomplete, dropped once drained
+        self._start = 0
+        self._end = 0
+        self._scan = 0    # lines mode: bytes before this hold no newline
+
+    @property
+    def key(self):
+        return (self.mode, self.encoding)
+
+    # ----- outgoing -----
+    def encode(self, obj):
+        if self.mode == LINES:
+            return dump_json(obj) + b"\n"
+        return self._frame(dump(obj, self.encoding))
+
+    def encode_shared(self, obj, cache):
+        """encode() for a frame going to many connections: cache (format key ->
+        (payload, uncompressed bytes)) keeps the serialization for the next
+        connection with the same format; only compression is per connection."""
+        entry = cache.get(self.key)
+        if entry is None:
+            if self.mode == LINES:
+                entry = (None, dump_json(obj) + b"\n")
+            else:
+                payload = dump(obj, self.encoding)
+                entry = (payload, self._frame(payload, compress=False))
+            cache[self.key] = entry
+        payload, plain = entry
+        if payload is None or self.compression is None or len(payload) < self.compress_min:
+            return plain
+        return self._frame(payload)
+
+    def _frame(self, payload, compress=True):
+        if len(payload) > self.max_frame:
+            raise FrameError(f"frame of {len(payload)} bytes exceeds {self.max_frame}")
+        codec = CODECS[self.encoding]
+        if compress and self.compression is not None and len(payload) >= self.compress_min:
+            if self._deflate is None:
+                self._deflate = zlib.compressobj(self.compress_level, zlib.DEFLATED, -self.window_bits,
+                                                 COMPRESS_MEM_LEVEL)
+            packed = self._deflate.compress(payload) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+            if self.on_compress is not None:
+                self.on_compress(len(payload), len(packed))
+            payload = packed
+            codec |= COMPRESSED
+        return HEADER.pack(len(payload), codec) + payload
+
+    # ----- incoming -----
+    def _reserve(self, n):
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        elif self._start and len(self._buf) - self._end < n:
+            # slide the unread tail to the front instead of growing
+            live = self._end - self._start
+            self._buf[:live] = self._buf[self._start:self._end]
+            self._scan -= self._start
+            self._start, self._end = 0, live
+        if len(self._buf) - self._end < n:
+            self._buf.extend(bytes(n - (len(self._buf) - self._end)))
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        """Read from a blocking socket into the buffer; returns 0 on EOF."""
+        if self._start == self._end:
+            # nothing pending: recv() sizes its result to what arrived, so an
+            # idle connection never holds a RECV_SIZE buffer
+            data = sock.recv(size)
+            self.feed(data)
+            return len(data)
+        self._reserve(size)
+        n = sock.recv_into(memoryview(self._buf)[self._end:self._end + size])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def messages(self):
+        """Yield every complete message in the buffer. Malformed payloads are
+        skipped; an oversized one raises FrameError. The mode is re-read for
+        each message, so a hello handled mid-burst takes effect at once."""
+        while True:
+            if self.mode == LINES:
+                raw = self._next_line()
+                if raw is None:
+                    self._release()
+                    return
+                if not raw.strip():
+                    continue
+                encoding = "json"
+            else:
+                frame = self._next_frame()
+                if frame is None:
+                    self._release()
+                    return
+                raw, encoding = frame
+            try:
+                obj = load(raw, encoding)
+            except (ValueError, TypeError):
+                continue
+            if isinstance(obj, dict):
+                yield obj
+
+    def _release(self):
+        if self._start == self._end:
+            self._buf = bytearray()
+            self._start = self._end = self._scan = 0
+
+    def _next_line(self):
+        idx = self._buf.find(b"\n", max(self._scan, self._start), self._end)
+        if idx < 0:
+            self._scan = self._end
+            if self._end - self._start > self.max_frame:
+                raise FrameError(f"line longer than {self.max_frame} bytes")
+            return None
+        raw = bytes(self._buf[self._start:idx])
+        self._start = self._scan = idx + 1
+        return raw
+
+    def _next_frame(self):
+        if self._end - self._start < HEADER.size:
+            return None
+        length, codec = HEADER.unpack_from(self._buf, self._start)
+        if length > self.max_frame:
+            raise FrameError(f"frame of {length} bytes exceeds {self.max_frame}")
+        begin = self._start + HEADER.size
+        if self._end - begin < length:
+            self._reserve(HEADER.size + length)
+            return None
+        raw = bytes(self._buf[begin:begin + length])
+        self._start = self._scan = begin + length
+        if codec & COMPRESSED:
+            raw = self._inflate_frame(raw)
+        return raw, CODEC_NAMES.get(codec & ~COMPRESSED, "json")
+
+    def _inflate_frame(self, raw):
+        if self.compression is None:
+            raise FrameError("compressed frame on a connection without compression")
+        if self._inflate is None:
+            self._inflate = zlib.decompressobj(-self.window_bits)
+        try:
+            # bounded, so a small frame cannot inflate into gigabytes
+            out = self._inflate.decompress(raw, self.max_frame + 1)
+        except zlib.error as e:
+            raise FrameError(f"corrupt compressed frame: {e}") from None
+        if len(out) > self.max_frame or self._inflate.unconsumed_tail:
+            raise FrameError(f"compressed frame inflates past {self.max_frame} bytes")
+        return out
+
+    # ----- negotiation -----
+    def client_hello(self, compression=True):
+        # "ping": the caller answers {"action":"ping"}, so the server may close it once it stops answering
+        hello = {"action":"hello","framing":[FRAMES, LINES],"encodings":supported_encodings(),
+                 "max_frame":self.max_frame,"ping":True}
+        if compression:
+            hello["compression"] = [DEFLATE]
+        return hello
+
+    def negotiate(self, hello, compress_level=COMPRESS_LEVEL, compress_min=COMPRESS_MIN):
+        """Server side: choose settings for a client hello. Send the returned
+        reply in the current format, then call switch(reply). compress_level
+        0 never turns compression on."""
+        offered = hello.get("framing") or [LINES]
+        mode = FRAMES if FRAMES in offered else LINES
+        encoding = next((e for e in hello.get("encodings") or [] if e in supported_encodings()), "json")
+        try:
+            max_frame = min(self.max_frame, int(hello.get("max_frame") or self.max_frame))
+        except (TypeError, ValueError):
+            max_frame = self.max_frame
+        reply = {"action":"hello","framing":mode,"encoding":encoding,"max_frame":max_frame}
+        if mode == FRAMES and compress_level > 0 and DEFLATE in (hello.get("compression") or []):
+            self.compress_level = compress_level
+            reply.update(compression=DEFLATE, compress_min=compress_min, window_bits=COMPRESS_WINDOW_BITS)
+        return reply
+
+    def switch(self, reply):
+        """Adopt the settings of a hello reply (both sides)."""
+        self.mode = reply.get("framing", LINES)
+        self.encoding = reply.get("encoding", "json")
+        self.max_frame = reply.get("max_frame", self.max_frame)
+        self.compression = reply.get("compression") if self.mode == FRAMES else None
+        if self.compression is not None:
+            self.compress_min = reply.get("compress_min", COMPRESS_MIN)
+            self.window_bits = reply.get("window_bits", COMPRESS_WINDOW_BITS)
+        self._scan = self._start
@@ -0,0 +1,273 @@
+# messagelog.py
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from itertools import islice
+
+SEGMENT_BYTES = 4 * 1024 * 1024   # a segment is sealed once it grows past this
+PARTITIONS = 16
+OFFSETS_COMPACT = 256 * 1024      # rewrite a partition's offsets journal past this size
+
+# payload length, CRC32 of the payload, sequence number within the partition
+RECORD = struct.Struct("!IIQ")
+
+def partition_of(key, count):
+    # crc32, not hash(): the mapping has to survive a restart
+    return zlib.crc32(key.encode("utf-8")) % count
+
+
+class Segment:
+    """One append-only file of records, named by its first sequence number.
+    Reads go through an mmap, remapped when the file has grown past it."""
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.live = 0       # records not yet consumed
+        self._map = None
+
+    def append(self, data, sync=False):
+        os.write(self.fd, data)
+        self.size += len(data)
+        if sync:
+            os.fsync(self.fd)
+
+    def view(self):
+        if self._map is None or len(self._map) < self.size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def read(self, pos):
+        buf = self.view()
+        length = RECORD.unpack_from(buf, pos)[0]
+        start = pos + RECORD.size
+        return json.loads(buf[start:start + length])
+
+    def scan(self):
+        """Yield (pos, seq, payload) for every intact record. A torn or
+        corrupt tail, left by a crash mid-write, is cut off."""
+        if not self.size:
+            return
+        buf = self.view()
+        pos = 0
+        while pos + RECORD.size <= self.size:
+            length, crc, seq = RECORD.unpack_from(buf, pos)
+            start = pos + RECORD.size
+            payload = buf[start:start + length]
+            if start + length > self.size or zlib.crc32(payload) != crc:
+                break
+            yield pos, seq, json.loads(payload)
+            pos = start + length
+        if pos < self.size:
+            self._map.close()
+            self._map = None
+            os.ftruncate(self.fd, pos)
+            self.size = pos
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self.fd)
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class Partition:
+    """Segments plus, per key, the records not yet consumed (in append order)
+    and the consumer offset: the sequence number of the last one consumed."""
+
+    def __init__(self, path, segment_bytes, sync=True):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.sync = sync     # fsync each appended batch (and each new segment's directory entry)
+        self.segments = []
+        self.pending = {}    # key -> deque of (seq, id, segment, pos)
+        self.offsets = {}    # key -> last consumed seq
+        self.next_seq = 1
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._recover()
+        self._journal = open(os.path.join(path, "offsets"), "a", encoding="utf-8")
+
+    def _recover(self):
+        journal = os.path.join(self.path, "offsets")
+        if os.path.exists(journal):
+            with open(journal, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        key, seq = json.loads(line)
+                    except ValueError:
+                        continue   # torn last line
+                    self.offsets[key] = max(seq, self.offsets.get(key, 0))
+        names = sorted(n for n in os.listdir(self.path) if n.endswith(".seg"))
+        for name in names:
+            seg = Segment(os.path.join(self.path, name), int(name[:-4]))
+            self.segments.append(seg)
+            # an empty active segment still holds the next sequence number in its name
+            self.next_seq = max(self.next_seq, seg.base)
+            for pos, seq, (key, mid, _, _, _) in seg.scan():
+                self.next_seq = max(self.next_seq, seq + 1)
+                if seq > self.offsets.get(key, 0):
+                    self.pending.setdefault(key, deque()).append((seq, mid, seg, pos))
+                    seg.live += 1
+        for seg in self.segments[:-1]:
+            if not seg.live:
+                seg.delete()
+        self.segments = [s for s in self.segments[:-1] if s.live] + self.segments[-1:]
+        if not self.segments:
+            self._roll()
+
+    def _roll(self):
+        if self.segments and not self.segments[-1].live:
+            self.segments.pop().delete()
+        self.segments.append(Segment(os.path.join(self.path, f"{self.next_seq:020d}.seg"), self.next_seq))
+        if self.sync:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def append(self, entries):
+        # caller holds the lock; one write for the whole batch
+        if self.segments[-1].size >= self.segment_bytes:
+            self._roll()
+        seg = self.segments[-1]
+        parts = []
+        pos = seg.size
+        for key, row in entries:
+            payload = json.dumps([key, *row], ensure_ascii=False).encode("utf-8")
+            parts.append(RECORD.pack(len(payload), zlib.crc32(payload), self.next_seq))
+            parts.append(payload)
+            self.pending.setdefault(key, deque()).append((self.next_seq, row[0], seg, pos))
+            seg.live += 1
+            pos += RECORD.size + len(payload)
+            self.next_seq += 1
+        seg.append(b"".join(parts), self.sync)
+
+    def consume(self, key, ids):
+        # caller holds the lock; only a prefix can be consumed, so the offset says it all
+        queue = self.pending.get(key)
+        done = 0
+        last = None
+        while queue and queue[0][1] in ids:
+            last, _, seg, _ = queue.popleft()
+            seg.live -= 1
+            if not seg.live and seg is not self.segments[-1]:
+                seg.delete()
+                self.segments.remove(seg)
+            done += 1
+        if queue is not None and not queue:
+            del self.pending[key]
+        if last is not None:
+            self.offsets[key] = last
+            self._journal.write(json.dumps([key, last], ensure_ascii=False) + "\n")
+            self._journal.flush()
+            if self._journal.tell() > OFFSETS_COMPACT:
+                self._compact()
+        return done
+
+    def _compact(self):
+        # only offsets that still hide records in a live segment matter
+        oldest = self.segments[0].base
+        path = os.path.join(self.path, "offsets")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            for key, seq in self.offsets.items():
+                if seq >= oldest:
+                    f.write(json.dumps([key, seq], ensure_ascii=False) + "\n")
+        self._journal.close()
+        os.replace(path + ".tmp", path)
+        self._journal = open(path, "a", encoding="utf-8")
+        self.offsets = {k: v for k, v in self.offsets.items() if v >= oldest}
+
+    def close(self):
+        self._journal.close()
+        for seg in self.segments:
+            os.fsync(seg.fd)
+            seg.close()
+
+
+class MessageLog:
+    """Append-only store of messages waiting for their recipient.
+
+    Keys (recipients) are hashed onto a fixed set of partitions, each a
+    directory of segment files. Nothing is ever updated in place: delivery
+    advances the recipient's consumer offset, written to a small journal,
+    and a segment whose records have all been consumed is deleted. Opening
+    the log scans the segments to rebuild the pending records, so a crash
+    loses at most a torn final write; with sync, append() returns only once
+    the records are on disk. Delivery is at least once: records sent but
+    not yet consumed when the process died are sent again.
+    """
+
+    def __init__(self, path, partitions=PARTITIONS, segment_bytes=SEGMENT_BYTES, sync=True):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        existing = sorted(n for n in os.listdir(path) if n.startswith("p") and n[1:].isdigit())
+        # the partition count is fixed when the log is created
+        count = len(existing) or partitions
+        self.partitions = [Partition(os.path.join(path, f"p{i:03d}"), segment_bytes, sync) for i in range(count)]
+
+    def _partition(self, key):
+        return self.partitions[partition_of(key, len(self.partitions))]
+
+    def append(self, entries):
+        """entries: (key, (id, sender, message, timestamp)) in order."""
+        groups = {}
+        for key, row in entries:
+            groups.setdefault(partition_of(key, len(self.partitions)), []).append((key, row))
+        for i, group in groups.items():
+            part = self.partitions[i]
+            with part.lock:
+                part.append(group)
+
+    def pending(self, key, limit=-1):
+        """The oldest records waiting for key, as (id, sender, message, timestamp)."""
+        part = self._partition(key)
+        with part.lock:
+            refs = list(islice(part.pending.get(key) or (), limit if limit >= 0 else None))
+            return [tuple(seg.read(pos)[1:]) for _, _, seg, pos in refs]
+
+    def pending_ids(self, key):
+        part = self._partition(key)
+        with part.lock:
+            return {mid for _, mid, _, _ in part.pending.get(key) or ()}
+
+    def consume(self, key, ids):
+        """Mark the leading pending records of key with these ids delivered."""
+        part = self._partition(key)
+        with part.lock:
+            return part.consume(key, set(ids))
+
+    def all_pending(self):
+        """{key: [ids]} across every partition."""
+        out = {}
+        for part in self.partitions:
+            with part.lock:
+                for key, queue in part.pending.items():
+                    out[key] = [mid for _, mid, _, _ in queue]
+        return out
+
+    def stats(self):
+        segments = pending = 0
+        for part in self.partitions:
+            with part.lock:
+                segments += len(part.segments)
+                pending += sum(len(q) for q in part.pending.values())
+        return {"segments": segments, "pending": pending}
+
+    def close(self):
+        for part in self.partitions:
+            with part.lock:
+                part.close()
@@ -0,0 +1,219 @@
+# metrics.py
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds; covers sub-millisecond routing up to slow DB commits
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, None, v) for labels, v in self._values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return {"/".join(map(str, k)) or "total": v for k, v in self._values.items()}
+
+
+class Gauge:
+    """Either set() explicitly or read from fn() at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = ()
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn is None:
+            return self.value
+        try:
+            return self.fn()
+        except Exception:
+            return float("nan")
+
+    def samples(self):
+        return [(self.name, (), None, self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 2)
+            s[i] += 1
+            s[-1] += value
+
+    def samples(self):
+        out = []
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        for labels, s in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), s):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append((self.name + "_bucket", labels, ("le", le), cumulative))
+            out.append((self.name + "_sum", labels, None, s[-1]))
+            out.append((self.name + "_count", labels, None, cumulative))
+        return out
+
+    def snapshot(self):
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        out = {}
+        for labels, s in series:
+            count = sum(s[:-1])
+            out["/".join(map(str, labels)) or "total"] = {
+                "count": count,
+                "sum": round(s[-1], 6),
+                "p50": self._quantile(s, count, 0.5),
+                "p99": self._quantile(s, count, 0.99),
+            }
+        return out
+
+    def _quantile(self, s, count, q):
+        # upper bound of the bucket holding the q-th observation
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, s):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, fn=None):
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def render_prometheus(self):
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, extra, value in m.samples():
+                lines.append(f"{name}{format_labels(m.labelnames, labels, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {"time": time.time(), "metrics": {m.name: m.snapshot() for m in self.metrics}}
+
+
+def serve_http(registry, host, port):
+    """Prometheus text on /metrics, the JSON snapshot on /metrics.json."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body = json.dumps(registry.snapshot()).encode("utf-8")
+                ctype = "application/json"
+            elif self.path.startswith("/metrics"):
+                body = registry.render_prometheus().encode("utf-8")
+                ctype = "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    return httpd
+
+
+class SnapshotWriter:
+    """Writes registry.snapshot() to a JSON file every interval seconds."""
+
+    def __init__(self, registry, path, interval):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-json", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp, self.path)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
@@ -1,297 +1,2915 @@
 # server.py
+import argparse
+import asyncio
+import bisect
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import selectors
+import signal
 import socket
 import threading
 import sqlite3
-import json
+import queue
+import secrets
+import shutil
+import time
+from collections import deque
+from itertools import count, islice
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+import credentials01
+from credentials01 import CredentialError, Hasher
+import framing01
+from framing01 import Framing, RECV_SIZE
+import messagelog01
+from messagelog01 import MessageLog
+from metrics01 import Registry, SnapshotWriter, serve_http
+
 HOST = "0.0.0.0"
 PORT = 5000
 DB_FILE = "users.db"
+ENGINE = "threaded"     # "threaded" or "asyncio"
+DB_WORKERS = 8          # threads available for blocking DB work (asyncio requests, backlog replays)
+WORKERS = 1             # >1: supervisor + worker processes sharing the port
+REUSE_PORT = False      # set in workers: every process binds PORT with SO_REUSEPORT
 
-# username -> (conn, addr)
+# username -> ClientSession
 connections = {}
 lock = threading.Lock()
 
+# ---------- Metrics ----------
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0          # >0: Prometheus text on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_JSON = None       # path for a periodic JSON snapshot
+METRICS_INTERVAL = 10.0   # seconds between JSON snapshots
+
+registry = Registry()
+ACTION_SECONDS = registry.histogram("chat_action_seconds", "Time to handle one request", ("action",))
+ERRORS = registry.counter("chat_errors_total", "Exceptions while serving clients", ("where", "type"))
+DB_SECONDS = registry.histogram("chat_db_seconds", "Time spent in each DB helper", ("op",))
+DELIVERIES = registry.counter("chat_deliveries_total",
+                              "Private messages by outcome: online, remote, busy, offline, failed, backlog",
+                              ("path",))
+BYTES_IN = registry.counter("chat_bytes_in_total", "Bytes received from clients")
+BYTES_OUT = registry.counter("chat_bytes_out_total", "Bytes written to clients")
+FANOUT_SECONDS = registry.histogram("chat_presence_fanout_seconds", "Time to queue one presence update for everyone")
+FANOUT_RECIPIENTS = registry.counter("chat_presence_fanout_recipients_total", "Presence frames queued")
+WRITE_BATCH_ROWS = registry.histogram("chat_offline_batch_rows", "Rows per offline group commit",
+                                      buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+registry.gauge("chat_connections", "Logged-in connections on this process", lambda: len(connections))
+registry.gauge("chat_outbox_bytes", "Bytes queued for all clients",
+               lambda: sum(s.queued for s in list(connections.values())))
+registry.gauge("chat_offline_queue_depth", "Offline messages waiting for the writer",
+               lambda: offline_writer.depth() if offline_writer is not None else 0)
+registry.gauge("chat_online_delivery_ratio", "Share of private messages delivered live (not stored)",
+               lambda: online_delivery_ratio())
+registry.gauge("chat_presence_version", "Roster version sent to clients", lambda: presence.version)
+registry.gauge("chat_heartbeat_tracked", "Connections with an idle deadline on the timer wheel",
+               lambda: len(heartbeats))
+ROOM_FANOUT_SECONDS = registry.histogram("chat_room_fanout_seconds", "Time to queue one room post for its online members")
+ROOM_RECIPIENTS = registry.counter("chat_room_recipients_total", "Room posts by outcome: live, behind", ("path",))
+HASH_SECONDS = registry.histogram("chat_password_hash_seconds", "Password hash/verify time, queueing included",
+                                  ("op",))
+PASSWORD_UPGRADES = registry.counter("chat_password_upgrades_total", "Stored passwords rehashed on login")
+THROTTLED = registry.counter("chat_throttled_total", "Requests refused by rate limits",
+                             ("action", "scope"))
+THROTTLE_DISCONNECTS = registry.counter("chat_throttle_disconnects_total",
+                                        "Connections dropped for staying over their rate limits")
+IDLE_REAPED = registry.counter("chat_idle_reaped_total", "Connections closed after missing heartbeats")
+RETENTION_ROWS = registry.counter("chat_retention_rows_total", "Expired private messages archived and deleted",
+                                  ("kind",))
+VACUUMED_PAGES = registry.counter("chat_vacuumed_pages_total", "Free database pages returned by incremental_vacuum")
+COMPRESSION_BYTES = registry.counter("chat_compression_bytes_total",
+                                     "Payload bytes of deflated frames to clients: raw, wire", ("stage",))
+registry.gauge("chat_maintenance_last_pass_timestamp", "When the last retention pass finished (epoch seconds)",
+               lambda: maintenance.progress().get("finished", 0))
+USER_DIRECTORY_RELOADS = registry.counter("chat_user_directory_reloads_total",
+                                          "Full reloads of the in-memory user directory")
+registry.gauge("chat_password_hash_inflight", "Hash jobs queued or running",
+               lambda: hasher.depth() if hasher is not None else 0)
+registry.gauge("chat_store_pending", "Undelivered messages held by the log or memory store",
+               lambda: store_stat("pending"))
+registry.gauge("chat_store_segments", "Segment files in the message log", lambda: store_stat("segments"))
+
+def online_delivery_ratio():
+    counts = DELIVERIES.snapshot()
+    live = counts.get("online", 0) + counts.get("remote", 0)
+    total = live + counts.get("offline", 0) + counts.get("busy", 0) + counts.get("failed", 0)
+    return live / total if total else 0.0
+
+def timed_db(fn):
+    op = fn.__name__
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, op)
+    wrapper.__name__ = op
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
 # ---------- Database ----------
+DB_POOL_SIZE = 8          # long-lived connections shared by all handlers
+DB_SYNCHRONOUS = "NORMAL" # WAL + NORMAL: durable across app crashes, one fsync per checkpoint
+DB_CACHE_KB = 8192
+
+db_pool = None
+db_pool_lock = threading.Lock()
+fts_enabled = False   # set by init_db when SQLite has FTS5
+
+class ConnectionPool:
+    """Fixed set of long-lived SQLite connections handed out per call.
+
+    Every connection runs in WAL mode, so readers never wait on the writer,
+    and keeps sqlite3's statement cache warm so repeated queries skip parsing.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=256)
+        # before WAL creates the file, or it does nothing: on a new database
+        # the pages retention frees are then handed back a few at a time
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+def db():
+    global db_pool
+    if db_pool is None or db_pool.path != DB_FILE:
+        with db_pool_lock:
+            if db_pool is None or db_pool.path != DB_FILE:
+                db_pool = ConnectionPool(DB_FILE, DB_POOL_SIZE)
+    return db_pool.connection()
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            country TEXT,
-            phone TEXT,
-            username TEXT UNIQUE,
-            password TEXT
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender TEXT,
-            recipient TEXT,
-            message TEXT,
-            timestamp TEXT,
-            delivered INTEGER DEFAULT 0
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def add_user(country, phone, username, password):
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO users (country, phone, username, password) VALUES (?, ?, ?, ?)",
-                    (country, phone, username, password))
+    global fts_enabled
+    with db() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                country TEXT,
+                phone TEXT,
+                username TEXT UNIQUE,
+                password TEXT
+            )
+        """)
+        # view_users order, so the admin console can page without sorting
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_listing ON users (username COLLATE NOCASE, username)")
+        # bumped by triggers on every change to users, whoever makes it, so
+        # the in-memory directory can tell its copy is out of date
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+        conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('users', 0)")
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS users_version_{event.lower()} AFTER {event} ON users "
+                         "BEGIN UPDATE counters SET value=value+1 WHERE name='users'; END")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT,
+                recipient TEXT,
+                message TEXT,
+                timestamp TEXT,
+                delivered INTEGER DEFAULT 0,
+                sent_at REAL
+            )
+        """)
+        # timestamp is the sender's display string; sent_at (epoch seconds) sorts
+        add_column(conn, "messages", "sent_at", "REAL")
+        backfill_sent_at(conn, "messages")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_undelivered ON messages (recipient, delivered, id)")
+        # resume cursor: everything after a message id, delivered or not
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (recipient, id)")
+        # history: one conversation, either direction, newest first
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation "
+                     "ON messages (min(sender, recipient), max(sender, recipient), id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                token_hash TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions (username)")
+        # an account deleted from outside the server (viewusers01.py) takes its tokens with it
+        conn.execute("CREATE TRIGGER IF NOT EXISTS users_delete_sessions AFTER DELETE ON users "
+                     "BEGIN DELETE FROM sessions WHERE username=old.username; END")
+        conn.execute("DELETE FROM sessions WHERE username NOT IN (SELECT username FROM users)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rooms (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                owner TEXT
+            )
+        """)
+        # last_read: newest room message id this member has been sent
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS room_members (
+                room_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                last_read INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (room_id, username)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_room_members_user ON room_members (username)")
+        # one row per post, however many members the room has
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS room_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room_id INTEGER NOT NULL,
+                sender TEXT,
+                message TEXT,
+                timestamp TEXT,
+                sent_at REAL
+            )
+        """)
+        add_column(conn, "room_messages", "sent_at", "REAL")
+        backfill_sent_at(conn, "room_messages")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_room_messages_room ON room_messages (room_id, id)")
+        fts_enabled = all(create_fts_index(conn, table) for table in ("messages", "room_messages"))
         conn.commit()
-        conn.close()
+
+def add_column(conn, table, column, decl):
+    # upgrade a database created before the column existed
+    if column not in {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def backfill_sent_at(conn, table):
+    # rows written before sent_at existed carry no date (timestamp is only a
+    # clock time), so their age starts at the upgrade; otherwise retention
+    # would take every one of them as the oldest and expire them all at once.
+    # They are the lowest ids, so the first row says whether any are left.
+    first = conn.execute(f"SELECT sent_at FROM {table} ORDER BY id LIMIT 1").fetchone()
+    if first is not None and first[0] is None:
+        conn.execute(f"UPDATE {table} SET sent_at=? WHERE sent_at IS NULL", (time.time(),))
+
+def create_fts_index(conn, table):
+    """External-content FTS5 index over table.message, kept current by
+    triggers. False when this SQLite build has no FTS5."""
+    fts = table + "_fts"
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (fts,)).fetchone()
+    try:
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} "
+                     f"USING fts5(message, content='{table}', content_rowid='id')")
+    except sqlite3.OperationalError:
+        return False
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+                 f"INSERT INTO {fts} (rowid, message) VALUES (new.id, new.message); END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+                 f"INSERT INTO {fts} ({fts}, rowid, message) VALUES ('delete', old.id, old.message); END")
+    if not existed:
+        # index the rows written before the index existed
+        conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+    return True
+
+def users_version(conn):
+    return conn.execute("SELECT value FROM counters WHERE name='users'").fetchone()[0]
+
+@timed_db
+def add_user(country, phone, username, password_hash):
+    try:
+        with db() as conn:
+            conn.execute("INSERT INTO users (country, phone, username, password) VALUES (?, ?, ?, ?)",
+                         (country, phone, username, password_hash))
+            version = users_version(conn)
+            conn.commit()
+        directory.added((country, phone, username, password_hash), version)
         return True, "Registered successfully"
     except sqlite3.IntegrityError:
         return False, "Username or phone already exists"
     except Exception as e:
         return False, str(e)
 
+def lookup_user(identifier):
+    """(username, stored password) by username or phone, from memory."""
+    return directory.lookup(identifier)
+
+@timed_db
+def replace_password(username, old, new):
+    # conditional, so a concurrent password change is never overwritten
+    with db() as conn:
+        changed = conn.execute("UPDATE users SET password=? WHERE username=? AND password=?",
+                               (new, username, old)).rowcount
+        version = users_version(conn) if changed else None
+        conn.commit()
+    if changed:
+        directory.password_changed(username, new, version)
+
 def verify_user(identifier, password):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT username, password FROM users WHERE phone=? OR username=?", (identifier, identifier))
-    row = cur.fetchone()
-    conn.close()
+    row = lookup_user(identifier)
     if not row:
         return False, None
-    username_db, pw = row
-    if pw == password:
-        return True, username_db
-    return False, None
-
-def store_message(sender, recipient, message, timestamp):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO messages (sender, recipient, message, timestamp, delivered) VALUES (?, ?, ?, ?, 0)",
-                (sender, recipient, message, timestamp))
-    conn.commit()
-    conn.close()
-
-def fetch_undelivered(recipient):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, sender, message, timestamp FROM messages WHERE recipient=? AND delivered=0 ORDER BY id ASC", (recipient,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def mark_delivered(ids):
+    username_db, stored = row
+    ok, upgraded = check_credentials(stored, password)
+    if not ok:
+        return False, None
+    if upgraded:
+        # plaintext or outdated parameters: migrate on this successful login
+        replace_password(username_db, stored, upgraded)
+        PASSWORD_UPGRADES.inc()
+    return True, username_db
+
+@timed_db
+def insert_messages(rows):
+    """Insert in one transaction; returns the new ids in row order."""
+    with db() as conn:
+        ids = [conn.execute("INSERT INTO messages (sender, recipient, message, timestamp, sent_at, delivered) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", row).lastrowid for row in rows]
+        conn.commit()
+    return ids
+
+def store_message(sender, recipient, message, timestamp, delivered=False, wait=False):
+    """Record one private message. Returns its id once committed; None when
+    durability is relaxed and the caller did not ask to wait."""
+    row = (sender, recipient, message, timestamp, time.time(), int(delivered))
+    if offline_writer is None:
+        return store().append([row])[0]
+    done = offline_writer.submit(row)
+    if wait or not RELAXED_DURABILITY:
+        return done.result()
+    return None
+
+@timed_db
+def fetch_undelivered(recipient, after_id=0, limit=-1):
+    # served from idx_messages_undelivered: a range seek, no sort
+    with db() as conn:
+        return conn.execute("SELECT id, sender, message, timestamp FROM messages "
+                            "WHERE recipient=? AND delivered=0 AND id>? ORDER BY id ASC LIMIT ?",
+                            (recipient, after_id, limit)).fetchall()
+
+@timed_db
+def fetch_since(recipient, after_id, limit=-1):
+    # delivered or not: replays what a dropped connection may have lost
+    with db() as conn:
+        return conn.execute("SELECT id, sender, message, timestamp FROM messages "
+                            "WHERE recipient=? AND id>? ORDER BY id ASC LIMIT ?",
+                            (recipient, after_id, limit)).fetchall()
+
+@timed_db
+def mark_delivered(ids, delivered=1):
     if not ids:
         return
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.executemany("UPDATE messages SET delivered=1 WHERE id=?", [(i,) for i in ids])
-    conn.commit()
-    conn.close()
-
-def get_registered_users():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT country, phone, username FROM users ORDER BY username COLLATE NOCASE")
-    rows = cur.fetchall()
-    conn.close()
-    return [{"country": r[0], "phone": r[1], "username": r[2]} for r in rows]
+    ids = sorted(ids)
+    with db() as conn:
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            conn.execute(f"UPDATE messages SET delivered=? WHERE id IN ({','.join('?' * len(chunk))})",
+                         [delivered] + chunk)
+        conn.commit()
+
+@timed_db
+def mark_undelivered(mid):
+    # a live send failed after the row was stored as delivered
+    with db() as conn:
+        conn.execute("UPDATE messages SET delivered=0 WHERE id=?", (mid,))
+        conn.commit()
+
+@timed_db
+def count_undelivered(ids):
+    n = 0
+    with db() as conn:
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            n += conn.execute(f"SELECT count(*) FROM messages WHERE delivered=0 AND id IN ({','.join('?' * len(chunk))})",
+                              chunk).fetchone()[0]
+    return n
+
+@timed_db
+def fetch_all_undelivered():
+    with db() as conn:
+        return conn.execute("SELECT id, recipient, sender, message, timestamp FROM messages "
+                            "WHERE delivered=0 ORDER BY id").fetchall()
 
+@timed_db
+def mark_delivered_range(recipient, first_id, last_id):
+    with db() as conn:
+        conn.execute("UPDATE messages SET delivered=1 WHERE recipient=? AND delivered=0 AND id BETWEEN ? AND ?",
+                     (recipient, first_id, last_id))
+        conn.commit()
+
+@timed_db
+def expiry_boundary(cutoff):
+    """Highest message id sent before cutoff. Ids grow with sent_at, so a
+    binary search over the primary key finds it without an index on sent_at
+    (init_db gives rows older than the column the upgrade time)."""
+    with db() as conn:
+        lo, hi = conn.execute("SELECT min(id), max(id) FROM messages").fetchone()
+        if lo is None:
+            return 0
+        boundary = 0
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            mid_id, sent_at = conn.execute("SELECT id, sent_at FROM messages WHERE id>=? ORDER BY id LIMIT 1",
+                                           (mid,)).fetchone()
+            if (sent_at or 0) < cutoff:
+                boundary, lo = mid_id, mid_id + 1
+            else:
+                hi = mid - 1
+        return boundary
+
+@timed_db
+def fetch_expired(after_id, boundary, delivered, limit):
+    # a primary-key range scan, resumed from the last chunk
+    with db() as conn:
+        return conn.execute("SELECT id, sender, recipient, message, timestamp, sent_at, delivered FROM messages "
+                            "WHERE id>? AND id<=? AND delivered=? ORDER BY id LIMIT ?",
+                            (after_id, boundary, delivered, limit)).fetchall()
+
+@timed_db
+def delete_messages(ids, delivered):
+    # rows whose delivered flag changed since they were read stay for the next pass
+    with db() as conn:
+        n = conn.execute(f"DELETE FROM messages WHERE delivered=? AND id IN ({','.join('?' * len(ids))})",
+                         [delivered] + ids).rowcount
+        conn.commit()
+    return n
+
+@timed_db
+def load_users():
+    # version first: a write landing in between only causes another reload
+    with db() as conn:
+        version = users_version(conn)
+        rows = conn.execute("SELECT country, phone, username, password FROM users ORDER BY id").fetchall()
+    return version, rows
+
+@timed_db
+def read_users_version():
+    with db() as conn:
+        return users_version(conn)
+
+@timed_db
 def delete_user_db(username):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM users WHERE username=?", (username,))
-    conn.commit()
-    conn.close()
-
-# ---------- JSON helpers ----------
-def send_json(conn, obj):
-    raw = json.dumps(obj, ensure_ascii=False) + "\n"
-    conn.sendall(raw.encode("utf-8"))
-
-def recv_jsons(conn, buffer):
+    with db() as conn:
+        gone = conn.execute("DELETE FROM users WHERE username=?", (username,)).rowcount
+        version = users_version(conn) if gone else None
+        conn.execute("DELETE FROM sessions WHERE username=?", (username,))
+        conn.execute("DELETE FROM room_members WHERE username=?", (username,))
+        conn.commit()
+    if gone:
+        directory.removed(username, version)
+    return bool(gone)
+
+# ---------- User directory ----------
+USERS_PAGE = 100         # users per view_users reply unless the client asks for fewer
+USERS_PAGE_MAX = 1000
+USERS_CHECK_SECS = 1.0   # how often the directory looks for writes made outside this process
+
+def listing_key(username):
+    # the order view_users has always used (COLLATE NOCASE), ties broken exactly
+    return (username.lower(), username)
+
+class UserDirectory:
+    """Every registered user in memory: lookups by username or phone and the
+    sorted view_users listing, without a query.
+
+    The database stays the source of truth. This process's own writes are
+    applied in place, each carrying the users version it produced; a gap in
+    the versions, or a changed version seen by the periodic check, means
+    someone else wrote (another worker, viewusers01.py) and the next access
+    reloads everything.
+    """
+
+    def __init__(self):
+        self._users = {}     # username -> (country, phone, username, password)
+        self._phones = {}    # phone -> username
+        self._keys = []      # listing_key of each user, sorted
+        self._order = []     # usernames in listing order
+        self._pages = {}     # (after, limit) -> (frame, encoded per wire format)
+        self._version = None # None until loaded, or once known stale
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _fresh(self, force=False):
+        # caller holds the lock
+        now = time.monotonic()
+        if self._version is not None and not force and now - self._checked < USERS_CHECK_SECS:
+            return
+        self._checked = now
+        if self._version is not None and read_users_version() == self._version:
+            return
+        version, rows = load_users()
+        self._users = {}
+        self._phones = {}
+        for row in rows:
+            self._users[row[2]] = row
+            self._phones.setdefault(row[1], row[2])
+        self._order = sorted(self._users, key=listing_key)
+        self._keys = [listing_key(u) for u in self._order]
+        self._pages = {}
+        self._version = version
+        USER_DIRECTORY_RELOADS.inc()
+
+    def _applies(self, version):
+        # caller holds the lock; True when version directly follows ours
+        if self._version is not None and version == self._version + 1:
+            self._version = version
+            self._pages = {}
+            return True
+        self._version = None
+        return False
+
+    def lookup(self, identifier):
+        with self._lock:
+            self._fresh()
+            row = self._users.get(identifier)
+            if row is None:
+                username = self._phones.get(identifier)
+                if username is None:
+                    # registered through another worker a moment ago?
+                    self._fresh(force=True)
+                    username = self._phones.get(identifier, identifier)
+                row = self._users.get(username)
+        return (row[2], row[3]) if row else None
+
+    def added(self, row, version):
+        with self._lock:
+            if not self._applies(version):
+                return
+            username = row[2]
+            if username not in self._users:
+                i = bisect.bisect_left(self._keys, listing_key(username))
+                self._keys.insert(i, listing_key(username))
+                self._order.insert(i, username)
+            self._users[username] = row
+            self._phones.setdefault(row[1], username)
+
+    def removed(self, username, version):
+        with self._lock:
+            if not self._applies(version):
+                return
+            row = self._users.pop(username, None)
+            if row is None:
+                return
+            if self._phones.get(row[1]) == username:
+                del self._phones[row[1]]
+            i = bisect.bisect_left(self._keys, listing_key(username))
+            del self._keys[i]
+            del self._order[i]
+
+    def password_changed(self, username, password, version):
+        with self._lock:
+            if self._applies(version) and username in self._users:
+                self._users[username] = self._users[username][:3] + (password,)
+
+    def page(self, after, limit, match=None):
+        """view_users reply for the limit users listed after `after` (a
+        username; None for the first page), optionally only those whose
+        username or phone contains `match`, with its encode cache. Both are
+        reused until the directory changes."""
+        with self._lock:
+            self._fresh()
+            cached = self._pages.get((after, limit, match))
+            if cached is not None:
+                return cached
+            listed, keys = self._order, self._keys
+            if match:
+                needle = match.lower()
+                listed = [u for u in listed if needle in u.lower() or needle in self._users[u][1].lower()]
+                keys = [listing_key(u) for u in listed]
+            start = 0 if after is None else bisect.bisect_right(keys, listing_key(after))
+            names = listed[start:start + limit]
+            users = [{"country":r[0],"phone":r[1],"username":r[2]} for r in (self._users[u] for u in names)]
+            nxt = names[-1] if start + limit < len(listed) else None
+            frame = {"status":"success","users":users,"next":nxt,"total":len(listed)}
+            if len(self._pages) >= 256:
+                self._pages.clear()
+            cached = self._pages[(after, limit, match)] = (frame, {})
+            return cached
+
+directory = UserDirectory()
+
+# ---------- Session tokens ----------
+SESSION_TTL = 7 * 24 * 3600   # seconds a login can be resumed without the password
+RESUME_GRACE = 10.0           # seconds a dropped user stays listed online, waiting for a resume
+
+def token_hash(token):
+    # only the digest is stored, so a copy of the database cannot resume sessions
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+@timed_db
+def create_session(username):
+    token = secrets.token_urlsafe(24)
+    now = time.time()
+    with db() as conn:
+        conn.execute("DELETE FROM sessions WHERE username=? AND expires<?", (username, now))
+        conn.execute("INSERT INTO sessions (token_hash, username, expires) VALUES (?, ?, ?)",
+                     (token_hash(token), username, now + SESSION_TTL))
+        conn.commit()
+    return token
+
+@timed_db
+def lookup_session(token):
+    with db() as conn:
+        # only while the account exists
+        row = conn.execute("SELECT s.username FROM sessions s JOIN users u ON u.username=s.username "
+                           "WHERE s.token_hash=? AND s.expires>?", (token_hash(token), time.time())).fetchone()
+    return row[0] if row else None
+
+@timed_db
+def delete_session(token):
+    with db() as conn:
+        conn.execute("DELETE FROM sessions WHERE token_hash=?", (token_hash(token),))
+        conn.commit()
+
+# ---------- Credentials ----------
+HASH_WORKERS = credentials01.HASH_WORKERS
+HASH_QUEUE = credentials01.HASH_QUEUE
+HASH_TIMEOUT = credentials01.HASH_TIMEOUT
+
+hasher = None   # Hasher process pool while the server runs; inline otherwise
+
+def hash_credentials(password):
+    start = time.perf_counter()
     try:
-        data = conn.recv(4096)
-        if not data:
-            return None, buffer
-        buffer += data.decode("utf-8", errors="ignore")
-        msgs = []
-        while "\n" in buffer:
-            idx = buffer.index("\n")
-            raw = buffer[:idx].strip()
-            buffer = buffer[idx+1:]
-            if not raw:
-                continue
+        if hasher is None:
+            return credentials01.hash_password(password)
+        return hasher.hash(password)
+    finally:
+        HASH_SECONDS.observe(time.perf_counter() - start, "hash")
+
+def check_credentials(stored, password):
+    """(ok, replacement hash or None); raises CredentialError when the pool
+    is saturated or too slow."""
+    start = time.perf_counter()
+    try:
+        if hasher is None:
+            return credentials01.verify_and_upgrade(stored, password)
+        return hasher.verify(stored, password)
+    finally:
+        HASH_SECONDS.observe(time.perf_counter() - start, "verify")
+
+# ---------- Message stores ----------
+STORE_ENGINE = "sqlite"   # where undelivered private messages wait: "sqlite", "log" or "memory"
+LOG_DIR = None            # log engine directory; DB_FILE + ".log" when unset
+LOG_PARTITIONS = messagelog01.PARTITIONS
+LOG_SEGMENT_BYTES = messagelog01.SEGMENT_BYTES
+MIGRATE_LOG = False       # --store sqlite: move a log left by --store log back into the database
+
+message_store = None
+message_store_lock = threading.Lock()
+
+def log_dir():
+    return LOG_DIR or DB_FILE + ".log"
+
+class SqliteStore:
+    """The delivered flag on each messages row, set by an UPDATE on delivery."""
+
+    name = "sqlite"
+
+    def __init__(self):
+        # switching back from the log engine: only on request, since it deletes the log
+        if os.path.isdir(log_dir()):
+            if MIGRATE_LOG:
+                migrate_log(log_dir())
+            else:
+                print(f"[SERVER] {log_dir()} is a message log left by --store log; its undelivered "
+                      "messages are not served by --store sqlite. Start once with --migrate-log to move them back.")
+
+    def append(self, rows):
+        return insert_messages(rows)
+
+    def pending(self, recipient, limit):
+        return fetch_undelivered(recipient, 0, limit)
+
+    def since(self, recipient, after_id, limit):
+        return fetch_since(recipient, after_id, limit)
+
+    def consume(self, recipient, rows):
+        mark_delivered_range(recipient, rows[0][0], rows[-1][0])
+
+    def unconsume(self, recipient, row):
+        mark_undelivered(row[0])
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+def migrate_log(path):
+    """Flag the log's undelivered messages delivered=0 again, then delete
+    the log, but only once every one of them is confirmed flagged."""
+    log = MessageLog(path)
+    pending = sorted({mid for ids in log.all_pending().values() for mid in ids})
+    log.close()
+    mark_delivered(pending, delivered=0)
+    flagged = count_undelivered(pending)
+    if flagged != len(pending):
+        print(f"[SERVER] kept {path}: only {flagged} of its {len(pending)} undelivered messages "
+              "are in the database")
+        return
+    shutil.rmtree(path)
+    print(f"[SERVER] moved {len(pending)} undelivered messages from {path} back to the database and removed it")
+
+
+class LogStore:
+    """Undelivered messages in an append-only MessageLog, consumed by
+    offset; the messages table becomes an insert-only archive that history,
+    search and resume read, and is never updated on delivery."""
+
+    name = "log"
+
+    def __init__(self, path):
+        self.log = MessageLog(path, LOG_PARTITIONS, LOG_SEGMENT_BYTES, sync=not RELAXED_DURABILITY)
+        # messages the sqlite engine left pending move into the log, once
+        rows = fetch_all_undelivered()
+        if rows:
+            known = {}
+            entries = []
+            for mid, recipient, sender, message, timestamp in rows:
+                if recipient not in known:
+                    known[recipient] = self.log.pending_ids(recipient)
+                if mid not in known[recipient]:
+                    entries.append((recipient, (mid, sender, message, timestamp)))
+            self.log.append(entries)
+            mark_delivered([r[0] for r in rows])
+
+    def append(self, rows):
+        # a row stays delivered=0 until the log holds it, so a crash in
+        # between leaves it for the migration in __init__ at the next start
+        ids = insert_messages(rows)
+        entries = [(row[1], (mid, row[0], row[2], row[3])) for mid, row in zip(ids, rows) if not row[5]]
+        self.log.append(entries)
+        mark_delivered([row[0] for _, row in entries])
+        return ids
+
+    def pending(self, recipient, limit):
+        return self.log.pending(recipient, limit)
+
+    def since(self, recipient, after_id, limit):
+        return fetch_since(recipient, after_id, limit)
+
+    def consume(self, recipient, rows):
+        self.log.consume(recipient, [r[0] for r in rows])
+
+    def unconsume(self, recipient, row):
+        self.log.append([(recipient, tuple(row))])
+
+    def stats(self):
+        return self.log.stats()
+
+    def close(self):
+        self.log.close()
+
+
+class MemoryStore:
+    """Everything in process memory, for tests and benchmarks: no database
+    writes, nothing survives a restart, and history/search see none of it."""
+
+    name = "memory"
+
+    def __init__(self):
+        # ids keep rising across restarts, so resume cursors stay meaningful
+        self._ids = count(int(time.time() * 1000))
+        self._inbox = {}     # recipient -> every row, by id
+        self._pending = {}   # recipient -> deque of rows not yet delivered
+        self._lock = threading.Lock()
+
+    def append(self, rows):
+        ids = []
+        with self._lock:
+            for sender, recipient, message, timestamp, _, delivered in rows:
+                row = (next(self._ids), sender, message, timestamp)
+                self._inbox.setdefault(recipient, []).append(row)
+                if not delivered:
+                    self._pending.setdefault(recipient, deque()).append(row)
+                ids.append(row[0])
+        return ids
+
+    def pending(self, recipient, limit):
+        with self._lock:
+            return list(islice(self._pending.get(recipient) or (), limit if limit >= 0 else None))
+
+    def since(self, recipient, after_id, limit):
+        with self._lock:
+            rows = self._inbox.get(recipient) or []
+            start = bisect.bisect_left(rows, (after_id + 1,))
+            return rows[start:start + limit] if limit >= 0 else rows[start:]
+
+    def consume(self, recipient, rows):
+        ids = {r[0] for r in rows}
+        with self._lock:
+            queue = self._pending.get(recipient)
+            while queue and queue[0][0] in ids:
+                queue.popleft()
+
+    def unconsume(self, recipient, row):
+        with self._lock:
+            queue = self._pending.setdefault(recipient, deque())
+            queue.append(tuple(row))
+            if len(queue) > 1 and queue[-2][0] > row[0]:
+                self._pending[recipient] = deque(sorted(queue))
+
+    def stats(self):
+        with self._lock:
+            return {"pending": sum(len(q) for q in self._pending.values())}
+
+    def close(self):
+        pass
+
+
+def open_store():
+    if STORE_ENGINE == "log":
+        return LogStore(log_dir())
+    if STORE_ENGINE == "memory":
+        return MemoryStore()
+    return SqliteStore()
+
+def store():
+    global message_store
+    if message_store is None:
+        with message_store_lock:
+            if message_store is None:
+                message_store = open_store()
+    return message_store
+
+def store_stat(name):
+    return message_store.stats().get(name, 0) if message_store is not None else 0
+
+def close_store():
+    global message_store
+    with message_store_lock:
+        s, message_store = message_store, None
+    if s is not None:
+        s.close()
+
+# ---------- Offline write-behind ----------
+WRITE_BATCH = 256          # most rows committed in one transaction
+WRITE_WINDOW_MS = 0        # extra wait for a batch to fill; 0 commits what queued during the last commit
+RELAXED_DURABILITY = False # True: ack "stored" before the row is committed
+
+offline_writer = None
+
+class OfflineWriter:
+    """Single writer thread that group-commits queued message rows.
+
+    submit() returns a Future that resolves to the row's id once its
+    transaction has committed, so many senders share one commit (and one
+    fsync). Live messages go through it too, since history keeps them all.
+    """
+
+    _STOP = object()
+
+    def __init__(self, batch=WRITE_BATCH, window_ms=WRITE_WINDOW_MS):
+        self.batch = batch
+        self.window = window_ms / 1000.0
+        self._q = queue.Queue()
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="offline-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        fut = Future()
+        with self._pending_lock:
+            if not self._closed:
+                self._pending += 1
+                self._q.put((row, fut))
+                return fut
+        # late writers during shutdown commit on their own thread
+        fut.set_result(store().append([row])[0])
+        return fut
+
+    def depth(self):
+        return self._pending
+
+    def barrier(self):
+        """Block until every row submitted so far is committed."""
+        with self._pending_lock:
+            if not self._pending:
+                return
+        fut = Future()
+        self._q.put((None, fut))
+        fut.result()
+
+    def close(self):
+        with self._pending_lock:
+            self._closed = True
+            self._q.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._q.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch:
+                try:
+                    item = self._q.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._q.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # drain whatever was queued behind the stop marker
+        rest = []
+        while True:
             try:
-                msgs.append(json.loads(raw))
-            except json.JSONDecodeError:
-                continue
-        return msgs, buffer
-    except ConnectionResetError:
-        return None, buffer
-    except Exception:
-        return None, buffer
-
-# ---------- Broadcast online users ----------
-def broadcast_online():
-    users = list(connections.keys())
-    payload = {"action": "update_users", "users": users}
-    to_remove = []
-    with lock:
-        for uname, (c, _) in list(connections.items()):
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rest.append(item)
+        if rest:
+            self._flush(rest)
+
+    def _flush(self, batch):
+        rows = [row for row, _ in batch if row is not None]
+        error = None
+        ids = iter(())
+        if rows:
+            WRITE_BATCH_ROWS.observe(len(rows))
             try:
-                send_json(c, payload)
-            except Exception:
-                to_remove.append(uname)
-        for u in to_remove:
+                ids = iter(store().append(rows))
+            except Exception as e:
+                error = e
+        with self._pending_lock:
+            self._pending -= len(rows)
+        for row, fut in batch:
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(next(ids) if row is not None else None)
+
+# ---------- Retention ----------
+RETAIN_DELIVERED_DAYS = 0     # delivered private messages older than this are archived and deleted; 0 keeps them
+RETAIN_UNDELIVERED_DAYS = 0   # the same for messages that were never delivered
+ARCHIVE_DIR = None            # gzipped JSON lines of deleted rows; DB_FILE + ".archive" when unset
+MAINTENANCE_SECS = 3600.0     # time between maintenance passes
+MAINTENANCE_CHUNK = 500       # rows archived and deleted per transaction
+MAINTENANCE_PAUSE_MS = 50.0   # sleep between chunks, so handlers are never kept off the database
+VACUUM_PAGES = 256            # free pages handed back per incremental_vacuum step
+
+ARCHIVE_FIELDS = ("id", "sender", "recipient", "message", "timestamp", "sent_at", "delivered")
+
+def archive_dir():
+    return ARCHIVE_DIR or DB_FILE + ".archive"
+
+class ArchiveFile:
+    """One gzipped JSON-lines export per maintenance pass. Every chunk is
+    flushed and fsynced before its rows are deleted, so a crash can only
+    leave a row both archived and still in the table, never neither."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, time.strftime("messages-%Y%m%d-%H%M%S.jsonl.gz"))
+        self._raw = open(self.path, "ab")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="ab")
+
+    def write(self, rows):
+        self._gz.write("".join(json.dumps(dict(zip(ARCHIVE_FIELDS, row)), ensure_ascii=False) + "\n"
+                               for row in rows).encode("utf-8"))
+        self._gz.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self):
+        self._gz.close()
+        self._raw.close()
+
+
+class Maintenance:
+    """Background retention job for the messages table.
+
+    Each pass archives expired rows and deletes them MAINTENANCE_CHUNK at a
+    time, one short transaction each with a pause in between, then returns
+    the freed pages with incremental_vacuum and truncates the WAL. Progress
+    is kept for progress(), the metrics and an admin "maintenance" event.
+    In sharded mode only worker 0 runs it.
+    """
+
+    def __init__(self):
+        self.interval = MAINTENANCE_SECS
+        self._progress = {"state": "idle", "passes": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enabled(self):
+        return RETAIN_DELIVERED_DAYS > 0 or RETAIN_UNDELIVERED_DAYS > 0
+
+    def progress(self):
+        with self._lock:
+            return dict(self._progress)
+
+    def _update(self, **fields):
+        with self._lock:
+            self._progress.update(fields)
+
+    def start(self):
+        if not self.enabled():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
             try:
-                connections[u][0].close()
-            except:
-                pass
-            connections.pop(u, None)
+                self.run_pass()
+            except Exception as e:
+                self._update(state="failed", error=str(e))
+                print(f"[SERVER] Maintenance pass failed: {e}")
+            self._stop.wait(self.interval)
 
-# ---------- Client handler ----------
-def handle_client(conn, addr):
-    buffer = ""
-    logged_user = None
-    try:
-        while True:
-            msgs, buffer = recv_jsons(conn, buffer)
-            if msgs is None:
+    def run_pass(self):
+        started = time.time()
+        self._update(state="archiving", started=started, archived=0, deleted=0,
+                     vacuumed_pages=0, archive=None, error=None)
+        archive = None
+        try:
+            for delivered, days in ((1, RETAIN_DELIVERED_DAYS), (0, RETAIN_UNDELIVERED_DAYS)):
+                if days > 0:
+                    archive = self._expire(delivered, started - days * 86400, archive)
+        finally:
+            if archive is not None:
+                archive.close()
+        if self._stop.is_set():
+            return
+        self._update(state="vacuuming")
+        self._vacuum()
+        self._update(state="checkpointing")
+        with db() as conn:
+            busy, wal_pages, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        with self._lock:
+            self._progress.update(state="idle", finished=time.time(), checkpoint_busy=bool(busy),
+                                  wal_pages=wal_pages, passes=self._progress["passes"] + 1)
+            summary = dict(self._progress)
+        admin_feed.emit("maintenance", **summary)
+
+    def _expire(self, delivered, cutoff, archive):
+        kind = "delivered" if delivered else "undelivered"
+        boundary = expiry_boundary(cutoff)
+        last = 0
+        while not self._stop.is_set():
+            rows = fetch_expired(last, boundary, delivered, MAINTENANCE_CHUNK)
+            if not rows:
                 break
-            for req in msgs:
-                action = req.get("action")
-                if action == "register":
-                    country = req.get("country", "")
-                    phone = req.get("phone", "")
-                    username = req.get("username", "")
-                    password = req.get("password", "")
-                    if not (phone and username and password):
-                        send_json(conn, {"status":"error","message":"Missing registration fields"})
-                        continue
-                    ok, msg = add_user(country, phone, username, password)
-                    if ok:
-                        send_json(conn, {"status":"success","message":msg})
-                    else:
-                        send_json(conn, {"status":"error","message":msg})
+            if archive is None:
+                archive = ArchiveFile(archive_dir())
+                self._update(archive=archive.path)
+            archive.write(rows)
+            gone = delete_messages([r[0] for r in rows], delivered)
+            last = rows[-1][0]
+            RETENTION_ROWS.inc(kind, value=gone)
+            with self._lock:
+                self._progress["archived"] += len(rows)
+                self._progress["deleted"] += gone
+                self._progress["last_id"] = last
+            self._stop.wait(MAINTENANCE_PAUSE_MS / 1000.0)
+        return archive
+
+    def _vacuum(self):
+        with db() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:   # 2: INCREMENTAL
+                return
+        while not self._stop.is_set():
+            with db() as conn:
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free:
+                    break
+                # execute() stops after the pragma's first step (one page);
+                # executescript() runs it to the end
+                conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+            pages = min(free, VACUUM_PAGES)
+            VACUUMED_PAGES.inc(value=pages)
+            with self._lock:
+                self._progress["vacuumed_pages"] += pages
+            self._stop.wait(MAINTENANCE_PAUSE_MS / 1000.0)
+
+maintenance = Maintenance()
+
+# ---------- Sessions ----------
+OUTBOX_HIGH = 256 * 1024        # queued bytes at which a peer counts as congested
+OUTBOX_LOW = 64 * 1024          # ...until its queue drains below this again
+OUTBOX_LIMIT = 4 * 1024 * 1024  # hard cap: evict the peer
+SLOW_EVICT_SECS = 15.0          # evict a peer that stays congested this long
+MAX_IOV = 512                   # buffers per vectored write
+COMPRESS_LEVEL = framing01.COMPRESS_LEVEL   # deflate level for clients that offer it; 0 = never
+COMPRESS_MIN = framing01.COMPRESS_MIN       # payload bytes below which frames are not deflated
+
+def note_compressed(raw, wire):
+    COMPRESSION_BYTES.inc("raw", value=raw)
+    COMPRESSION_BYTES.inc("wire", value=wire)
+
+def sendmsg_all(sock, bufs):
+    if not hasattr(sock, "sendmsg"):
+        # no vectored I/O (Windows)
+        sock.sendall(b"".join(bufs))
+        return
+    views = [memoryview(b) for b in bufs]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + MAX_IOV])
+        while sent and i < len(views):
+            if sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
+
+class ClientSession:
+    """One connected client, independent of the engine that serves it.
+
+    Frames are never written by the routing thread: send() encodes them in
+    the session's negotiated wire format and appends them to a
+    bounded outbox that the session's own writer drains in vectored batches.
+    Past OUTBOX_HIGH the peer is congested and routed messages are parked in
+    offline storage, then replayed once the outbox falls below OUTBOX_LOW.
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.user = None
+        self.token = None              # resumable session token, set at login
+        self.presence_deltas = False   # client understands user_online/user_offline
+        self.batch_delivery = False    # client understands receive_messages
+        self.framing = Framing()
+        self.framing.on_compress = note_compressed
+        self.closed = False
+        self.outbox = deque()
+        self.queued = 0                # bytes accepted but not yet written
+        self.congested_since = None
+        self.diverted = False          # messages for this peer were parked in storage
+        self.redelivering = False
+        self.room_cursors = {}         # room id -> newest post sent to this client
+        self.room_saved = {}           # room id -> cursor as stored in room_members
+        self.rooms_behind = {}         # room id -> newest post skipped; replayed from the cursor
+        self.admin = False             # authenticated admin_subscribe connection
+        self.last_seen = time.monotonic()   # last time anything arrived from the peer
+        self.pinged = False            # a heartbeat ping is outstanding
+        self.heartbeat = False         # the hello offered to answer pings: reaped when it stops
+        self.buckets = {}              # action (or "*") -> TokenBucket for this connection
+        self.strikes = None            # TokenBucket of refusals tolerated before disconnecting
+        self.out_lock = threading.Lock()
+
+    @property
+    def congested(self):
+        return self.congested_since is not None
+
+    def send(self, obj):
+        self.send_shared(obj, None)
+
+    def send_shared(self, obj, cache, then_switch=False):
+        """Queue obj. With a cache (see Framing.encode_shared) shared across
+        recipients, each format is serialized only once; deflate streams are
+        per connection. then_switch adopts obj as a hello reply right after
+        encoding it."""
+        rid = reply_rid(self, obj)
+        if rid is not None:
+            # the shared encoding has no rid in it
+            obj = dict(obj, rid=rid)
+            cache = None
+        with self.out_lock:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            # encode under the lock so a framing switch cannot reorder frames
+            # (and so frames enter the deflate stream in the order they are sent)
+            if cache is None:
+                raw = self.framing.encode(obj)
+            else:
+                raw = self.framing.encode_shared(obj, cache)
+            if then_switch:
+                self.framing.switch(obj)
+            self.outbox.append(raw)
+            self.queued += len(raw)
+            first = len(self.outbox) == 1
+            now = time.monotonic()
+            if self.congested_since is None and self.queued > OUTBOX_HIGH:
+                self.congested_since = now
+            evict = self.queued > OUTBOX_LIMIT or (
+                self.congested_since is not None and now - self.congested_since > SLOW_EVICT_SECS)
+        if evict:
+            self.abort()
+            raise ConnectionError("slow consumer evicted")
+        if first:
+            self._wake()
+
+    def room_accepts(self, room_id, mid):
+        """Whether a live room post can go out now. While the peer is
+        congested, or already replaying the room, the post is only noted."""
+        with self.out_lock:
+            if self.closed or room_id not in self.room_cursors:
+                return False
+            if self.congested or room_id in self.rooms_behind:
+                self.rooms_behind[room_id] = max(self.rooms_behind.get(room_id, 0), mid)
+                return False
+            return True
+
+    def room_seen(self, room_id, mid, replay=False):
+        with self.out_lock:
+            if room_id in self.rooms_behind and not replay:
+                # the replay owns the cursor until it catches up
+                return
+            if room_id in self.room_cursors and mid > self.room_cursors[room_id]:
+                self.room_cursors[room_id] = mid
+
+    def _take(self):
+        with self.out_lock:
+            n = min(len(self.outbox), MAX_IOV)
+            return [self.outbox.popleft() for _ in range(n)]
+
+    def _written(self, nbytes):
+        BYTES_OUT.inc(value=nbytes)
+        with self.out_lock:
+            self.queued -= nbytes
+            drained = self.congested_since is not None and self.queued < OUTBOX_LOW
+            if drained:
+                self.congested_since = None
+        if drained and self.diverted:
+            schedule_redelivery(self)
 
-                elif action == "login":
-                    identifier = req.get("identifier") or req.get("phone") or req.get("username")
-                    password = req.get("password", "")
-                    if not (identifier and password):
-                        send_json(conn, {"status":"error","message":"Missing credentials"})
+    def close(self):
+        """Stop accepting frames; the writer flushes what is queued, then closes."""
+        with self.out_lock:
+            self.closed = True
+        self._wake()
+
+    def abort(self):
+        with self.out_lock:
+            self.closed = True
+            self.outbox.clear()
+            self.queued = 0
+        self._kill()
+
+    def _wake(self):
+        raise NotImplementedError
+
+    def _kill(self):
+        raise NotImplementedError
+
+    def run_blocking(self, fn, *args):
+        raise NotImplementedError
+
+
+class SocketSession(ClientSession):
+    """Blocking socket read by the handler thread, written by its own thread."""
+
+    def __init__(self, conn, addr):
+        super().__init__(addr)
+        self.conn = conn
+        self.out_cond = threading.Condition(self.out_lock)
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _wake(self):
+        with self.out_cond:
+            self.out_cond.notify()
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self.out_cond:
+                    while not self.outbox and not self.closed:
+                        self.out_cond.wait()
+                    if not self.outbox:
+                        break
+                bufs = self._take()
+                sendmsg_all(self.conn, bufs)
+                self._written(sum(map(len, bufs)))
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self._kill()
+
+    def _kill(self):
+        # shutdown also wakes a reader or writer blocked on the socket
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.conn.close()
+        except:
+            pass
+
+    def run_blocking(self, fn, *args):
+        # on the shared pool: the writer thread only ever drains the outbox
+        db_executor.submit(fn, *args)
+
+
+class StreamSession(ClientSession):
+    """asyncio StreamWriter drained by a writer task; safe to use from executor threads."""
+
+    def __init__(self, loop, writer, addr):
+        super().__init__(addr)
+        self.loop = loop
+        self.writer = writer
+        self.thread_id = threading.get_ident()
+        self._ready = asyncio.Event()
+        self._task = loop.create_task(self._write_loop())
+
+    def _on_loop(self):
+        return threading.get_ident() == self.thread_id
+
+    def _wake(self):
+        if self._on_loop():
+            self._ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                bufs = self._take()
+                if not bufs:
+                    if self.closed:
+                        break
+                    self._ready.clear()
+                    if self.outbox or self.closed:
                         continue
-                    ok, username_db = verify_user(identifier, password)
-                    if ok:
-                        logged_user = username_db
-                        with lock:
-                            connections[username_db] = (conn, addr)
-                        send_json(conn, {"status":"success","message":"Login successful","username": username_db})
-                        broadcast_online()
-                        # deliver undelivered messages
-                        undel = fetch_undelivered(username_db)
-                        if undel:
-                            delivered_ids = []
-                            for mid, sender, message, timestamp in undel:
-                                try:
-                                    send_json(conn, {"action":"receive_message","from":sender,"message":message,"timestamp":timestamp})
-                                    delivered_ids.append(mid)
-                                except:
-                                    pass
-                            mark_delivered(delivered_ids)
-                    else:
-                        send_json(conn, {"status":"error","message":"Invalid credentials"})
-
-                elif action == "get_online_users":
-                    with lock:
-                        users = list(connections.keys())
-                    send_json(conn, {"status":"success","users":users})
-
-                elif action == "send_message":
-                    # PRIVATE-only message handling
-                    sender = req.get("from")
-                    recipient = req.get("to")
-                    message = req.get("message", "")
-                    timestamp = req.get("timestamp") or datetime.utcnow().strftime("%I:%M %p")
-                    if not (sender and recipient and message):
-                        send_json(conn, {"status":"error","message":"Missing fields for private message"})
+                    await self._ready.wait()
+                    continue
+                self.writer.writelines(bufs)
+                await asyncio.wait_for(self.writer.drain(), SLOW_EVICT_SECS)
+                self._written(sum(map(len, bufs)))
+        except (OSError, asyncio.TimeoutError):
+            self.abort()
+        finally:
+            self.closed = True
+            self.writer.close()
+
+    def _kill(self):
+        if self._on_loop():
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def run_blocking(self, fn, *args):
+        if self._on_loop():
+            self.loop.run_in_executor(db_executor, fn, *args)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.run_in_executor, db_executor, fn, *args)
+
+def schedule_redelivery(session):
+    """Replay parked messages once the peer can take them again."""
+    with session.out_lock:
+        session.diverted = True
+        stalled = session.congested and time.monotonic() - session.congested_since > SLOW_EVICT_SECS
+        start = not (stalled or session.redelivering or session.congested or session.closed)
+        if start:
+            session.redelivering = True
+    if stalled:
+        session.abort()
+    elif start:
+        session.run_blocking(redeliver, session)
+
+def redeliver(session):
+    while True:
+        with session.out_lock:
+            session.diverted = False
+        deliver_backlog(session)
+        deliver_room_backlog(session)
+        with session.out_lock:
+            if not session.diverted or session.congested or session.closed:
+                session.redelivering = False
+                return
+
+# ---------- Presence ----------
+def online_users():
+    with lock:
+        users = list(connections.keys())
+    local = set(users)
+    users += [u for u in presence.lingering() if u not in local]
+    if bus is not None:
+        local.update(users)
+        users += [u for u in bus.remote_users() if u not in local]
+    return users
+
+PRESENCE_WINDOW_MS = 50   # changes inside this window go out as one update
+
+class Presence:
+    """Coalesces online/offline changes and fans them out as versioned deltas.
+
+    A client gets one full snapshot (update_users) at login, then only
+    user_online / user_offline frames. Every frame carries the version it
+    brings the roster to, so a client that sees a gap asks get_online_users
+    for a fresh snapshot. Clients that did not ask for deltas keep getting
+    the whole roster as update_users. Each payload is encoded once per wire format.
+
+    A user whose connection drops lingers online for RESUME_GRACE seconds;
+    resuming within that time changes nothing anyone can see.
+    """
+
+    def __init__(self, window_ms=PRESENCE_WINDOW_MS):
+        self.window = window_ms / 1000.0
+        self.version = 0
+        self._pending = {}   # username -> online after this window
+        self._linger = {}    # username -> monotonic deadline for going offline
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="presence", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def changed(self, username, online, publish=True):
+        if publish and bus is not None:
+            bus.publish(username, online)
+        with self._cond:
+            if self._pending.get(username, online) != online:
+                # e.g. offline then online again inside one window: no net change
+                del self._pending[username]
+            else:
+                self._pending[username] = online
+            self._cond.notify()
+
+    def changed_many(self, usernames, online, publish=True):
+        # one window, so they all go out in the same update
+        with self._cond:
+            for u in usernames:
+                self.changed(u, online, publish)
+
+    def linger(self, username, secs):
+        with self._cond:
+            self._linger[username] = time.monotonic() + secs
+            self._cond.notify()
+
+    def reclaim(self, username):
+        """True if username was still listed from a dropped connection."""
+        with self._cond:
+            return self._linger.pop(username, None) is not None
+
+    def lingering(self):
+        with self._cond:
+            return list(self._linger)
+
+    def snapshot(self):
+        with self._cond:
+            return online_users(), self.version
+
+    def _run(self):
+        while True:
+            expired = []
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    now = time.monotonic()
+                    expired = [u for u, deadline in self._linger.items() if deadline <= now]
+                    if expired:
+                        break
+                    self._cond.wait(min(self._linger.values()) - now if self._linger else None)
+                if self._stopping:
+                    return
+                for u in expired:
+                    del self._linger[u]
+            if expired:
+                for u in expired:
+                    self.changed(u, False)
+                continue
+            time.sleep(self.window)
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            changes, self._pending = self._pending, {}
+            if not changes:
+                return
+            frames = []
+            for action, state in (("user_online", True), ("user_offline", False)):
+                users = [u for u, online in changes.items() if online == state]
+                if users:
+                    self.version += 1
+                    frames.append(({"action":action,"users":users,"version":self.version}, {}))
+            with lock:
+                targets = list(connections.items())
+            users = online_users()
+            full = ({"action":"update_users","users":users,"version":self.version}, {})
+        for event, state in (("login", True), ("logout", False)):
+            names = [u for u, online in changes.items() if online == state]
+            if names:
+                # every worker flushes every change, so nothing goes on the bus
+                admin_feed.emit(event, publish=False, users=names)
+        start = time.perf_counter()
+        dead = []
+        for uname, s in targets:
+            try:
+                if s.presence_deltas:
+                    for obj, cache in frames:
+                        s.send_shared(obj, cache)
+                else:
+                    s.send_shared(*full)
+            except Exception:
+                dead.append((uname, s))
+        FANOUT_SECONDS.observe(time.perf_counter() - start)
+        FANOUT_RECIPIENTS.inc(value=len(targets))
+        for uname, s in dead:
+            s.close()
+            with lock:
+                gone = connections.get(uname) is s
+                if gone:
+                    connections.pop(uname, None)
+            if gone:
+                self.changed(uname, False)
+
+presence = Presence()
+
+# ---------- Admin feed ----------
+ADMIN_TOKEN = os.environ.get("CHAT_ADMIN_TOKEN")   # unset: admin actions are refused
+ADMIN_STATS_SECS = 2.0   # queue depths are sampled this often, and sent when they change
+
+def admin_authorized(session, req):
+    if session.admin:
+        return True
+    token = req.get("admin_token")
+    return bool(ADMIN_TOKEN) and isinstance(token, str) and \
+        hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def queue_depths():
+    with lock:
+        sessions = list(connections.values())
+    return {"worker": bus.worker_id if bus is not None else 0,
+            "connections": len(sessions),
+            "outbox_bytes": sum(s.queued for s in sessions),
+            "congested": sum(1 for s in sessions if s.congested),
+            "write_queue": offline_writer.depth() if offline_writer is not None else 0,
+            "hash_queue": hasher.depth() if hasher is not None else 0}
+
+class AdminFeed:
+    """Pushes admin_event frames to subscribed admin connections, so admin
+    tools follow the server instead of polling the database.
+
+    Registrations and deletions happen on one worker and cross the bus;
+    logins and logouts come from the presence flush, which every worker
+    runs for every change; each worker samples its own queue depths.
+    """
+
+    def __init__(self):
+        self.interval = ADMIN_STATS_SECS
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, session):
+        with self._lock:
+            self._subs.add(session)
+
+    def unsubscribe(self, session):
+        with self._lock:
+            self._subs.discard(session)
+
+    def emit(self, event, publish=True, **fields):
+        frame = {"action":"admin_event","event":event,"time":time.time(), **fields}
+        if publish and bus is not None:
+            bus.admin_event(frame)
+        self.deliver(frame)
+
+    def deliver(self, frame):
+        with self._lock:
+            subs = list(self._subs)
+        cache = {}
+        for s in subs:
+            try:
+                s.send_shared(frame, cache)
+            except Exception:
+                self.unsubscribe(s)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="admin-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                watched = bool(self._subs)
+            # a worker cannot see subscribers on other workers, so it always reports
+            if not watched and bus is None:
+                continue
+            sample = queue_depths()
+            if sample != self._last:
+                self._last = sample
+                self.emit("queue_depth", **sample)
+
+admin_feed = AdminFeed()
+
+# ---------- Heartbeats ----------
+HEARTBEAT_SECS = 25.0   # a connection silent this long is sent a ping
+IDLE_TIMEOUT = 75.0     # ...and one silent this long is closed; 0 disables both
+WHEEL_TICK = 0.5        # resolution of the idle deadlines, seconds
+KEEPALIVE_IDLE = 60     # TCP keepalive for every connection: probes after this many idle seconds,
+KEEPALIVE_INTERVAL = 15 # ...this far apart,
+KEEPALIVE_PROBES = 4    # ...and the kernel drops the connection after this many go unanswered
+
+def enable_keepalive(sock):
+    # clients that cannot answer pings are only ever dropped by TCP
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for opt, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                       ("TCP_KEEPCNT", KEEPALIVE_PROBES)):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+class TimerWheel:
+    """Hierarchical timing wheel: schedule, cancel and each expiry are O(1)
+    whatever the number of timers.
+
+    Level 0 has one slot per tick; each slot of a higher level spans a whole
+    turn of the level below and is cascaded down into it when that turn
+    begins. Deadlines past the top level are parked in its furthest slot and
+    placed again when they come round.
+    """
+
+    def __init__(self, tick, sizes=(256, 64, 64)):
+        self.tick = tick
+        self._tick = int(time.monotonic() / tick)   # last tick processed
+        self._sizes = sizes
+        self._shifts = [0]
+        for size in sizes[:-1]:
+            self._shifts.append(self._shifts[-1] + size.bit_length() - 1)
+        self._span = 1 << (self._shifts[-1] + sizes[-1].bit_length() - 1)
+        self._slots = [[{} for _ in range(size)] for size in sizes]
+        self._where = {}   # key -> (level, slot, expires tick)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._where)
+
+    def _place(self, key, expires):
+        delta = min(max(expires - self._tick, 0), self._span - 1)
+        at = self._tick + delta
+        level = 0
+        while level < len(self._sizes) - 1 and delta >= 1 << self._shifts[level + 1]:
+            level += 1
+        idx = (at >> self._shifts[level]) % self._sizes[level]
+        self._slots[level][idx][key] = expires
+        self._where[key] = (level, idx, expires)
+
+    def schedule(self, key, when):
+        """(Re)arm key's timer for monotonic time `when`."""
+        expires = max(-int(-when // self.tick), self._tick + 1)
+        with self._lock:
+            old = self._where.get(key)
+            if old is not None:
+                del self._slots[old[0]][old[1]][key]
+            self._place(key, expires)
+
+    def cancel(self, key):
+        with self._lock:
+            old = self._where.pop(key, None)
+            if old is not None:
+                del self._slots[old[0]][old[1]][key]
+
+    def advance(self, now):
+        """Keys whose deadline passed by monotonic time `now`; they are disarmed."""
+        target = int(now / self.tick)
+        due = []
+        with self._lock:
+            while self._tick < target:
+                self._tick += 1
+                # cascade top-down, each level only when the one below starts a new turn
+                for level in range(len(self._sizes) - 1, 0, -1):
+                    if self._tick & ((1 << self._shifts[level]) - 1):
                         continue
-                    with lock:
-                        target = connections.get(recipient)
-                    if target:
-                        try:
-                            target_conn, _ = target
-                            send_json(target_conn, {"action":"receive_message","from":sender,"message":message,"timestamp":timestamp})
-                            # ack to sender
-                            send_json(conn, {"status":"success","message":"Delivered"})
-                        except Exception:
-                            # if sending fails, store for later
-                            store_message(sender, recipient, message, timestamp)
-                            send_json(conn, {"status":"success","message":"Stored for later delivery"})
+                    idx = (self._tick >> self._shifts[level]) % self._sizes[level]
+                    slot, self._slots[level][idx] = self._slots[level][idx], {}
+                    for key, expires in slot.items():
+                        self._place(key, expires)
+                slot = self._slots[0][self._tick % self._sizes[0]]
+                self._slots[0][self._tick % self._sizes[0]] = {}
+                for key, expires in slot.items():
+                    if expires > self._tick:
+                        self._place(key, expires)   # parked beyond the top level
                     else:
-                        # store for offline recipient
-                        store_message(sender, recipient, message, timestamp)
-                        send_json(conn, {"status":"success","message":"Recipient offline — stored"})
-
-                elif action == "view_users":
-                    users = get_registered_users()
-                    send_json(conn, {"status":"success","users":users})
-
-                elif action == "delete_user":
-                    username = req.get("username")
-                    if username:
-                        delete_user_db(username)
-                        with lock:
-                            if username in connections:
-                                try:
-                                    connections[username][0].close()
-                                except:
-                                    pass
-                                connections.pop(username, None)
-                        broadcast_online()
-                        send_json(conn, {"status":"success","message":"Deleted"})
+                        del self._where[key]
+                        due.append(key)
+        return due
+
+PING = {"action":"ping"}
+
+class Heartbeats:
+    """Idle deadlines for every connection that said in its hello that it
+    answers pings, on one TimerWheel served by a single thread, so 100k
+    connections cost no timers of their own. Older clients never get a
+    ping and are never reaped for being quiet; TCP keepalive finds the
+    dead ones.
+
+    Receiving only stores session.last_seen; the wheel holds one entry per
+    session and, when it fires, compares the deadline with last_seen and
+    re-arms it if the peer was heard from since. A peer quiet for
+    HEARTBEAT_SECS is sent a ping; one quiet for IDLE_TIMEOUT is closed, and
+    everyone reaped in a tick goes offline in a single presence update.
+    """
+
+    def __init__(self):
+        self.interval = HEARTBEAT_SECS
+        self.timeout = IDLE_TIMEOUT
+        self.wheel = TimerWheel(WHEEL_TICK)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def track(self, session):
+        if self.timeout > 0:
+            self.wheel.schedule(session, session.last_seen + min(self.interval, self.timeout))
+
+    def untrack(self, session):
+        self.wheel.cancel(session)
+
+    def start(self):
+        self._stop.clear()
+        if self.timeout > 0:
+            self._thread = threading.Thread(target=self._run, name="heartbeats", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.wheel.tick):
+            self.check(time.monotonic())
+
+    def check(self, now):
+        expired = []
+        for s in self.wheel.advance(now):
+            if s.closed:
+                continue
+            quiet = now - s.last_seen
+            if quiet >= self.timeout:
+                expired.append(s)
+                continue
+            if quiet >= self.interval and not s.pinged:
+                s.pinged = True
+                try:
+                    s.send(PING)
+                except Exception:
+                    expired.append(s)
+                    continue
+            deadline = self.timeout if s.pinged else self.interval
+            self.wheel.schedule(s, s.last_seen + deadline)
+        if expired:
+            reap(expired)
+
+def reap(sessions):
+    """Close dead peers. They could not resume anyway, so nobody lingers."""
+    gone = []
+    with lock:
+        for s in sessions:
+            if s.user and connections.get(s.user) is s:
+                connections.pop(s.user, None)
+                gone.append(s.user)
+    for s in sessions:
+        s.abort()
+    IDLE_REAPED.inc(value=len(sessions))
+    presence.changed_many(gone, False)
+
+def heard_from(session):
+    session.last_seen = time.monotonic()
+    session.pinged = False
+
+heartbeats = Heartbeats()
+
+# ---------- Rooms ----------
+ROOM_NAME_MAX = 64
+
+@timed_db
+def create_room_db(name, owner):
+    try:
+        with db() as conn:
+            cur = conn.execute("INSERT INTO rooms (name, owner) VALUES (?, ?)", (name, owner))
+            conn.commit()
+            return cur.lastrowid
+    except sqlite3.IntegrityError:
+        return None
+
+@timed_db
+def find_room(name):
+    with db() as conn:
+        row = conn.execute("SELECT id FROM rooms WHERE name=?", (name,)).fetchone()
+    return row[0] if row else None
+
+@timed_db
+def load_room_members(room_id):
+    with db() as conn:
+        return [r[0] for r in conn.execute("SELECT username FROM room_members WHERE room_id=?", (room_id,))]
+
+@timed_db
+def load_memberships(username):
+    with db() as conn:
+        return conn.execute("SELECT m.room_id, r.name, m.last_read FROM room_members m "
+                            "JOIN rooms r ON r.id = m.room_id WHERE m.username=?", (username,)).fetchall()
+
+@timed_db
+def join_room_db(room_id, username):
+    # new members start at the newest post, not at the room's whole history
+    with db() as conn:
+        conn.execute("INSERT OR IGNORE INTO room_members (room_id, username, last_read) "
+                     "VALUES (?, ?, (SELECT IFNULL(MAX(id), 0) FROM room_messages WHERE room_id=?))",
+                     (room_id, username, room_id))
+        conn.commit()
+        return conn.execute("SELECT last_read FROM room_members WHERE room_id=? AND username=?",
+                            (room_id, username)).fetchone()[0]
+
+@timed_db
+def leave_room_db(room_id, username):
+    with db() as conn:
+        conn.execute("DELETE FROM room_members WHERE room_id=? AND username=?", (room_id, username))
+        conn.commit()
+
+@timed_db
+def insert_room_message(room_id, sender, message, timestamp):
+    with db() as conn:
+        cur = conn.execute("INSERT INTO room_messages (room_id, sender, message, timestamp, sent_at) "
+                           "VALUES (?, ?, ?, ?, ?)", (room_id, sender, message, timestamp, time.time()))
+        conn.commit()
+        return cur.lastrowid
+
+@timed_db
+def fetch_room_since(room_id, after_id, limit=-1):
+    with db() as conn:
+        return conn.execute("SELECT id, sender, message, timestamp FROM room_messages "
+                            "WHERE room_id=? AND id>? ORDER BY id ASC LIMIT ?",
+                            (room_id, after_id, limit)).fetchall()
+
+@timed_db
+def save_room_cursors(username, cursors):
+    with db() as conn:
+        conn.executemany("UPDATE room_members SET last_read=? WHERE room_id=? AND username=? AND last_read<?",
+                         [(last, room_id, username, last) for room_id, last in cursors])
+        conn.commit()
+
+class RoomDirectory:
+    """Room names and member sets, cached in memory so a post is routed
+    without a query. The database stays the source of truth; joins and
+    leaves on other workers arrive over the bus."""
+
+    def __init__(self):
+        self._ids = {}       # name -> id
+        self._names = {}     # id -> name
+        self._members = {}   # id -> set of usernames
+        self._lock = threading.Lock()
+
+    def lookup(self, name):
+        with self._lock:
+            room_id = self._ids.get(name)
+        if room_id is None:
+            room_id = find_room(name)
+            if room_id is not None:
+                self.named(room_id, name)
+        return room_id
+
+    def named(self, room_id, name):
+        with self._lock:
+            self._ids[name] = room_id
+            self._names[room_id] = name
+
+    def name(self, room_id):
+        with self._lock:
+            return self._names.get(room_id)
+
+    def members(self, room_id):
+        with self._lock:
+            members = self._members.get(room_id)
+            if members is not None:
+                return list(members)
+        loaded = set(load_room_members(room_id))
+        with self._lock:
+            members = self._members.setdefault(room_id, loaded)
+            return list(members)
+
+    def is_member(self, room_id, username):
+        return username in self.members(room_id)
+
+    def changed(self, room_id, username, member):
+        with self._lock:
+            members = self._members.get(room_id)
+            if members is None:
+                return
+            if member:
+                members.add(username)
+            else:
+                members.discard(username)
+
+    def forget_user(self, username):
+        with self._lock:
+            for members in self._members.values():
+                members.discard(username)
+
+rooms = RoomDirectory()
+
+def room_state_for(session):
+    """Load the user's rooms and cursors; every room starts out behind so
+    deliver_room_backlog replays what arrived while the user was away."""
+    for room_id, name, last_read in load_memberships(session.user):
+        rooms.named(room_id, name)
+        session.room_cursors[room_id] = session.room_saved[room_id] = last_read
+        session.rooms_behind[room_id] = 0
+
+def user_rooms(session):
+    return sorted(n for n in (rooms.name(r) for r in session.room_cursors) if n)
+
+def fanout_room(room_id, frame, publish=True):
+    """Queue one post for every online member, encoded once per wire format.
+    Congested members are skipped and catch up from their cursor."""
+    start = time.perf_counter()
+    mid = frame["id"]
+    members = rooms.members(room_id)
+    with lock:
+        targets = [s for s in (connections.get(u) for u in members) if s is not None]
+    cache = {}
+    live = behind = 0
+    for s in targets:
+        if s.user == frame.get("from"):
+            s.room_seen(room_id, mid)
+            continue
+        if not s.room_accepts(room_id, mid):
+            behind += 1
+            schedule_redelivery(s)
+            continue
+        try:
+            s.send_shared(frame, cache)
+            s.room_seen(room_id, mid)
+            live += 1
+        except Exception:
+            pass
+    ROOM_FANOUT_SECONDS.observe(time.perf_counter() - start)
+    ROOM_RECIPIENTS.inc("live", value=live)
+    ROOM_RECIPIENTS.inc("behind", value=behind)
+    if publish and bus is not None:
+        bus.room_post(room_id, frame)
+
+def deliver_room_backlog(session):
+    """Replay each room the session is behind in, from its cursor."""
+    for room_id in list(session.rooms_behind):
+        name = rooms.name(room_id)
+        while True:
+            with session.out_lock:
+                if session.congested:
+                    session.diverted = True
+                    return
+                cursor = session.room_cursors.get(room_id, 0)
+            rows = fetch_room_since(room_id, cursor, BACKLOG_PAGE)
+            if rows:
+                msgs = [{"id":mid,"from":sender,"message":message,"timestamp":timestamp}
+                        for mid, sender, message, timestamp in rows]
+                try:
+                    if session.batch_delivery:
+                        session.send({"action":"room_messages","room":name,"messages":msgs})
                     else:
-                        send_json(conn, {"status":"error","message":"username required"})
-
-                elif action == "logout":
-                    username = req.get("username")
-                    if username:
-                        with lock:
-                            if username in connections:
-                                try:
-                                    connections[username][0].close()
-                                except:
-                                    pass
-                                connections.pop(username, None)
-                        broadcast_online()
-                    send_json(conn, {"status":"success","message":"Logged out"})
+                        for m in msgs:
+                            session.send({"action":"room_message","room":name, **m})
+                except Exception:
                     return
+                session.room_seen(room_id, rows[-1][0], replay=True)
+            if len(rows) < BACKLOG_PAGE:
+                # caught up unless a live post was skipped meanwhile
+                with session.out_lock:
+                    if session.rooms_behind.get(room_id, 0) <= session.room_cursors.get(room_id, 0):
+                        session.rooms_behind.pop(room_id, None)
+                        break
 
-                else:
-                    send_json(conn, {"status":"error","message":"Unknown action"})
-    except Exception:
-        pass
+def flush_room_cursors(session):
+    with session.out_lock:
+        moved = [(r, c) for r, c in session.room_cursors.items() if c > session.room_saved.get(r, 0)]
+    if not moved:
+        return
+    try:
+        save_room_cursors(session.user, moved)
+        with session.out_lock:
+            session.room_saved.update(moved)
+    except Exception as e:
+        ERRORS.inc("room_cursors", type(e).__name__)
+
+def valid_room_name(name):
+    return isinstance(name, str) and 0 < len(name.strip()) <= ROOM_NAME_MAX
+
+# ---------- History ----------
+HISTORY_PAGE = 50    # messages per history/search reply unless the client asks for fewer
+HISTORY_MAX = 200
+NEWEST = 2 ** 63 - 1 # "before" cursor of the first page
+
+# Pages are keyset-paginated on the message id: the client passes the
+# oldest id it holds as "before", and each query is one index seek plus
+# limit rows, however deep into the history it is.
+
+@timed_db
+def fetch_conversation(user, peer, before, limit):
+    # the WHERE terms match idx_messages_conversation's expressions exactly
+    lo, hi = sorted((user, peer))
+    with db() as conn:
+        return conn.execute("SELECT id, sender, recipient, message, timestamp, sent_at FROM messages "
+                            "WHERE min(sender, recipient)=? AND max(sender, recipient)=? AND id<? "
+                            "ORDER BY id DESC LIMIT ?", (lo, hi, before, limit)).fetchall()
+
+@timed_db
+def fetch_room_history(room_id, before, limit):
+    with db() as conn:
+        return conn.execute("SELECT id, sender, NULL, message, timestamp, sent_at FROM room_messages "
+                            "WHERE room_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                            (room_id, before, limit)).fetchall()
+
+@timed_db
+def search_messages(user, query, before, limit):
+    # the FTS index yields matches newest first; rows of other people's
+    # conversations are filtered out on the way
+    with db() as conn:
+        return conn.execute("SELECT m.id, m.sender, m.recipient, m.message, m.timestamp, m.sent_at "
+                            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                            "WHERE messages_fts MATCH ? AND messages_fts.rowid<? "
+                            "AND (m.sender=? OR m.recipient=?) ORDER BY messages_fts.rowid DESC LIMIT ?",
+                            (query, before, user, user, limit)).fetchall()
+
+@timed_db
+def search_room(room_id, query, before, limit):
+    with db() as conn:
+        return conn.execute("SELECT m.id, m.sender, NULL, m.message, m.timestamp, m.sent_at "
+                            "FROM room_messages_fts JOIN room_messages m ON m.id = room_messages_fts.rowid "
+                            "WHERE room_messages_fts MATCH ? AND room_messages_fts.rowid<? AND m.room_id=? "
+                            "ORDER BY room_messages_fts.rowid DESC LIMIT ?",
+                            (query, before, room_id, limit)).fetchall()
+
+def fts_query(text):
+    """User words as quoted FTS5 terms, all required, so no input is parsed
+    as query syntax. A trailing * keeps its prefix meaning."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"%s"%s' % (word.replace('"', '""'), "*" if prefix else ""))
+    return " ".join(terms)
+
+def history_rows(rows):
+    out = []
+    for mid, sender, recipient, message, timestamp, sent_at in rows:
+        m = {"id":mid,"from":sender,"message":message,"timestamp":timestamp,"sent_at":sent_at}
+        if recipient is not None:
+            m["to"] = recipient
+        out.append(m)
+    return out
+
+def page_args(req):
+    try:
+        before = int(req.get("before") or NEWEST)
+        limit = min(HISTORY_MAX, max(1, int(req.get("limit") or HISTORY_PAGE)))
+    except (TypeError, ValueError):
+        return None, None
+    return before, limit
+
+def handle_history_action(session, action, req):
+    if not session.user:
+        session.send({"status":"error","message":"Login required"})
+        return
+    before, limit = page_args(req)
+    if before is None:
+        session.send({"status":"error","message":"Invalid page"})
+        return
+    room_id = None
+    name = req.get("room")
+    if name is not None:
+        room_id = rooms.lookup(name.strip()) if valid_room_name(name) else None
+        if room_id is None or not rooms.is_member(room_id, session.user):
+            session.send({"status":"error","message":"Not a member of this room"})
+            return
+
+    if action == "history":
+        peer = req.get("with")
+        if room_id is not None:
+            rows = fetch_room_history(room_id, before, limit)
+        elif isinstance(peer, str) and peer:
+            rows = fetch_conversation(session.user, peer, before, limit)
+        else:
+            session.send({"status":"error","message":"history needs \"with\" or \"room\""})
+            return
+        reply = {"status":"success","action":"history","messages":history_rows(reversed(rows))}
+        reply.update({"room":name.strip()} if room_id is not None else {"with":peer})
+    else:
+        query = fts_query(req.get("query") or "") if isinstance(req.get("query"), str) else ""
+        if not query:
+            session.send({"status":"error","message":"Empty search"})
+            return
+        if not fts_enabled:
+            session.send({"status":"error","message":"Search is not available"})
+            return
+        if room_id is not None:
+            rows = search_room(room_id, query, before, limit)
+        else:
+            rows = search_messages(session.user, query, before, limit)
+        # search results stay newest first
+        reply = {"status":"success","action":"search","query":req.get("query"),"messages":history_rows(rows)}
+        if room_id is not None:
+            reply["room"] = name.strip()
+    # the oldest id returned is the "before" of the next page; None at the end
+    reply["next"] = min(r[0] for r in rows) if len(rows) == limit else None
+    session.send(reply)
+
+# ---------- Rate limits ----------
+RATE_LIMITS_ENABLED = True
+# per connection: action -> (requests per second, burst); "*" covers actions not listed
+RATE_LIMITS = {"*": (50.0, 200), "send_message": (20.0, 50), "room_post": (20.0, 50),
+               "send_batch": (2.0, 5), "view_users": (2.0, 10), "history": (10.0, 30), "search": (2.0, 10),
+               "register": (0.5, 5), "login": (1.0, 10), "resume": (1.0, 10)}
+# per user, across all of that user's connections on this process
+USER_RATE_LIMITS = {"send_message": (30.0, 80), "room_post": (30.0, 80), "send_batch": (4.0, 10),
+                    "view_users": (4.0, 20),
+                    "history": (20.0, 60), "search": (4.0, 20)}
+ABUSE_STRIKES = 50       # refused requests in a row (allowing ABUSE_FORGIVE/s) before disconnecting
+ABUSE_FORGIVE = 5.0
+USER_BUCKETS_MAX = 100000
+
+class TokenBucket:
+    """rate tokens per second, holding at most burst. Refilled lazily when
+    taken from, so an idle bucket costs nothing."""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, now):
+        """0 if a token was taken, otherwise seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+user_buckets = {}   # username -> {action: TokenBucket}
+buckets_lock = threading.Lock()
+
+def take_token(buckets, limits, action, now):
+    key = action if action in limits else "*"
+    limit = limits.get(key)
+    if limit is None:
+        return 0.0
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = TokenBucket(limit[0], limit[1], now)
+    return bucket.take(now)
+
+def prune_user_buckets(now):
+    # caller holds buckets_lock; users whose buckets have all refilled lose nothing
+    for name in [u for u, b in user_buckets.items() if all(x.idle(now) for x in b.values())]:
+        del user_buckets[name]
+
+def admit(session, req):
+    """Charge one request to the connection's and the user's buckets before
+    it is dispatched. Returns False if it was refused: the client gets a
+    throttle reply, and one that keeps going is closed (session.closed)."""
+    if not RATE_LIMITS_ENABLED:
+        return True
+    action = req.get("action")
+    now = time.monotonic()
+    # only listed actions and "*" ever get a bucket, whatever the client sends
+    wait = take_token(session.buckets, RATE_LIMITS, action, now)
+    scope = "connection"
+    if not wait and session.user and action in USER_RATE_LIMITS:
+        with buckets_lock:
+            buckets = user_buckets.get(session.user)
+            if buckets is None:
+                if len(user_buckets) >= USER_BUCKETS_MAX:
+                    prune_user_buckets(now)
+                buckets = user_buckets[session.user] = {}
+            wait = take_token(buckets, USER_RATE_LIMITS, action, now)
+        scope = "user"
+    if not wait:
+        return True
+    label = action if action in KNOWN_ACTIONS else "unknown"
+    THROTTLED.inc(label, scope)
+    if session.strikes is None:
+        session.strikes = TokenBucket(ABUSE_FORGIVE, ABUSE_STRIKES, now)
+    try:
+        with answering(session, req):
+            session.send({"status":"error","message":"Too many requests","throttled":label,
+                          "retry_after":round(wait, 3)})
+    except ConnectionError:
+        return False
+    if session.strikes.take(now):
+        THROTTLE_DISCONNECTS.inc()
+        admin_feed.emit("throttled", username=session.user, addr=str(session.addr))
+        session.close()
+    return False
+
+def parse_rate_limit(text):
+    """argparse type for ACTION=RATE/BURST; RATE 0 removes the limit."""
+    try:
+        action, spec = text.split("=", 1)
+        rate, _, burst = spec.partition("/")
+        rate = float(rate)
+        burst = int(burst) if burst else max(1, int(rate))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected ACTION=RATE/BURST, got {text!r}")
+    return action, ((rate, burst) if rate > 0 else None)
+
+# ---------- Request ids ----------
+RID_MAX = 64   # longest request id echoed back
+
+replying = threading.local()   # .to: (session, rid) of the request this thread is answering
+
+def request_id(req):
+    """The client's optional "rid", a short string or integer, else None."""
+    rid = req.get("rid")
+    if isinstance(rid, bool) or not isinstance(rid, (int, str)) or len(str(rid)) > RID_MAX:
+        return None
+    return rid
+
+@contextmanager
+def answering(session, req):
+    """Frames sent to session in this block that answer req carry its rid,
+    so a client can keep many requests in flight and match the replies."""
+    rid = request_id(req)
+    previous = getattr(replying, "to", None)
+    replying.to = (session, rid) if rid is not None else None
+    try:
+        yield
     finally:
-        if logged_user:
-            with lock:
-                if logged_user in connections and connections[logged_user][0] is conn:
-                    connections.pop(logged_user, None)
-            broadcast_online()
+        replying.to = previous
+
+def reply_rid(session, obj):
+    to = getattr(replying, "to", None)
+    if to is None or to[0] is not session:
+        return None
+    # replies carry a status, or answer hello/ping; pushes (messages, presence,
+    # backlog) sent while the request is handled are not replies
+    if "status" in obj or obj.get("action") in ("hello", "pong"):
+        return to[1]
+    return None
+
+# ---------- Action dispatch ----------
+# actions that never touch the database; the asyncio engine runs these on the loop
+INLINE_ACTIONS = {"hello", "get_online_users", "ping", "pong"}
+# actions that wait on the hash pool; the asyncio engine gives them their own threads
+AUTH_ACTIONS = {"register", "login"}
+KNOWN_ACTIONS = {"hello", "register", "login", "resume", "get_online_users", "send_message", "send_batch",
+                 "view_users", "delete_user", "logout",
+                 "create_room", "join_room", "leave_room", "room_post", "list_rooms",
+                 "history", "search", "admin_subscribe", "admin_delete", "ping", "pong"}
+BACKLOG_PAGE = 200   # stored messages per query / "receive_messages" frame
+SEND_BATCH_MAX = 1000   # items in one send_batch frame
+
+def remove_user(username):
+    """Delete the account and end its session, on whichever worker holds it."""
+    if not delete_user_db(username):
+        return False
+    rooms.forget_user(username)
+    if bus is not None and bus.owner(username) is not None:
+        bus.drop(username)
+    else:
+        drop_connection(username)
+    admin_feed.emit("deleted", username=username)
+    return True
+
+def drop_connection(username, publish=True):
+    with lock:
+        if username not in connections:
+            return
+        connections[username].close()
+        connections.pop(username, None)
+    presence.changed(username, False, publish)
+
+def deliver_routed(recipient, frame):
+    """A receive_message, or a send_batch's receive_messages, routed here
+    from another worker."""
+    msgs = frame.get("messages", []) if frame.get("action") == "receive_messages" else [frame]
+    with lock:
+        target = connections.get(recipient)
+    if target and not (target.congested or target.diverted):
         try:
-            conn.close()
-        except:
+            push_messages(target, msgs)
+            return
+        except Exception:
             pass
+    # stored as delivered by the sender's worker
+    for m in msgs:
+        store().unconsume(recipient, (m.get("id"), m.get("from"), m.get("message"), m.get("timestamp")))
+    if target:
+        schedule_redelivery(target)
 
-# ---------- Start server ----------
-def start_server():
+def push_messages(session, msgs):
+    """One receive_messages frame, or a receive_message per message for
+    clients that did not ask for batches."""
+    if session.batch_delivery:
+        session.send({"action":"receive_messages","messages":msgs})
+    else:
+        for m in msgs:
+            session.send({"action":"receive_message", **m})
+
+def deliver_backlog(session, after_id=None):
+    """Stream stored messages page by page; each page is one frame when the
+    client accepts "receive_messages" batches, and is consumed in one step.
+    Stops early while the peer is congested and resumes once it drains.
+    With after_id (a resume cursor) every message past it is replayed,
+    including ones marked delivered that the old connection may have lost."""
+    if offline_writer is not None:
+        offline_writer.barrier()
+    last_id = after_id or 0
+    while True:
+        with session.out_lock:
+            if session.congested:
+                session.diverted = True
+                return
+        if after_id is None:
+            rows = store().pending(session.user, BACKLOG_PAGE)
+        else:
+            rows = store().since(session.user, last_id, BACKLOG_PAGE)
+        if not rows:
+            return
+        msgs = [{"id":mid,"from":sender,"message":message,"timestamp":timestamp}
+                for mid, sender, message, timestamp in rows]
+        try:
+            push_messages(session, msgs)
+        except Exception:
+            return
+        DELIVERIES.inc("backlog", value=len(rows))
+        store().consume(session.user, rows)
+        last_id = rows[-1][0]
+        if len(rows) < BACKLOG_PAGE:
+            return
+
+def start_session(session, username, token, req, after_id=None):
+    """Shared tail of login and resume: send the reply, register the
+    connection, send the roster, then replay stored messages."""
+    session.user = username
+    session.token = token
+    session.presence_deltas = bool(req.get("deltas"))
+    session.batch_delivery = bool(req.get("batch"))
+    room_state_for(session)
+    # the reply goes out before anything can be routed here: a client
+    # discards frames until it sees the reply, and a message routed before
+    # registration is stored and replayed below instead
+    verb = "Login successful" if after_id is None else "Session resumed"
+    session.send({"status":"success","message":verb,"username":username,"token":token,
+                  "rooms":user_rooms(session)})
+    with lock:
+        connections[username] = session
+    # back within the grace period, or moved from another worker: the
+    # user never left anyone's roster, so there is nothing to announce
+    reclaimed = presence.reclaim(username)
+    moved = bus.claim(username) if bus is not None else False
+    if not (reclaimed or moved):
+        presence.changed(username, True, publish=False)
+    users, version = presence.snapshot()
+    session.send({"action":"update_users","users":users,"version":version})
+    deliver_backlog(session, after_id)
+    deliver_room_backlog(session)
+
+def dispatch(session, req):
+    """Handle one request. Returns False when the connection should end."""
+    start = time.perf_counter()
+    action = req.get("action")
+    if action not in KNOWN_ACTIONS:
+        action = "unknown"
+    try:
+        with answering(session, req):
+            return handle_action(session, req)
+    except Exception as e:
+        ERRORS.inc(action, type(e).__name__)
+        raise
+    finally:
+        ACTION_SECONDS.observe(time.perf_counter() - start, action)
+
+def handle_action(session, req):
+    action = req.get("action")
+    if action == "hello":
+        # wire format negotiation; the reply still goes out in the old format
+        reply = session.framing.negotiate(req, compress_level=COMPRESS_LEVEL, compress_min=COMPRESS_MIN)
+        session.send_shared(reply, None, then_switch=True)
+        if req.get("ping") and not session.heartbeat:
+            session.heartbeat = True
+            heartbeats.track(session)
+
+    elif action == "ping":
+        session.send({"action":"pong"})
+
+    elif action == "pong":
+        # the read already counted as a sign of life
+        pass
+
+    elif action == "register":
+        country = req.get("country", "")
+        phone = req.get("phone", "")
+        username = req.get("username", "")
+        password = req.get("password", "")
+        if not (phone and username and password):
+            session.send({"status":"error","message":"Missing registration fields"})
+            return True
+        try:
+            ok, msg = add_user(country, phone, username, hash_credentials(password))
+        except CredentialError:
+            session.send({"status":"error","message":"Server busy, try again"})
+            return True
+        if ok:
+            session.send({"status":"success","message":msg})
+            admin_feed.emit("registered", username=username, country=country, phone=phone)
+        else:
+            session.send({"status":"error","message":msg})
+
+    elif action == "login":
+        identifier = req.get("identifier") or req.get("phone") or req.get("username")
+        password = req.get("password", "")
+        if not (identifier and password):
+            session.send({"status":"error","message":"Missing credentials"})
+            return True
+        try:
+            ok, username_db = verify_user(identifier, password)
+        except CredentialError:
+            session.send({"status":"error","message":"Server busy, try again"})
+            return True
+        if ok:
+            start_session(session, username_db, create_session(username_db), req)
+        else:
+            session.send({"status":"error","message":"Invalid credentials"})
+
+    elif action == "resume":
+        # reconnect without the password: a token lookup instead of a KDF
+        token = req.get("token")
+        username = lookup_session(token) if isinstance(token, str) and token else None
+        if not username:
+            session.send({"status":"error","message":"Session expired"})
+            return True
+        try:
+            after_id = max(0, int(req.get("last_id") or 0))
+        except (TypeError, ValueError):
+            after_id = 0
+        start_session(session, username, token, req, after_id)
+
+    elif action == "get_online_users":
+        users, version = presence.snapshot()
+        session.send({"status":"success","users":users,"version":version})
+
+    elif action == "send_message":
+        # PRIVATE-only message handling; stored for good, so only as the logged-in user
+        sender = session.user
+        if sender is None:
+            session.send({"status":"error","message":"Not logged in"})
+            return True
+        if req.get("from") not in (None, sender):
+            session.send({"status":"error","message":"send_message can only send as the logged-in user"})
+            return True
+        recipient = req.get("to")
+        message = req.get("message", "")
+        timestamp = req.get("timestamp") or datetime.utcnow().strftime("%I:%M %p")
+        if not (recipient and message):
+            session.send({"status":"error","message":"Missing fields for private message"})
+            return True
+        with lock:
+            target = connections.get(recipient)
+        if target and not (target.congested or target.diverted):
+            # every message is kept for history; a live one is stored as
+            # delivered first so the frame carries its id (the resume cursor)
+            mid = store_message(sender, recipient, message, timestamp, delivered=True, wait=True)
+            try:
+                target.send({"action":"receive_message","id":mid,"from":sender,"message":message,
+                             "timestamp":timestamp})
+                DELIVERIES.inc("online")
+                # ack to sender
+                session.send({"status":"success","message":"Delivered","state":"delivered","id":mid})
+            except Exception:
+                # if sending fails, leave it for later delivery
+                DELIVERIES.inc("failed")
+                store().unconsume(recipient, (mid, sender, message, timestamp))
+                session.send({"status":"success","message":"Stored for later delivery","state":"stored","id":mid})
+        elif target:
+            # slow consumer: park it, replayed once the peer drains
+            DELIVERIES.inc("busy")
+            mid = store_message(sender, recipient, message, timestamp)
+            schedule_redelivery(target)
+            session.send({"status":"success","message":"Recipient busy — stored","state":"stored","id":mid})
+        elif bus is not None and bus.owner(recipient) is not None:
+            # connected to another worker process
+            DELIVERIES.inc("remote")
+            mid = store_message(sender, recipient, message, timestamp, delivered=True, wait=True)
+            bus.route(recipient, {"action":"receive_message","id":mid,"from":sender,"message":message,
+                                  "timestamp":timestamp})
+            session.send({"status":"success","message":"Delivered","state":"delivered","id":mid})
+        else:
+            # store for offline recipient
+            DELIVERIES.inc("offline")
+            mid = store_message(sender, recipient, message, timestamp)
+            session.send({"status":"success","message":"Recipient offline — stored","state":"stored","id":mid})
+
+    elif action == "send_batch":
+        handle_send_batch(session, req)
+
+    elif action in ("create_room", "join_room", "leave_room", "room_post", "list_rooms"):
+        handle_room_action(session, action, req)
+
+    elif action in ("history", "search"):
+        handle_history_action(session, action, req)
+
+    elif action == "view_users":
+        # a page at a time, encoded once per wire format until the next change
+        after = req.get("after")
+        try:
+            limit = min(USERS_PAGE_MAX, max(1, int(req.get("limit") or USERS_PAGE)))
+        except (TypeError, ValueError):
+            limit = USERS_PAGE
+        match = req.get("match")
+        frame, cache = directory.page(after if isinstance(after, str) else None, limit,
+                                      match.strip() if isinstance(match, str) else None)
+        session.send_shared(frame, cache)
+
+    elif action == "delete_user":
+        # older form of admin_delete: without the admin token, only your own account
+        username = req.get("username")
+        if not username:
+            session.send({"status":"error","message":"username required"})
+        elif not (admin_authorized(session, req) or username == session.user):
+            session.send({"status":"error","message":"Not authorized"})
+        elif username == session.user:
+            # answered first: removing the account closes this connection
+            session.send({"status":"success","message":"Deleted"})
+            remove_user(username)
+            return False
+        elif remove_user(username):
+            session.send({"status":"success","message":"Deleted"})
+        else:
+            session.send({"status":"error","message":"No such user"})
+
+    elif action in ("admin_subscribe", "admin_delete"):
+        if not admin_authorized(session, req):
+            session.send({"status":"error","message":"Not authorized"})
+            return True
+        if action == "admin_subscribe":
+            session.admin = True
+            admin_feed.subscribe(session)
+            users, version = presence.snapshot()
+            session.send({"status":"success","message":"Subscribed","online":users,"stats":queue_depths(),
+                          "maintenance":maintenance.progress()})
+        elif not req.get("username"):
+            session.send({"status":"error","message":"username required"})
+        elif remove_user(req.get("username")):
+            session.send({"status":"success","message":"Deleted","username":req.get("username")})
+        else:
+            session.send({"status":"error","message":"No such user","username":req.get("username")})
+
+    elif action == "logout":
+        # only ever this connection's own user (a "username" field is ignored).
+        # Without a token end_session takes the user offline at once rather
+        # than holding them listed for a resume that can no longer succeed.
+        if session.token:
+            delete_session(session.token)
+            session.token = None
+        session.send({"status":"success","message":"Logged out"})
+        return False
+
+    else:
+        session.send({"status":"error","message":"Unknown action"})
+    return True
+
+def batch_items(req):
+    """(recipient, message, timestamp) per item of a send_batch, None for an
+    unusable one; None overall when the frame has neither form: "items"
+    ([{"to","message"[,"timestamp"]}...]) or one "message" to a "to" list."""
+    default_ts = req.get("timestamp") or datetime.utcnow().strftime("%I:%M %p")
+    if isinstance(req.get("items"), list):
+        raw = req["items"]
+    elif isinstance(req.get("to"), list):
+        raw = [{"to":r,"message":req.get("message")} for r in req["to"]]
+    else:
+        return None
+    items = []
+    for item in raw:
+        if isinstance(item, dict) and item.get("to") and isinstance(item.get("to"), str) \
+                and item.get("message") and isinstance(item.get("message"), str):
+            items.append((item["to"], item["message"], item.get("timestamp") or default_ts))
+        else:
+            items.append(None)
+    return items
+
+def handle_send_batch(session, req):
+    """Many private messages in one frame: all stored in one transaction,
+    then one frame per online recipient. The reply's "states" string has a
+    letter per item, in order: d delivered, s stored, e rejected; "ids" has
+    the message ids (null where rejected)."""
+    sender = session.user
+    if sender is None:
+        session.send({"status":"error","message":"Not logged in"})
+        return
+    if req.get("from") not in (None, sender):
+        session.send({"status":"error","message":"send_batch can only send as the logged-in user"})
+        return
+    items = batch_items(req)
+    if items is None:
+        session.send({"status":"error","message":"send_batch needs \"items\" or a \"to\" list"})
+        return
+    if len(items) > SEND_BATCH_MAX:
+        session.send({"status":"error","message":f"At most {SEND_BATCH_MAX} items per send_batch"})
+        return
+    recipients = {item[0] for item in items if item}
+    with lock:
+        targets = {r: connections.get(r) for r in recipients}
+    routes = {}
+    for r, target in targets.items():
+        if target and not (target.congested or target.diverted):
+            routes[r] = "online"
+        elif target:
+            routes[r] = "busy"
+        elif bus is not None and bus.owner(r) is not None:
+            routes[r] = "remote"
+        else:
+            routes[r] = "offline"
+    now = time.time()
+    # live ones stored as delivered first, so their frames carry ids
+    rows = [(sender, r, message, timestamp, now, int(routes[r] in ("online", "remote")))
+            for r, message, timestamp in filter(None, items)]
+    ids = iter(store().append(rows) if rows else ())
+    states, mids, live, counts = [], [], {}, {}
+    for item in items:
+        if item is None:
+            states.append("e")
+            mids.append(None)
+            continue
+        r, message, timestamp = item
+        mid = next(ids)
+        mids.append(mid)
+        if routes[r] != "online":
+            # online ones are counted once their frame is queued
+            counts[routes[r]] = counts.get(routes[r], 0) + 1
+        if routes[r] in ("online", "remote"):
+            live.setdefault(r, []).append({"id":mid,"from":sender,"message":message,"timestamp":timestamp})
+            states.append("d")
+        else:
+            states.append("s")
+    for route, n in counts.items():
+        DELIVERIES.inc(route, value=n)
+    position = {mid: i for i, mid in enumerate(mids) if mid is not None}
+    for r, msgs in live.items():
+        if routes[r] == "remote":
+            bus.route(r, {"action":"receive_messages","messages":msgs})
+            continue
+        try:
+            push_messages(targets[r], msgs)
+            DELIVERIES.inc("online", value=len(msgs))
+        except Exception:
+            DELIVERIES.inc("failed", value=len(msgs))
+            for m in msgs:
+                store().unconsume(r, (m["id"], sender, m["message"], m["timestamp"]))
+                states[position[m["id"]]] = "s"
+    for r, route in routes.items():
+        if route == "busy":
+            schedule_redelivery(targets[r])
+    session.send({"status":"success","message":"Batch processed","states":"".join(states),"ids":mids})
+
+def handle_room_action(session, action, req):
+    if not session.user:
+        session.send({"status":"error","message":"Login required"})
+        return
+    if action == "list_rooms":
+        session.send({"status":"success","rooms":user_rooms(session)})
+        return
+    name = req.get("room")
+    if not valid_room_name(name):
+        session.send({"status":"error","message":"Invalid room name"})
+        return
+    name = name.strip()
+    room_id = rooms.lookup(name)
+
+    if action == "create_room":
+        room_id = create_room_db(name, session.user) if room_id is None else None
+        if room_id is None:
+            session.send({"status":"error","message":"Room already exists"})
+            return
+        rooms.named(room_id, name)
+        action = "join_room"
+    elif action == "join_room" and room_id is None and req.get("create"):
+        # join, creating the room if needed; a racing creator may win
+        room_id = create_room_db(name, session.user) or rooms.lookup(name)
+        if room_id is not None:
+            rooms.named(room_id, name)
+    if room_id is None:
+        session.send({"status":"error","message":"No such room"})
+        return
+
+    if action == "join_room":
+        last_read = join_room_db(room_id, session.user)
+        with session.out_lock:
+            session.room_cursors.setdefault(room_id, last_read)
+            session.room_saved.setdefault(room_id, last_read)
+        rooms.changed(room_id, session.user, True)
+        if bus is not None:
+            bus.room_member(room_id, session.user, True)
+        session.send({"status":"success","message":"Joined","room":name,"rooms":user_rooms(session)})
+
+    elif action == "leave_room":
+        leave_room_db(room_id, session.user)
+        with session.out_lock:
+            session.room_cursors.pop(room_id, None)
+            session.room_saved.pop(room_id, None)
+            session.rooms_behind.pop(room_id, None)
+        rooms.changed(room_id, session.user, False)
+        if bus is not None:
+            bus.room_member(room_id, session.user, False)
+        session.send({"status":"success","message":"Left","room":name,"rooms":user_rooms(session)})
+
+    elif action == "room_post":
+        message = req.get("message", "")
+        if not message:
+            session.send({"status":"error","message":"Empty message"})
+            return
+        if not rooms.is_member(room_id, session.user):
+            session.send({"status":"error","message":"Not a member of this room"})
+            return
+        timestamp = req.get("timestamp") or datetime.utcnow().strftime("%I:%M %p")
+        # stored once before fan-out: a member skipped below replays it from its cursor
+        mid = insert_room_message(room_id, session.user, message, timestamp)
+        fanout_room(room_id, {"action":"room_message","room":name,"id":mid,"from":session.user,
+                              "message":message,"timestamp":timestamp})
+        session.send({"status":"success","message":"Posted","room":name,"id":mid})
+
+def end_session(session):
+    heartbeats.untrack(session)
+    if session.admin:
+        admin_feed.unsubscribe(session)
+    if session.user:
+        flush_room_cursors(session)
+        with lock:
+            if connections.get(session.user) is session:
+                connections.pop(session.user, None)
+            else:
+                return
+        if session.token and RESUME_GRACE > 0:
+            # dropped, not logged out: give the client a chance to resume
+            presence.linger(session.user, RESUME_GRACE)
+        else:
+            presence.changed(session.user, False)
+
+# ---------- Services ----------
+metrics_services = []
+
+def start_services():
+    global offline_writer, hasher
     init_db()
+    store()
+    hasher = Hasher(HASH_WORKERS, HASH_QUEUE, HASH_TIMEOUT)
+    offline_writer = OfflineWriter(WRITE_BATCH, WRITE_WINDOW_MS)
+    presence.window = PRESENCE_WINDOW_MS / 1000.0
+    presence.start()
+    admin_feed.interval = ADMIN_STATS_SECS
+    admin_feed.start()
+    heartbeats.interval, heartbeats.timeout = HEARTBEAT_SECS, IDLE_TIMEOUT
+    heartbeats.start()
+    maintenance.interval = MAINTENANCE_SECS
+    if bus is None or bus.worker_id == 0:
+        maintenance.start()
+    if METRICS_PORT:
+        metrics_services.append(serve_http(registry, METRICS_HOST, METRICS_PORT))
+    if METRICS_JSON:
+        metrics_services.append(SnapshotWriter(registry, METRICS_JSON, METRICS_INTERVAL))
+
+def stop_services():
+    global offline_writer, hasher
+    while metrics_services:
+        svc = metrics_services.pop()
+        if isinstance(svc, SnapshotWriter):
+            svc.stop()
+        else:
+            svc.shutdown()
+    maintenance.stop()
+    heartbeats.stop()
+    admin_feed.stop()
+    presence.stop()
+    writer, offline_writer = offline_writer, None
+    if writer is not None:
+        writer.close()
+    close_store()
+    pool, hasher = hasher, None
+    if pool is not None:
+        pool.close()
+
+# ---------- Threaded engine ----------
+db_executor = None   # blocking DB work off the connection threads (both engines)
+
+def interrupt(signum, frame):
+    # SIGTERM (systemd stop, Popen.terminate) shuts down like Ctrl+C
+    raise KeyboardInterrupt
+
+def handle_client(conn, addr):
+    session = SocketSession(conn, addr)
+    framing = session.framing
+    enable_keepalive(conn)
+    try:
+        while True:
+            n = framing.recv_into(conn)
+            if not n:
+                break
+            heard_from(session)
+            BYTES_IN.inc(value=n)
+            for req in framing.messages():
+                if not admit(session, req):
+                    if session.closed:
+                        return
+                    continue
+                if not dispatch(session, req):
+                    return
+    except OSError:
+        pass
+    except Exception as e:
+        ERRORS.inc("handler", type(e).__name__)
+    finally:
+        end_session(session)
+        session.close()
+
+def start_server():
+    global db_executor
+    start_services()
+    # backlog replays for peers that were congested
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSE_PORT:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind((HOST, PORT))
     server.listen(200)
     print(f"[SERVER] Listening on {HOST}:{PORT}")
+    signal.signal(signal.SIGTERM, interrupt)
     try:
         while True:
             conn, addr = server.accept()
@@ -300,6 +2918,468 @@ def start_server():
         print("Shutting down server...")
     finally:
         server.close()
+        db_executor.shutdown(wait=True)
+        stop_services()
+
+# ---------- asyncio engine ----------
+auth_executor = None
+
+def raise_fd_limit():
+    # every idle client holds one descriptor; lift the soft limit to the hard one
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+async def handle_client_async(reader, writer):
+    loop = asyncio.get_running_loop()
+    session = StreamSession(loop, writer, writer.get_extra_info("peername"))
+    enable_keepalive(writer.get_extra_info("socket"))
+    try:
+        keep = True
+        while keep:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                break
+            heard_from(session)
+            BYTES_IN.inc(value=len(data))
+            session.framing.feed(data)
+            for req in session.framing.messages():
+                # refused requests never reach the executors
+                if not admit(session, req):
+                    if session.closed:
+                        keep = False
+                        break
+                    continue
+                if req.get("action") in INLINE_ACTIONS:
+                    keep = dispatch(session, req)
+                elif req.get("action") in AUTH_ACTIONS:
+                    # waiting on the hash pool must not tie up the DB threads
+                    keep = await loop.run_in_executor(auth_executor, dispatch, session, req)
+                else:
+                    keep = await loop.run_in_executor(db_executor, dispatch, session, req)
+                if not keep:
+                    break
+    except OSError:
+        pass
+    except Exception as e:
+        ERRORS.inc("handler", type(e).__name__)
+    finally:
+        end_session(session)
+        session.close()
+
+async def serve_async():
+    server = await asyncio.start_server(handle_client_async, HOST, PORT,
+                                        backlog=4096, reuse_address=True, reuse_port=REUSE_PORT or None)
+    print(f"[SERVER] Listening on {HOST}:{PORT} (asyncio)")
+    async with server:
+        await server.serve_forever()
+
+def start_async_server():
+    global db_executor, auth_executor
+    start_services()
+    raise_fd_limit()
+    db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    # more threads than hash slots, so excess logins reach the pool's bound and are refused
+    auth_executor = ThreadPoolExecutor(max_workers=HASH_QUEUE * 2, thread_name_prefix="auth")
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        asyncio.run(serve_async())
+    except KeyboardInterrupt:
+        print("Shutting down server...")
+    finally:
+        db_executor.shutdown(wait=True)
+        auth_executor.shutdown(wait=True)
+        stop_services()
+
+# ---------- Sharded mode ----------
+bus = None   # WorkerBus inside a worker process
+
+class WorkerBus:
+    """A worker's link to the supervisor: the global roster and routing
+    of messages to users connected to other workers."""
+
+    def __init__(self, sock, worker_id):
+        self.sock = sock
+        self.worker_id = worker_id
+        self.framing = Framing()
+        self.remote = {}   # username -> worker id, for users on other workers
+        self._remote_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name="bus", daemon=True).start()
+
+    def _send(self, obj):
+        with self._send_lock:
+            self.sock.sendall(self.framing.encode(obj))
+
+    def publish(self, username, online):
+        self._send({"op":"presence","user":username,"online":online})
+
+    def claim(self, username):
+        """username logged in on this worker; True if another worker had it."""
+        with self._remote_lock:
+            moved = self.remote.pop(username, None) is not None
+        self.publish(username, True)
+        return moved
+
+    def route(self, recipient, frame):
+        self._send({"op":"route","to":recipient,"frame":frame})
+
+    def room_post(self, room_id, frame):
+        self._send({"op":"room_post","room_id":room_id,"frame":frame})
+
+    def room_member(self, room_id, username, member):
+        self._send({"op":"room_member","room_id":room_id,"user":username,"member":member})
+
+    def admin_event(self, frame):
+        self._send({"op":"admin_event","frame":frame})
+
+    def drop(self, username):
+        # end username's session on the worker that holds it
+        self._send({"op":"drop","user":username})
+
+    def owner(self, username):
+        with self._remote_lock:
+            return self.remote.get(username)
+
+    def remote_users(self):
+        with self._remote_lock:
+            return list(self.remote)
+
+    def _run(self):
+        try:
+            while self.framing.recv_into(self.sock):
+                for msg in self.framing.messages():
+                    self._handle(msg)
+        except OSError:
+            pass
+        # the supervisor is gone (or stopping us): shut down gracefully
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def _handle(self, msg):
+        op = msg.get("op")
+        if op == "presence":
+            user, online = msg.get("user"), msg.get("online")
+            with self._remote_lock:
+                if online:
+                    listed = user in self.remote
+                    self.remote[user] = msg.get("worker")
+                    if listed:
+                        return   # moved between workers, or resumed
+                elif self.remote.get(user) == msg.get("worker"):
+                    del self.remote[user]
+                else:
+                    return
+            presence.changed(user, online, publish=False)
+        elif op == "deliver":
+            deliver_routed(msg.get("to"), msg.get("frame") or {})
+        elif op == "room_post":
+            # fan out to this worker's members; the post is already stored
+            frame = msg.get("frame") or {}
+            rooms.named(msg.get("room_id"), frame.get("room"))
+            fanout_room(msg.get("room_id"), frame, publish=False)
+        elif op == "room_member":
+            rooms.changed(msg.get("room_id"), msg.get("user"), msg.get("member"))
+        elif op == "admin_event":
+            admin_feed.deliver(msg.get("frame") or {})
+        elif op == "drop":
+            user = msg.get("user")
+            rooms.forget_user(user)
+            drop_connection(user)
+        elif op == "kick":
+            # the user logged in again on another worker: close the old
+            # connection and hand the roster entry over without a change
+            user = msg.get("user")
+            with self._remote_lock:
+                self.remote[user] = msg.get("worker")
+            presence.reclaim(user)
+            with lock:
+                session = connections.pop(user, None)
+            if session is not None:
+                session.close()
+
+
+class Supervisor:
+    """Forks the workers and runs the routing bus between them.
+
+    Each worker reaches the supervisor over a Unix socketpair. Workers
+    publish their logins/logouts; the supervisor keeps the global
+    username -> worker map, fans presence out to the other workers and
+    forwards routed messages to the owning worker.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.sel = selectors.DefaultSelector()
+        self.workers = {}   # worker id -> [pid, sock, framing]
+        self.owner = {}     # username -> worker id
+        self.stopping = False
+
+    def spawn(self, wid):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            for _, sock, _ in self.workers.values():
+                sock.close()
+            self.sel.close()
+            code = 0
+            try:
+                run_worker(wid, child)
+            except BaseException:
+                code = 1
+            os._exit(code)
+        child.close()
+        self.workers[wid] = [pid, parent, Framing()]
+        self.sel.register(parent, selectors.EVENT_READ, wid)
+        for user, w in self.owner.items():
+            self._send(wid, {"op":"presence","user":user,"online":True,"worker":w})
+
+    def _send(self, wid, obj):
+        _, sock, framing = self.workers[wid]
+        try:
+            sock.sendall(framing.encode(obj))
+        except OSError:
+            pass
+
+    def _broadcast(self, obj, exclude):
+        for wid in list(self.workers):
+            if wid != exclude:
+                self._send(wid, obj)
+
+    def serve(self):
+        for wid in range(self.count):
+            self.spawn(wid)
+        print(f"[SERVER] Supervisor running {self.count} workers on {HOST}:{PORT}")
+        while self.workers:
+            for key, _ in self.sel.select():
+                wid = key.data
+                if wid not in self.workers:
+                    continue
+                _, sock, framing = self.workers[wid]
+                try:
+                    alive = framing.recv_into(sock)
+                except OSError:
+                    alive = 0
+                if not alive:
+                    self._worker_exited(wid)
+                    continue
+                for msg in framing.messages():
+                    self._handle(wid, msg)
+
+    def _handle(self, wid, msg):
+        op = msg.get("op")
+        if op == "presence":
+            user, online = msg.get("user"), msg.get("online")
+            if online:
+                prev = self.owner.get(user)
+                self.owner[user] = wid
+                if prev is not None and prev != wid:
+                    self._send(prev, {"op":"kick","user":user,"worker":wid})
+            elif self.owner.get(user) == wid:
+                del self.owner[user]
+            else:
+                return   # stale: the user already moved to another worker
+            self._broadcast({"op":"presence","user":user,"online":online,"worker":wid}, exclude=wid)
+        elif op == "route":
+            # unknown recipient: bounce to the sender's worker, which stores it
+            target = self.owner.get(msg.get("to"), wid)
+            self._send(target, {"op":"deliver","to":msg.get("to"),"frame":msg.get("frame")})
+        elif op in ("room_post", "room_member", "admin_event"):
+            self._broadcast(msg, exclude=wid)
+        elif op == "drop":
+            target = self.owner.get(msg.get("user"))
+            if target is not None:
+                self._send(target, msg)
+
+    def _worker_exited(self, wid):
+        pid, sock, _ = self.workers.pop(wid)
+        self.sel.unregister(sock)
+        # reap before closing the bus: a worker still shutting down would
+        # take the closed bus as a second stop signal mid-cleanup
+        _, status = os.waitpid(pid, 0)
+        sock.close()
+        for user in [u for u, w in self.owner.items() if w == wid]:
+            del self.owner[user]
+            self._broadcast({"op":"presence","user":user,"online":False,"worker":wid}, exclude=wid)
+        if not self.stopping and status != 0:
+            print(f"[SERVER] Worker {wid} died (status {status}), restarting")
+            self.spawn(wid)
+
+    def stop(self):
+        self.stopping = True
+        for pid, _, _ in self.workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for wid in list(self.workers):
+            self._worker_exited(wid)
+
+def run_worker(wid, sock):
+    global bus, REUSE_PORT, METRICS_PORT, METRICS_JSON, HASH_WORKERS
+    # Ctrl+C reaches the whole process group; only the supervisor acts on
+    # it and stops each worker once with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt)
+    REUSE_PORT = True
+    # one metrics endpoint / snapshot file per worker
+    if METRICS_PORT:
+        METRICS_PORT += wid
+    if METRICS_JSON:
+        METRICS_JSON = f"{METRICS_JSON}.{wid}"
+    # the hash processes are shared out between the workers
+    HASH_WORKERS = max(1, HASH_WORKERS // WORKERS)
+    bus = WorkerBus(sock, wid)
+    bus.start()
+    if ENGINE == "asyncio":
+        start_async_server()
+    else:
+        start_server()
+
+def start_sharded_server():
+    global db_pool
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("--workers needs fork() and SO_REUSEPORT (Linux/BSD)")
+    init_db()
+    # a log left by an earlier --store log run is folded back in once, here
+    store()
+    close_store()
+    # workers open their own connections
+    db_pool.close()
+    db_pool = None
+    signal.signal(signal.SIGTERM, interrupt)
+    sup = Supervisor(WORKERS)
+    try:
+        sup.serve()
+    except KeyboardInterrupt:
+        print("Shutting down server...")
+    finally:
+        sup.stop()
+
+# ---------- Start server ----------
+def parse_args():
+    p = argparse.ArgumentParser(description="Chat server")
+    p.add_argument("--engine", choices=("threaded", "asyncio"), default=ENGINE)
+    p.add_argument("--host", default=HOST)
+    p.add_argument("--port", type=int, default=PORT)
+    p.add_argument("--db", default=DB_FILE, help="SQLite database file")
+    p.add_argument("--db-workers", type=int, default=DB_WORKERS,
+                   help="threads for blocking DB work: requests (asyncio engine) and backlog replays")
+    p.add_argument("--db-pool", type=int, default=DB_POOL_SIZE,
+                   help="number of long-lived SQLite connections")
+    p.add_argument("--write-batch", type=int, default=WRITE_BATCH,
+                   help="most offline messages committed per transaction")
+    p.add_argument("--write-window-ms", type=float, default=WRITE_WINDOW_MS,
+                   help="how long the offline writer waits to fill a batch")
+    p.add_argument("--store", choices=("sqlite", "log", "memory"), default=STORE_ENGINE,
+                   help="where undelivered private messages wait (log and memory need --workers 1)")
+    p.add_argument("--log-dir", default=LOG_DIR, help="message log directory (default: DB file + .log)")
+    p.add_argument("--migrate-log", action="store_true",
+                   help="with --store sqlite: move the undelivered messages of a --store log directory back "
+                        "into the database, then delete the directory")
+    p.add_argument("--log-partitions", type=int, default=LOG_PARTITIONS,
+                   help="partitions of a new message log; an existing log keeps its own")
+    p.add_argument("--log-segment-bytes", type=int, default=LOG_SEGMENT_BYTES,
+                   help="size at which a log segment is sealed and a new one started")
+    p.add_argument("--retain-delivered-days", type=float, default=RETAIN_DELIVERED_DAYS,
+                   help="archive and delete delivered private messages older than this (0 keeps them)")
+    p.add_argument("--retain-undelivered-days", type=float, default=RETAIN_UNDELIVERED_DAYS,
+                   help="the same for messages never delivered (0 keeps them)")
+    p.add_argument("--archive-dir", default=ARCHIVE_DIR,
+                   help="where expired messages are exported (default: DB file + .archive)")
+    p.add_argument("--maintenance-secs", type=float, default=MAINTENANCE_SECS,
+                   help="seconds between retention passes")
+    p.add_argument("--maintenance-chunk", type=int, default=MAINTENANCE_CHUNK,
+                   help="rows archived and deleted per transaction")
+    p.add_argument("--maintenance-pause-ms", type=float, default=MAINTENANCE_PAUSE_MS,
+                   help="pause between retention transactions")
+    p.add_argument("--relaxed-durability", action="store_true",
+                   help="acknowledge offline messages before they are committed")
+    p.add_argument("--heartbeat-secs", type=float, default=HEARTBEAT_SECS,
+                   help="ping a connection that has been silent this long")
+    p.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                   help="close a connection silent this long (0 disables heartbeats)")
+    p.add_argument("--presence-window-ms", type=float, default=PRESENCE_WINDOW_MS,
+                   help="presence changes inside this window are sent as one update")
+    p.add_argument("--outbox-high", type=int, default=OUTBOX_HIGH,
+                   help="queued bytes at which a client is treated as slow")
+    p.add_argument("--outbox-low", type=int, default=OUTBOX_LOW,
+                   help="queued bytes below which a slow client recovers")
+    p.add_argument("--compress-level", type=int, default=COMPRESS_LEVEL, choices=range(10), metavar="0-9",
+                   help="deflate level for framed clients that offer compression (0: never compress)")
+    p.add_argument("--compress-min", type=int, default=COMPRESS_MIN,
+                   help="frames smaller than this many bytes are sent uncompressed")
+    p.add_argument("--slow-evict-secs", type=float, default=SLOW_EVICT_SECS,
+                   help="disconnect clients that stay slow this long")
+    p.add_argument("--workers", type=int, default=WORKERS,
+                   help="worker processes sharing the port via SO_REUSEPORT (Linux/BSD)")
+    p.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                   help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (worker N uses PORT+N)")
+    p.add_argument("--metrics-json", default=METRICS_JSON,
+                   help="write a JSON metrics snapshot to this file (worker N appends .N)")
+    p.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                   help="seconds between JSON snapshots")
+    p.add_argument("--session-ttl", type=float, default=SESSION_TTL,
+                   help="seconds a login token can be used to resume")
+    p.add_argument("--resume-grace", type=float, default=RESUME_GRACE,
+                   help="seconds a dropped user stays online waiting for a resume (0 = none)")
+    p.add_argument("--hash-workers", type=int, default=HASH_WORKERS,
+                   help="processes hashing and checking passwords (split across --workers)")
+    p.add_argument("--hash-queue", type=int, default=HASH_QUEUE,
+                   help="password jobs queued or running before logins are refused")
+    p.add_argument("--admin-token", default=ADMIN_TOKEN,
+                   help="secret for admin_subscribe/admin_delete (default: $CHAT_ADMIN_TOKEN; unset disables them)")
+    p.add_argument("--admin-stats-secs", type=float, default=ADMIN_STATS_SECS,
+                   help="how often queue depths are sampled for admin subscribers")
+    p.add_argument("--hash-timeout", type=float, default=HASH_TIMEOUT,
+                   help="seconds a login waits for its password check")
+    p.add_argument("--rate-limit", type=parse_rate_limit, action="append", default=[], metavar="ACTION=RATE/BURST",
+                   help="per-connection limit for ACTION (or *), repeatable; RATE 0 removes it")
+    p.add_argument("--user-rate-limit", type=parse_rate_limit, action="append", default=[],
+                   metavar="ACTION=RATE/BURST", help="the same, per user across their connections")
+    p.add_argument("--abuse-strikes", type=int, default=ABUSE_STRIKES,
+                   help="refused requests in a burst before the client is disconnected")
+    p.add_argument("--no-rate-limits", action="store_true", help="switch rate limiting off")
+    return p.parse_args()
 
 if __name__ == "__main__":
-    start_server()
+    args = parse_args()
+    HOST, PORT, DB_FILE, DB_WORKERS = args.host, args.port, args.db, args.db_workers
+    DB_POOL_SIZE = args.db_pool
+    WRITE_BATCH, WRITE_WINDOW_MS = args.write_batch, args.write_window_ms
+    RELAXED_DURABILITY = args.relaxed_durability
+    STORE_ENGINE, LOG_DIR, MIGRATE_LOG = args.store, args.log_dir, args.migrate_log
+    LOG_PARTITIONS, LOG_SEGMENT_BYTES = args.log_partitions, args.log_segment_bytes
+    RETAIN_DELIVERED_DAYS, RETAIN_UNDELIVERED_DAYS = args.retain_delivered_days, args.retain_undelivered_days
+    ARCHIVE_DIR, MAINTENANCE_SECS = args.archive_dir, args.maintenance_secs
+    MAINTENANCE_CHUNK, MAINTENANCE_PAUSE_MS = args.maintenance_chunk, args.maintenance_pause_ms
+    PRESENCE_WINDOW_MS = args.presence_window_ms
+    HEARTBEAT_SECS, IDLE_TIMEOUT = args.heartbeat_secs, args.idle_timeout
+    OUTBOX_HIGH, OUTBOX_LOW, SLOW_EVICT_SECS = args.outbox_high, args.outbox_low, args.slow_evict_secs
+    COMPRESS_LEVEL, COMPRESS_MIN = args.compress_level, args.compress_min
+    ENGINE, WORKERS = args.engine, args.workers
+    METRICS_PORT, METRICS_JSON, METRICS_INTERVAL = args.metrics_port, args.metrics_json, args.metrics_interval
+    HASH_WORKERS, HASH_QUEUE, HASH_TIMEOUT = args.hash_workers, args.hash_queue, args.hash_timeout
+    SESSION_TTL, RESUME_GRACE = args.session_ttl, args.resume_grace
+    ADMIN_TOKEN, ADMIN_STATS_SECS = args.admin_token, args.admin_stats_secs
+    RATE_LIMITS_ENABLED, ABUSE_STRIKES = not args.no_rate_limits, args.abuse_strikes
+    for table, overrides in ((RATE_LIMITS, args.rate_limit), (USER_RATE_LIMITS, args.user_rate_limit)):
+        for action, limit in overrides:
+            if limit is None:
+                table.pop(action, None)
+            else:
+                table[action] = limit
+    if WORKERS > 1 and STORE_ENGINE != "sqlite":
+        raise SystemExit(f"--store {STORE_ENGINE} keeps delivery state in one process; use --workers 1")
+    if WORKERS > 1:
+        start_sharded_server()
+    elif ENGINE == "asyncio":
+        start_async_server()
+    else:
+        start_server()
@@ -0,0 +1,139 @@
+# test_framing.py
+import unittest
+import zlib
+
+import framing01
+from framing01 import Framing, FrameError
+
+
+def connected(compression=True):
+    """A client and a server Framing after a hello exchange."""
+    client, server = Framing(), Framing()
+    reply = server.negotiate(client.client_hello(compression))
+    server.switch(reply)
+    client.switch(reply)
+    return client, server
+
+
+class LinesTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        f = Framing()
+        msgs = [{"action":"login","username":"ana"}, {"action":"send_message","message":"olá"}]
+        f.feed(b"".join(f.encode(m) for m in msgs))
+        self.assertEqual(list(f.messages()), msgs)
+
+    def test_split_feeds(self):
+        f = Framing()
+        data = f.encode({"n":1}) + f.encode({"n":2})
+        out = []
+        for i in range(len(data)):
+            f.feed(data[i:i + 1])
+            out.extend(f.messages())
+        self.assertEqual(out, [{"n":1}, {"n":2}])
+
+    def test_malformed_and_blank_lines_skipped(self):
+        f = Framing()
+        f.feed(b"not json\n\n[1, 2]\n" + f.encode({"ok":True}))
+        self.assertEqual(list(f.messages()), [{"ok":True}])
+
+    def test_line_too_long(self):
+        f = Framing(max_frame=16)
+        f.feed(b"x" * 32)
+        with self.assertRaises(FrameError):
+            list(f.messages())
+
+    def test_buffer_released_when_drained(self):
+        f = Framing()
+        f.feed(f.encode({"n":1}) + b'{"n":')
+        self.assertEqual(list(f.messages()), [{"n":1}])
+        self.assertTrue(len(f._buf))
+        f.feed(b"2}\n")
+        self.assertEqual(list(f.messages()), [{"n":2}])
+        self.assertEqual(len(f._buf), 0)
+
+
+class FramesTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        client, server = connected()
+        self.assertEqual(server.mode, framing01.FRAMES)
+        self.assertEqual(client.key, server.key)
+        self.assertEqual(server.compression, framing01.DEFLATE)
+
+    def test_lines_only_client(self):
+        server = Framing()
+        reply = server.negotiate({"action":"hello"})
+        self.assertEqual(reply["framing"], framing01.LINES)
+        self.assertNotIn("compression", reply)
+
+    def test_no_compression(self):
+        client, server = connected(compression=False)
+        self.assertIsNone(server.compression)
+        server = Framing()
+        reply = server.negotiate(Framing().client_hello(), compress_level=0)
+        self.assertNotIn("compression", reply)
+
+    def test_round_trip_split(self):
+        client, server = connected()
+        msgs = [{"n":i,"text":"y" * (i * 300)} for i in range(5)]
+        data = b"".join(client.encode(m) for m in msgs)
+        out = []
+        for i in range(0, len(data), 7):
+            server.feed(data[i:i + 7])
+            out.extend(server.messages())
+        self.assertEqual(out, msgs)
+        self.assertEqual(len(server._buf), 0)
+
+    def test_small_frames_not_compressed(self):
+        client, _ = connected()
+        frame = client.encode({"n":1})
+        self.assertFalse(frame[4] & framing01.COMPRESSED)
+        frame = client.encode({"text":"z" * 2000})
+        self.assertTrue(frame[4] & framing01.COMPRESSED)
+        self.assertLess(len(frame), 2000)
+
+    def test_encode_shared(self):
+        # one serialization per format; each connection keeps its own deflate stream
+        a, server_a = connected()
+        b, server_b = connected()
+        cache = {}
+        obj = {"action":"room_message","message":"w" * 1000}
+        for _ in range(3):
+            server_a.feed(a.encode_shared(obj, cache))
+            server_b.feed(b.encode_shared(obj, cache))
+        self.assertEqual(list(server_a.messages()), [obj] * 3)
+        self.assertEqual(list(server_b.messages()), [obj] * 3)
+        self.assertEqual(list(cache), [a.key])
+
+    def test_oversize_frame(self):
+        _, server = connected()
+        server.max_frame = 64
+        server.feed(framing01.HEADER.pack(65, 0))
+        with self.assertRaises(FrameError):
+            list(server.messages())
+        sender = Framing(max_frame=8)
+        sender.switch({"framing":framing01.FRAMES,"encoding":"json"})
+        with self.assertRaises(FrameError):
+            sender.encode({"text":"x" * 9})
+
+    def test_inflate_bound(self):
+        _, server = connected()
+        server.max_frame = 1000
+        c = zlib.compressobj(6, zlib.DEFLATED, -framing01.COMPRESS_WINDOW_BITS)
+        bomb = c.compress(b"0" * 100000) + c.flush(zlib.Z_SYNC_FLUSH)
+        server.feed(framing01.HEADER.pack(len(bomb), framing01.COMPRESSED) + bomb)
+        with self.assertRaises(FrameError):
+            list(server.messages())
+
+    def test_compressed_frame_without_negotiation(self):
+        client, _ = connected()
+        server = Framing()
+        server.switch({"framing":framing01.FRAMES,"encoding":"json"})
+        server.feed(client.encode({"text":"q" * 2000}))
+        with self.assertRaises(FrameError):
+            list(server.messages())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# test_messagelog.py
+import os
+import shutil
+import tempfile
+import unittest
+
+import messagelog01
+from messagelog01 import MessageLog
+
+
+def row(mid, sender="ana", message="hi"):
+    return (mid, sender, f"{message} {mid}", f"2024-01-01 00:00:{mid % 60:02d}")
+
+
+class MessageLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "log")
+        self.log = None
+
+    def tearDown(self):
+        if self.log is not None:
+            self.log.close()
+        shutil.rmtree(self.dir)
+
+    def open(self, **kw):
+        if self.log is not None:
+            self.log.close()
+        kw.setdefault("partitions", 4)
+        kw.setdefault("sync", False)
+        self.log = MessageLog(self.path, **kw)
+        return self.log
+
+    def segment_files(self, key):
+        part = self.log._partition(key).path
+        return sorted(n for n in os.listdir(part) if n.endswith(".seg"))
+
+    def test_append_pending_consume(self):
+        log = self.open()
+        log.append([("bob", row(1)), ("eve", row(2)), ("bob", row(3))])
+        self.assertEqual(log.pending("bob"), [row(1), row(3)])
+        self.assertEqual(log.pending("bob", limit=1), [row(1)])
+        self.assertEqual(log.pending_ids("eve"), {2})
+        self.assertEqual(log.consume("bob", [1]), 1)
+        self.assertEqual(log.pending("bob"), [row(3)])
+        self.assertEqual(log.all_pending(), {"bob": [3], "eve": [2]})
+        self.assertEqual(log.stats()["pending"], 2)
+
+    def test_consume_prefix_only(self):
+        # the offset covers a prefix: an id behind a pending one stays pending
+        log = self.open()
+        log.append([("bob", row(1)), ("bob", row(2))])
+        self.assertEqual(log.consume("bob", [2]), 0)
+        self.assertEqual(log.pending_ids("bob"), {1, 2})
+
+    def test_reopen(self):
+        log = self.open()
+        log.append([("bob", row(i)) for i in range(1, 6)])
+        log.consume("bob", [1, 2])
+        log = self.open()
+        self.assertEqual(log.pending("bob"), [row(3), row(4), row(5)])
+        log.append([("bob", row(6))])
+        log = self.open()
+        self.assertEqual([r[0] for r in log.pending("bob")], [3, 4, 5, 6])
+
+    def test_torn_tail_truncated(self):
+        log = self.open()
+        log.append([("bob", row(1)), ("bob", row(2))])
+        seg = log._partition("bob").segments[-1]
+        self.log.close()
+        self.log = None
+        size = os.path.getsize(seg.path)
+        with open(seg.path, "r+b") as f:
+            f.truncate(size - 3)
+        log = self.open()
+        self.assertEqual(log.pending("bob"), [row(1)])
+        # the torn record is gone from disk, so later appends stay readable
+        log.append([("bob", row(3))])
+        log = self.open()
+        self.assertEqual(log.pending("bob"), [row(1), row(3)])
+
+    def test_corrupt_record_truncated(self):
+        log = self.open()
+        log.append([("bob", row(1))])
+        log.append([("bob", row(2))])
+        seg = log._partition("bob").segments[-1]
+        self.log.close()
+        self.log = None
+        with open(seg.path, "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"!!")
+        log = self.open()
+        self.assertEqual(log.pending("bob"), [row(1)])
+
+    def test_consumed_segments_deleted(self):
+        log = self.open(segment_bytes=200)
+        for i in range(1, 11):
+            log.append([("bob", row(i))])
+        self.assertGreater(len(self.segment_files("bob")), 2)
+        log.consume("bob", range(1, 10))
+        # only the active segment and the one holding id 10 can remain
+        self.assertLessEqual(len(self.segment_files("bob")), 2)
+        log = self.open(segment_bytes=200)
+        self.assertEqual(log.pending("bob"), [row(10)])
+        log.consume("bob", [10])
+        log = self.open(segment_bytes=200)
+        self.assertEqual(log.all_pending(), {})
+        self.assertEqual(len(self.segment_files("bob")), 1)
+
+    def test_offsets_compacted(self):
+        old = messagelog01.OFFSETS_COMPACT
+        messagelog01.OFFSETS_COMPACT = 100
+        try:
+            log = self.open(segment_bytes=200)
+            for i in range(1, 31):
+                log.append([("bob", row(i))])
+                log.consume("bob", [i])
+            journal = os.path.join(log._partition("bob").path, "offsets")
+            self.assertLessEqual(os.path.getsize(journal), 200)
+            log.append([("bob", row(31))])
+            log = self.open(segment_bytes=200)
+            self.assertEqual(log.pending("bob"), [row(31)])
+        finally:
+            messagelog01.OFFSETS_COMPACT = old
+
+    def test_partition_count_fixed(self):
+        log = self.open(partitions=3)
+        log.append([(f"user{i}", row(i)) for i in range(1, 20)])
+        log = self.open(partitions=8)
+        self.assertEqual(len(log.partitions), 3)
+        self.assertEqual(sum(len(ids) for ids in log.all_pending().values()), 19)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+# test_sessions.py
+import os
+import shutil
+import tempfile
+import unittest
+
+import server01
+
+
+class DatabaseTest(unittest.TestCase):
+    """server01 against a fresh database file."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._db_file = server01.DB_FILE
+        server01.DB_FILE = os.path.join(self.dir, "users.db")
+        server01.init_db()
+        for name in ("ana", "bob", "eve"):
+            self.add(name)
+
+    def tearDown(self):
+        server01.db_pool.close()
+        server01.db_pool = None
+        server01.DB_FILE = self._db_file
+        shutil.rmtree(self.dir)
+
+    def add(self, name):
+        with server01.db() as conn:
+            conn.execute("INSERT INTO users (country, phone, username, password) VALUES (?, ?, ?, ?)",
+                         ("PT", "+351-" + name, name, "x"))
+            conn.commit()
+
+    def delete(self, name):
+        with server01.db() as conn:
+            conn.execute("DELETE FROM users WHERE username=?", (name,))
+            conn.commit()
+
+
+class SessionTest(DatabaseTest):
+
+    def test_resume(self):
+        token = server01.create_session("ana")
+        self.assertEqual(server01.lookup_session(token), "ana")
+        self.assertIsNone(server01.lookup_session(token + "x"))
+
+    def test_stored_hashed(self):
+        token = server01.create_session("ana")
+        with server01.db() as conn:
+            stored = [r[0] for r in conn.execute("SELECT token_hash FROM sessions")]
+        self.assertEqual(stored, [server01.token_hash(token)])
+
+    def test_logout(self):
+        token = server01.create_session("ana")
+        other = server01.create_session("ana")
+        server01.delete_session(token)
+        self.assertIsNone(server01.lookup_session(token))
+        self.assertEqual(server01.lookup_session(other), "ana")
+
+    def test_expiry(self):
+        ttl = server01.SESSION_TTL
+        server01.SESSION_TTL = -1
+        try:
+            token = server01.create_session("ana")
+        finally:
+            server01.SESSION_TTL = ttl
+        self.assertIsNone(server01.lookup_session(token))
+        # expired rows are cleared by the user's next login
+        server01.create_session("ana")
+        with server01.db() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0], 1)
+
+    def test_deleted_user(self):
+        token = server01.create_session("bob")
+        self.delete("bob")
+        self.assertIsNone(server01.lookup_session(token))
+        with server01.db() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0], 0)
+        # re-registering the name does not bring the old login back
+        self.add("bob")
+        self.assertIsNone(server01.lookup_session(token))
+
+
+class HistoryTest(DatabaseTest):
+
+    def test_keyset_paging(self):
+        rows = [("ana" if i % 2 else "bob", "bob" if i % 2 else "ana", f"m{i}", "t", 0.0, 1) for i in range(25)]
+        rows.insert(10, ("eve", "ana", "other conversation", "t", 0.0, 1))
+        ids = server01.insert_messages(rows)
+        conversation = [mid for mid, r in zip(ids, rows) if r[0] != "eve"]
+        seen = []
+        before = server01.NEWEST
+        while True:
+            page = server01.fetch_conversation("bob", "ana", before, 10)
+            if not page:
+                break
+            seen.extend(r[0] for r in page)
+            before = page[-1][0]
+        self.assertEqual(seen, sorted(conversation, reverse=True))
+
+    def test_page_args(self):
+        self.assertEqual(server01.page_args({}), (server01.NEWEST, server01.HISTORY_PAGE))
+        self.assertEqual(server01.page_args({"before":7,"limit":10 ** 6}), (7, server01.HISTORY_MAX))
+        self.assertEqual(server01.page_args({"limit":"x"}), (None, None))
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_fires_once_in_order(self):
+        wheel = server01.TimerWheel(1.0)
+        now = wheel._tick * 1.0
+        wheel.schedule("a", now + 3)
+        wheel.schedule("b", now + 1)
+        self.assertEqual(wheel.advance(now + 0.5), [])
+        self.assertEqual(wheel.advance(now + 1), ["b"])
+        self.assertEqual(wheel.advance(now + 10), ["a"])
+        self.assertEqual(wheel.advance(now + 20), [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_reschedule_and_cancel(self):
+        wheel = server01.TimerWheel(1.0)
+        now = wheel._tick * 1.0
+        wheel.schedule("a", now + 2)
+        wheel.schedule("a", now + 5)
+        wheel.schedule("b", now + 2)
+        wheel.cancel("b")
+        wheel.cancel("missing")
+        self.assertEqual(wheel.advance(now + 4), [])
+        self.assertEqual(wheel.advance(now + 5), ["a"])
+
+    def test_higher_levels(self):
+        # deadlines on every level, and beyond the top one
+        wheel = server01.TimerWheel(1.0, sizes=(8, 4, 4))
+        now = wheel._tick * 1.0
+        delays = [1, 7, 8, 9, 31, 32, 33, 127, 128, 300]
+        for d in delays:
+            wheel.schedule(d, now + d)
+        fired = {}
+        for t in range(1, 302):
+            for key in wheel.advance(now + t):
+                fired[key] = t
+        self.assertEqual(fired, {d: d for d in delays})
+
+
+if __name__ == "__main__":
+    unittest.main()
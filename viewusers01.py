@@ -1,18 +1,58 @@
 # viewusers.py
 import tkinter as tk
 from tkinter import ttk, messagebox
+import argparse
+import os
+import socket
 import sqlite3
+import threading
+import time
+
+from framing01 import Framing
 
 DB_FILE = "users.db"
 POLL_MS = 3000
+PAGE_SIZE = 200         # rows in the table at a time
+FILTER_DELAY_MS = 250   # typing pause before the filter is applied
+RETRY_SECS = 3.0        # push mode: pause before reconnecting to the server
+EVENT_LINES = 200       # push mode: admin events kept in the log
+
+def recv_single(sock, framing):
+    while True:
+        for msg in framing.messages():
+            return msg
+        if not framing.recv_into(sock):
+            return None
 
 class ViewUsersApp:
-    def __init__(self, root):
+    """Reads users.db directly, polling for changes, or with server set
+    (host, port) follows the server's admin event stream and never polls."""
+
+    def __init__(self, root, server=None, token=None):
         self.root = root
-        root.title("Registered Users - Admin")
-        root.geometry("820x520")
+        self.server = server
+        self.token = token
+        root.title("Registered Users - Admin" + (f" ({server[0]}:{server[1]}, live)" if server else ""))
+        root.geometry("820x560")
         root.configure(bg="#071226")
 
+        self.conn = None
+        self.data_version = None    # PRAGMA data_version at the last check
+        self.users_version = None   # the server's users change counter at the last check
+        self.page_starts = [None]   # username each visited page starts after; the last is shown
+        self.has_next = False
+        self.filter_job = None
+        self.reload_job = None
+
+        # push mode
+        self.sock = None
+        self.framing = None
+        self.send_lock = threading.Lock()
+        self.running = True
+        self.pending = 0            # view_users requests not yet answered; only the last reply is shown
+        self.online = set()
+        self.stats = {}             # worker -> latest queue_depth event
+
         style = ttk.Style()
         style.theme_use("clam")
         style.configure("Treeview.Heading", font=("Segoe UI", 11, "bold"), background="#1abc9c", foreground="white")
@@ -20,6 +60,13 @@ class ViewUsersApp:
 
         ttk.Label(root, text="Registered Users", font=("Segoe UI", 18, "bold"), background="#071226", foreground="#9be7d3").pack(fill="x", pady=8)
 
+        searchf = tk.Frame(root, bg="#071226")
+        searchf.pack(fill="x", padx=12)
+        tk.Label(searchf, text="Filter (username or phone):", bg="#071226", fg="white").pack(side="left")
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add("write", lambda *a: self.on_filter())
+        ttk.Entry(searchf, textvariable=self.filter_var, width=40).pack(side="left", padx=8)
+
         frame = tk.Frame(root, bg="#06121a")
         frame.pack(fill="both", expand=True, padx=12, pady=8)
 
@@ -27,7 +74,8 @@ class ViewUsersApp:
         self.tree = ttk.Treeview(frame, columns=columns, show="headings")
         self.tree.heading("phone", text="📞 Phone (with country code)")
         self.tree.heading("username", text="👤 Username")
-        self.tree.heading("password", text="🔑 Password")
+        # the server never hands out password hashes; push mode shows presence there
+        self.tree.heading("password", text="🟢 Status" if server else "🔑 Password")
         self.tree.column("phone", width=300, anchor="center")
         self.tree.column("username", width=250, anchor="center")
         self.tree.column("password", width=250, anchor="center")
@@ -37,58 +85,364 @@ class ViewUsersApp:
         self.tree.pack(side="left", fill="both", expand=True)
         vsb.pack(side="right", fill="y")
 
+        self.status_var = tk.StringVar()
+        tk.Label(root, textvariable=self.status_var, bg="#071226", fg="#9be7d3").pack()
+        if server:
+            self.stats_var = tk.StringVar(value="Connecting…")
+            tk.Label(root, textvariable=self.stats_var, bg="#071226", fg="#9be7d3").pack()
+            self.events = tk.Listbox(root, height=6, bg="#06121a", fg="white", font=("Consolas", 10))
+            self.events.pack(fill="x", padx=12)
+
         btnf = tk.Frame(root, bg="#071226")
         btnf.pack(pady=10)
-        ttk.Button(btnf, text="🔄 Refresh", command=self.load_users).grid(row=0, column=0, padx=8)
-        ttk.Button(btnf, text="🗑 Delete Selected", command=self.delete_selected).grid(row=0, column=1, padx=8)
-        ttk.Button(btnf, text="❌ Exit", command=root.destroy).grid(row=0, column=2, padx=8)
+        self.prev_btn = ttk.Button(btnf, text="◀ Prev", command=self.prev_page)
+        self.prev_btn.grid(row=0, column=0, padx=8)
+        self.next_btn = ttk.Button(btnf, text="Next ▶", command=self.next_page)
+        self.next_btn.grid(row=0, column=1, padx=8)
+        ttk.Button(btnf, text="🔄 Refresh", command=self.load_users).grid(row=0, column=2, padx=8)
+        ttk.Button(btnf, text="🗑 Delete Selected", command=self.delete_selected).grid(row=0, column=3, padx=8)
+        ttk.Button(btnf, text="❌ Exit", command=self.on_exit).grid(row=0, column=4, padx=8)
+        root.protocol("WM_DELETE_WINDOW", self.on_exit)
 
-        self.load_users()
-        self._poll()
+        if server:
+            threading.Thread(target=self.listen_server, daemon=True).start()
+        else:
+            self.load_users()
+            self._poll()
+
+    def on_exit(self):
+        self.running = False
+        self.disconnect()
+        self.root.destroy()
+
+    def db(self):
+        # one connection for the life of the window
+        if self.conn is None:
+            self.conn = sqlite3.connect(DB_FILE)
+        return self.conn
+
+    def reset_db(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = None
+        self.data_version = self.users_version = None
+
+    def changed(self):
+        """Cheap check before any reload. data_version moves whenever another
+        connection commits, messages included; the users counter the server's
+        triggers keep then says whether any of those commits touched users."""
+        conn = self.db()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return False
+        self.data_version = version
+        try:
+            users = conn.execute("SELECT value FROM counters WHERE name='users'").fetchone()
+        except sqlite3.OperationalError:
+            return True   # a database the server has not upgraded yet
+        users = users[0] if users else None
+        if users is not None and users == self.users_version:
+            return False
+        self.users_version = users
+        return True
+
+    def filter_clause(self):
+        text = self.filter_var.get().strip()
+        if not text:
+            return "", []
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return "(username LIKE ? ESCAPE '\\' OR phone LIKE ? ESCAPE '\\')", [pattern, pattern]
+
+    def fetch_page(self, after):
+        """One page in view_users order, keyset-paged from the username `after`."""
+        where, args = self.filter_clause()
+        terms = [where] if where else []
+        if after is not None:
+            # written so the first term is an index seek on idx_users_listing
+            terms.append("username >= ? COLLATE NOCASE AND NOT (username = ? COLLATE NOCASE AND username <= ?)")
+            args += [after, after, after]
+        sql = "SELECT country, phone, username, password FROM users"
+        if terms:
+            sql += " WHERE " + " AND ".join(terms)
+        sql += " ORDER BY username COLLATE NOCASE, username LIMIT ?"
+        rows = self.db().execute(sql, args + [PAGE_SIZE + 1]).fetchall()
+        return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+    def count_users(self):
+        where, args = self.filter_clause()
+        sql = "SELECT COUNT(*) FROM users" + (" WHERE " + where if where else "")
+        return self.db().execute(sql, args).fetchone()[0]
 
     def load_users(self):
-        for r in self.tree.get_children():
-            self.tree.delete(r)
+        """Re-read the page on show and apply only the rows that differ."""
+        if self.server:
+            self.request_page()
+            return
         try:
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("SELECT country, phone, username, password FROM users ORDER BY username COLLATE NOCASE")
-            rows = cur.fetchall()
-            for r in rows:
-                phone_display = (r[0] + " " + r[1]).strip()
-                self.tree.insert("", "end", values=(phone_display, r[2], r[3]))
-            conn.close()
+            rows, self.has_next = self.fetch_page(self.page_starts[-1])
+            if not rows and len(self.page_starts) > 1:
+                # everything on this page went away: step back
+                self.page_starts.pop()
+                rows, self.has_next = self.fetch_page(self.page_starts[-1])
+            total = self.count_users()
         except sqlite3.Error as e:
+            self.reset_db()
             messagebox.showerror("DB Error", str(e))
+            return
+        self.show_page(rows, total)
+
+    def show_page(self, rows, total):
+        self.apply_rows(rows)
+        first = (len(self.page_starts) - 1) * PAGE_SIZE
+        shown = f"{first + 1}–{first + len(rows)}" if rows else "0"
+        self.status_var.set(f"Showing {shown} of {total}" + (" matching" if self.filter_var.get().strip() else ""))
+        self.prev_btn.state(["!disabled"] if len(self.page_starts) > 1 else ["disabled"])
+        self.next_btn.state(["!disabled"] if self.has_next else ["disabled"])
+
+    def apply_rows(self, rows):
+        # usernames are unique, so they double as Treeview item ids
+        wanted = {}
+        for r in rows:
+            wanted[r[2]] = ((r[0] + " " + r[1]).strip(), r[2], r[3])
+        for iid in self.tree.get_children():
+            if iid not in wanted:
+                self.tree.delete(iid)
+        for index, (iid, values) in enumerate(wanted.items()):
+            if not self.tree.exists(iid):
+                self.tree.insert("", index, iid=iid, values=values)
+                continue
+            if tuple(str(v) for v in self.tree.item(iid, "values")) != tuple(str(v) for v in values):
+                self.tree.item(iid, values=values)
+            if self.tree.index(iid) != index:
+                self.tree.move(iid, "", index)
+
+    def next_page(self):
+        children = self.tree.get_children()
+        if self.has_next and children:
+            self.page_starts.append(children[-1])
+            self.load_users()
+            self.tree.yview_moveto(0)
+
+    def prev_page(self):
+        if len(self.page_starts) > 1:
+            self.page_starts.pop()
+            self.load_users()
+            self.tree.yview_moveto(0)
+
+    def on_filter(self):
+        # wait for a pause in typing; a filter runs one page query, not a reload
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+        self.filter_job = self.root.after(FILTER_DELAY_MS, self._apply_filter)
+
+    def _apply_filter(self):
+        self.filter_job = None
+        self.page_starts = [None]
+        self.load_users()
 
     def delete_selected(self):
         sel = self.tree.selection()
         if not sel:
             messagebox.showwarning("Select", "No user selected")
             return
-        item = self.tree.item(sel[0])
-        username = item['values'][1]
+        # the item id is the username; values turn numeric names into ints
+        username = sel[0]
         ok = messagebox.askyesno("Confirm", f"Delete user '{username}' ?")
         if not ok:
             return
+        if self.server:
+            # the server ends the user's session too; the reply arrives in on_frame
+            if not self.send({"action":"admin_delete","username":username}):
+                messagebox.showerror("Server", "Not connected")
+            return
         try:
-            conn = sqlite3.connect(DB_FILE)
+            conn = self.db()
             cur = conn.cursor()
             cur.execute("DELETE FROM users WHERE username=?", (username,))
             conn.commit()
-            conn.close()
+            # our own commits do not move data_version; refresh the page now
             self.load_users()
             messagebox.showinfo("Deleted", f"User '{username}' removed")
         except sqlite3.Error as e:
+            self.reset_db()
             messagebox.showerror("DB Error", str(e))
 
     def _poll(self):
         try:
-            self.load_users()
+            if self.changed():
+                self.load_users()
+        except sqlite3.Error:
+            self.reset_db()
         finally:
             self.root.after(POLL_MS, self._poll)
 
+    # ---------- push mode ----------
+    def listen_server(self):
+        """Background thread: hold one admin_subscribe connection and hand
+        every frame to the Tk loop, reconnecting after a drop."""
+        while self.running:
+            try:
+                sock = socket.create_connection(self.server)
+                framing = Framing()
+                sock.sendall(framing.encode(framing.client_hello()))
+                resp = recv_single(sock, framing)
+                if resp and resp.get("action") == "hello":
+                    framing.switch(resp)
+                sock.sendall(framing.encode({"action":"admin_subscribe","admin_token":self.token}))
+                resp = recv_single(sock, framing)
+                if not resp:
+                    raise ConnectionError("connection closed")
+                if resp.get("status") != "success":
+                    sock.close()
+                    self.root.after(0, self.on_refused, resp.get("message", "Refused"))
+                    return
+                with self.send_lock:
+                    self.sock, self.framing = sock, framing
+                self.root.after(0, self.on_subscribed, resp)
+                while True:
+                    for msg in framing.messages():
+                        self.root.after(0, self.on_frame, msg)
+                    if not framing.recv_into(sock):
+                        raise ConnectionError("connection closed")
+            except Exception:
+                self.disconnect()
+                if self.running:
+                    self.root.after(0, self.stats_var.set, f"Disconnected; retrying in {RETRY_SECS:g}s")
+                    time.sleep(RETRY_SECS)
+
+    def disconnect(self):
+        with self.send_lock:
+            sock, self.sock = self.sock, None
+        if sock:
+            try:
+                sock.close()
+            except:
+                pass
+
+    def send(self, obj):
+        with self.send_lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(self.framing.encode(obj))
+                return True
+            except:
+                return False
+
+    def request_page(self):
+        text = self.filter_var.get().strip()
+        if self.send({"action":"view_users","after":self.page_starts[-1],"limit":PAGE_SIZE,"match":text or None}):
+            self.pending += 1
+
+    def on_refused(self, message):
+        self.stats_var.set(f"Admin stream refused: {message}")
+        messagebox.showerror("Server", f"{message}\nStart the server with --admin-token and pass the same --token here.")
+
+    def on_subscribed(self, resp):
+        self.online = set(resp.get("online", []))
+        stats = resp.get("stats")
+        self.stats = {stats.get("worker"): stats} if stats else {}
+        self.pending = 0
+        self.log("connected to the admin stream")
+        self.show_stats()
+        self.load_users()
+
+    def on_frame(self, msg):
+        if msg.get("action") == "ping":
+            self.send({"action":"pong"})
+        elif msg.get("action") == "admin_event":
+            self.on_event(msg)
+        elif "users" in msg and "total" in msg:
+            self.on_page(msg)
+        elif "username" in msg and "message" in msg:
+            # admin_delete reply
+            if msg.get("status") == "success":
+                messagebox.showinfo("Deleted", f"User '{msg['username']}' removed")
+            else:
+                messagebox.showerror("Delete", f"{msg['username']}: {msg['message']}")
+
+    def on_page(self, msg):
+        self.pending = max(0, self.pending - 1)
+        if self.pending:
+            return   # a newer request is on its way
+        rows = [(u.get("country", ""), u.get("phone", ""), u.get("username"),
+                 "online" if u.get("username") in self.online else "") for u in msg.get("users", [])]
+        if not rows and len(self.page_starts) > 1:
+            # everything on this page went away: step back
+            self.page_starts.pop()
+            self.request_page()
+            return
+        self.has_next = msg.get("next") is not None
+        self.show_page(rows, msg.get("total", len(rows)))
+
+    def on_event(self, msg):
+        event = msg.get("event")
+        if event in ("login", "logout"):
+            users = msg.get("users", [])
+            if event == "login":
+                self.online.update(users)
+            else:
+                self.online.difference_update(users)
+            for u in users:
+                if self.tree.exists(u):
+                    self.tree.set(u, "password", "online" if event == "login" else "")
+            self.log(f"{event} {', '.join(users)}")
+            self.show_stats()
+        elif event in ("registered", "deleted"):
+            phone = (msg.get("country", "") + " " + msg.get("phone", "")).strip()
+            detail = f" ({phone})" if event == "registered" and phone else ""
+            self.log(f"{event} {msg.get('username')}{detail}")
+            self.schedule_reload()
+        elif event == "queue_depth":
+            self.stats[msg.get("worker")] = msg
+            self.show_stats()
+        elif event == "maintenance":
+            self.log(f"maintenance: {msg.get('deleted', 0)} old messages archived, "
+                     f"{msg.get('vacuumed_pages', 0)} pages freed")
+
+    def schedule_reload(self):
+        # a burst of registrations costs one page request
+        if self.reload_job is None:
+            self.reload_job = self.root.after(FILTER_DELAY_MS, self._reload)
+
+    def _reload(self):
+        self.reload_job = None
+        self.load_users()
+
+    def log(self, text):
+        self.events.insert("end", time.strftime("%H:%M:%S ") + text)
+        if self.events.size() > EVENT_LINES:
+            self.events.delete(0, self.events.size() - EVENT_LINES - 1)
+        self.events.see("end")
+
+    def show_stats(self):
+        parts = [f"{len(self.online)} online"]
+        for worker in sorted(self.stats, key=str):
+            s = self.stats[worker]
+            parts.append(f"worker {worker}: {s.get('connections', 0)} conns, outbox {s.get('outbox_bytes', 0)} B"
+                         f" ({s.get('congested', 0)} congested), write queue {s.get('write_queue', 0)},"
+                         f" hash queue {s.get('hash_queue', 0)}")
+        self.stats_var.set(" | ".join(parts))
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Registered users admin console")
+    p.add_argument("--db", default=DB_FILE, help="database file read in direct mode")
+    p.add_argument("--server", metavar="HOST:PORT",
+                   help="follow a running server's admin event stream instead of reading the database")
+    p.add_argument("--token", default=os.environ.get("CHAT_ADMIN_TOKEN"),
+                   help="the server's admin token (default: $CHAT_ADMIN_TOKEN)")
+    return p.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
+    DB_FILE = args.db
+    server = None
+    if args.server:
+        host, _, port = args.server.rpartition(":")
+        server = (host or "127.0.0.1", int(port))
     root = tk.Tk()
-    app = ViewUsersApp(root)
+    app = ViewUsersApp(root, server, args.token)
     root.mainloop()